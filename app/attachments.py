@@ -0,0 +1,204 @@
+import contextlib
+import hashlib
+import os
+import sys
+import tempfile
+import time
+from os import environ
+from typing import AsyncIterator, Optional
+from urllib.parse import quote
+
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from profiling import run_in_threadpool
+
+# Files are stored once per content, at ATTACHMENT_DIR/<sha256[:2]>/<sha256[2:4]>/<sha256>
+ATTACHMENT_DIR = environ.get("ATTACHMENT_DIR", "attachments")
+ATTACHMENT_MAX_SIZE = int(environ.get("ATTACHMENT_MAX_SIZE", 100 * 1024 * 1024))  # bytes
+# Bytes read per body message when the server can't send the file itself
+ATTACHMENT_CHUNK_SIZE = int(environ.get("ATTACHMENT_CHUNK_SIZE", 256 * 1024))
+# Unreferenced files younger than this are left alone by the garbage collection, their rows may not be committed yet
+ATTACHMENT_GC_GRACE = float(environ.get("ATTACHMENT_GC_GRACE", 3600))  # seconds
+# ASGI extension for handing a file to the server, which then sends it with sendfile(2)
+ZERO_COPY_SEND = "http.response.zerocopysend"
+
+
+class AttachmentTooLarge(ValueError):
+    pass
+
+
+class RangeNotSatisfiable(ValueError):
+    pass
+
+
+def blob_path(digest: str, directory: str = ATTACHMENT_DIR):
+    return os.path.join(directory, digest[:2], digest[2:4], digest)
+
+
+def write_chunk(file, hasher, chunk: bytes):
+    # hashlib releases the GIL on large buffers, so hashing runs in the threadpool next to the write
+    hasher.update(chunk)
+    file.write(chunk)
+
+
+def finish_upload(file, temporary: str, digest: str, directory: str):
+    # Moves the upload under its digest, or drops it if the content is there already
+    file.flush()
+    os.fsync(file.fileno())
+    file.close()
+    path = blob_path(digest, directory)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        os.unlink(temporary)
+        # A fresh mtime keeps the garbage collection away until the new row is committed
+        os.utime(path)
+    else:
+        os.replace(temporary, path)
+
+
+async def store_upload(chunks: AsyncIterator[bytes], directory: str = ATTACHMENT_DIR,
+                       max_size: int = ATTACHMENT_MAX_SIZE):
+    # Streams a request body to disk without holding more than one chunk of it, returns (sha256 hex digest, size)
+    temporary_dir = os.path.join(directory, "tmp")
+    os.makedirs(temporary_dir, exist_ok=True)
+    fd, temporary = tempfile.mkstemp(dir=temporary_dir)
+    file = os.fdopen(fd, "wb")
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        async for chunk in chunks:
+            size += len(chunk)
+            if size > max_size:
+                raise AttachmentTooLarge(f"Attachments can't be larger than {max_size} bytes")
+            if chunk:
+                await run_in_threadpool(write_chunk, file, hasher, chunk)
+        digest = hasher.hexdigest()
+        await run_in_threadpool(finish_upload, file, temporary, digest, directory)
+    except BaseException:
+        file.close()
+        # Already gone when finish_upload failed after moving it into place
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(temporary)
+        raise
+    return digest, size
+
+
+def parse_range(header: str, size: int):
+    # The (first, last) byte of a single range request, None to answer with the whole file. Multiple ranges and
+    # headers that don't parse are ignored, as RFC 9110 allows.
+    unit, _, ranges = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        return None
+    first, separator, last = ranges.strip().partition("-")
+    if not separator:
+        return None
+    try:
+        first, last = int(first) if first else None, int(last) if last else None
+    except ValueError:
+        return None
+    if first is None:
+        # The last `last` bytes
+        if last is None:
+            return None
+        if last <= 0 or size == 0:
+            raise RangeNotSatisfiable()
+        return max(0, size - last), size - 1
+    last = size - 1 if last is None else last
+    if first >= size:
+        raise RangeNotSatisfiable()
+    if first > last:
+        return None
+    return first, min(last, size - 1)
+
+
+class AttachmentResponse(Response):
+    # A stored file with ETag, conditional and range request handling. The content behind a digest never changes, so
+    # the digest is the ETag and clients may cache the file for good.
+    def __init__(self, path: str, size: int, digest: str, media_type: str, filename: str, request_headers,
+                 method: str = "GET"):
+        self.path = path
+        self.background = None
+        self.media_type = media_type
+        self.send_body = method.upper() != "HEAD"
+        self.range: Optional[tuple] = None
+        etag = f'"{digest}"'
+        # Served as a download and never sniffed, so an uploaded page can't run scripts in the app's origin
+        headers = {"content-type": media_type, "etag": etag, "accept-ranges": "bytes",
+                   "cache-control": "private, max-age=31536000, immutable", "x-content-type-options": "nosniff",
+                   "content-disposition": f"attachment; filename*=utf-8''{quote(filename)}"}
+        if_none_match = {tag.strip() for tag in request_headers.get("if-none-match", "").split(",")}
+        if etag in if_none_match or f"W/{etag}" in if_none_match or "*" in if_none_match:
+            self.status_code = 304
+            self.send_body = False
+            self.init_headers(headers)
+            return
+        self.status_code = 200
+        range_header = request_headers.get("range")
+        # A client resuming with an outdated If-Range gets the whole file instead of a mismatched piece
+        if range_header and request_headers.get("if-range", etag) == etag:
+            try:
+                self.range = parse_range(range_header, size)
+            except RangeNotSatisfiable:
+                self.status_code = 416
+                self.send_body = False
+                headers["content-range"] = f"bytes */{size}"
+        first, last = self.range or (0, size - 1)
+        if self.range is not None:
+            self.status_code = 206
+            headers["content-range"] = f"bytes {first}-{last}/{size}"
+        headers["content-length"] = str(last - first + 1 if self.status_code != 416 else 0)
+        self.offset, self.count = first, last - first + 1
+        self.init_headers(headers)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if not self.send_body or self.count <= 0:
+            await send({"type": "http.response.body", "body": b""})
+            return
+        file = await run_in_threadpool(open, self.path, "rb")
+        try:
+            if ZERO_COPY_SEND in scope.get("extensions", {}):
+                await send({"type": ZERO_COPY_SEND, "file": file, "offset": self.offset, "count": self.count})
+                return
+            offset, end = self.offset, self.offset + self.count
+            while offset < end:
+                chunk = await run_in_threadpool(os.pread, file.fileno(), min(ATTACHMENT_CHUNK_SIZE, end - offset),
+                                                offset)
+                if not chunk:
+                    raise RuntimeError(f"{self.path} is shorter than its recorded size")
+                offset += len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": offset < end})
+        finally:
+            file.close()
+
+
+def collect_garbage(referenced, directory: str = ATTACHMENT_DIR, grace: float = ATTACHMENT_GC_GRACE):
+    # Deletes the stored files no attachment row refers to anymore, and uploads abandoned halfway. Returns how many.
+    removed = 0
+    cutoff = time.time() - grace
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            in_tmp = os.path.basename(root) == "tmp"
+            if (in_tmp or name not in referenced) and os.stat(path).st_mtime < cutoff:
+                os.unlink(path)
+                removed += 1
+    return removed
+
+
+if __name__ == "__main__":
+    # python attachments.py gc: deletes the files of deleted chats' attachments, e.g. from cron
+    from sqlalchemy import select
+
+    import db_defs
+    from db import create_shards, engine, shards
+    if sys.argv[1:] != ["gc"]:
+        sys.exit("usage: python attachments.py gc")
+    db_defs.Base.metadata.create_all(bind=engine)
+    create_shards()
+    digests = set()
+    for bind in [engine] + (shards.engines if shards is not None else []):
+        with bind.connect() as connection:
+            digests.update(connection.scalars(select(db_defs.Attachment.digest).distinct()))
+    print(f"removed {collect_garbage(digests)} files")
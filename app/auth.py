@@ -1,28 +1,172 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from os import environ
-from typing import Optional
+from os import environ, cpu_count
+from typing import Optional, Dict, Set, Tuple
 
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
 from passlib.context import CryptContext
-from sqlalchemy.orm import Session
+from sqlalchemy import select, event
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, object_session
 from starlette import status
 
 import db_defs
 from db import get_db
-from defs import TokenData
+from metrics import observe_bcrypt, registry
+from defs import TokenData, CurrentUser
 
 load_dotenv()
 SECRET_KEY = environ.get("AUTHKEY")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# Changing the cost takes effect for existing users on their next successful login
+BCRYPT_ROUNDS = int(environ.get("BCRYPT_ROUNDS", 12))
+# "thread" or "process"
+HASH_POOL = environ.get("HASH_POOL", "thread")
+HASH_WORKERS = int(environ.get("HASH_WORKERS", cpu_count() or 1))
+# Hashing jobs allowed to wait for a free worker before new ones are rejected with 503
+HASH_QUEUE_SIZE = int(environ.get("HASH_QUEUE_SIZE", 32))
+TOKEN_CACHE_SIZE = int(environ.get("TOKEN_CACHE_SIZE", 10000))
+# Upper bound on how long a cached user snapshot is trusted, entries never outlive the token's exp either. Changes
+# to a user only invalidate the cache of the process that made them, with several workers the others go on using
+# the old snapshot for up to this long: lower it where disabling a user has to take effect sooner.
+TOKEN_CACHE_TTL = float(environ.get("TOKEN_CACHE_TTL", 60))
+# Comma separated usernames allowed to use the /admin endpoints
+ADMIN_USERS = {username for username in environ.get("ADMIN_USERS", "").split(",") if username}
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
+def timed_call(fn, *args):
+    # Runs in the worker, so the time spent waiting for a free one isn't counted
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+class HashPool:
+    def __init__(self, executor: Executor, workers: int, queue_size: int):
+        self.executor = executor
+        self.limit = workers + queue_size
+        self.pending = 0
+
+    async def run(self, fn, *args):
+        # Only touched from the event loop, so the counter needs no lock
+        if self.pending >= self.limit:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many password checks in progress",
+                headers={"Retry-After": "1"},
+            )
+        self.pending += 1
+        try:
+            elapsed, result = await asyncio.wrap_future(self.executor.submit(timed_call, fn, *args))
+        finally:
+            self.pending -= 1
+        observe_bcrypt(elapsed)
+        return result
+
+
+hash_pool = HashPool(
+    (ProcessPoolExecutor if HASH_POOL == "process" else ThreadPoolExecutor)(max_workers=HASH_WORKERS),
+    HASH_WORKERS, HASH_QUEUE_SIZE
+)
+
+
+class TokenCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: "OrderedDict[str, Tuple[float, CurrentUser]]" = OrderedDict()
+        self.tokens_by_user: Dict[str, Set[str]] = {}
+        self.hits = 0
+        self.misses = 0
+        # Invalidation can come from ORM events fired in threadpool sessions
+        self.lock = threading.Lock()
+
+    def get(self, token: str):
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    self._remove(token)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(token)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, token: str, user: CurrentUser, expires_at: float):
+        with self.lock:
+            self.entries[token] = (min(expires_at, time.time() + self.ttl), user)
+            self.entries.move_to_end(token)
+            self.tokens_by_user.setdefault(user.username, set()).add(token)
+            while len(self.entries) > self.max_size:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate_user(self, username: str):
+        with self.lock:
+            for token in self.tokens_by_user.pop(username, ()):
+                self.entries.pop(token, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tokens_by_user.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+    def _remove(self, token: str):
+        _, user = self.entries.pop(token)
+        tokens = self.tokens_by_user.get(user.username)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self.tokens_by_user[user.username]
+
+
+token_cache = TokenCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+
+
+@registry.collector
+def collect_auth_metrics():
+    stats = token_cache.stats()
+    return [
+        ("chatapp_token_cache_hits_total", "Tokens resolved from the cache", "counter", stats["hits"]),
+        ("chatapp_token_cache_misses_total", "Tokens decoded and looked up", "counter", stats["misses"]),
+        ("chatapp_token_cache_size", "Cached tokens", "gauge", stats["size"]),
+        ("chatapp_hash_pool_pending", "Password hashing jobs running or queued", "gauge", hash_pool.pending),
+    ]
+
+
+@event.listens_for(db_defs.User, "after_update")
+@event.listens_for(db_defs.User, "after_delete")
+def remember_changed_user(mapper, connection, target: db_defs.User):
+    # Bulk UPDATE/DELETE statements skip these events, call token_cache.invalidate_user after them. The cache is only
+    # invalidated once the change is committed, until then a concurrent request would cache the old row again.
+    object_session(target).info.setdefault("changed_users", set()).add(target.username)
+
+
+@event.listens_for(Session, "after_commit")
+def invalidate_changed_users(session: Session):
+    for username in session.info.pop("changed_users", ()):
+        token_cache.invalidate_user(username)
+
+
+@event.listens_for(Session, "after_rollback")
+def forget_changed_users(session: Session):
+    session.info.pop("changed_users", None)
+
+
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
@@ -31,17 +175,31 @@ def get_password_hash(password):
     return pwd_context.hash(password)
 
 
-def get_user(db: Session, username: str):
-    result = db.query(db_defs.User).filter_by(username=username)
-    return result.scalar()
+def verify_and_rehash(plain_password, hashed_password):
+    # Returns whether the password matched and, if the stored hash uses outdated settings, its replacement
+    if not verify_password(plain_password, hashed_password):
+        return False, None
+    return True, get_password_hash(plain_password) if pwd_context.needs_update(hashed_password) else None
+
+
+async def hash_password(password):
+    return await hash_pool.run(get_password_hash, password)
+
+
+async def get_user(db: AsyncSession, username: str):
+    return await db.scalar(select(db_defs.User).filter_by(username=username))
 
 
-def authenticate_user(db, username: str, password: str):
-    user = get_user(db, username)
+async def authenticate_user(db: AsyncSession, username: str, password: str):
+    user = await get_user(db, username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    valid, new_hash = await hash_pool.run(verify_and_rehash, password, user.hashed_password)
+    if not valid:
         return False
+    if new_hash is not None:
+        user.hashed_password = new_hash
+        await db.commit()
     return user
 
 
@@ -56,7 +214,18 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+def token_username(token: str):
+    # Checks the signature and expiry only, for callers that can't wait for the database
+    try:
+        return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
+    except JWTError:
+        return None
+
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
+    current_user = token_cache.get(token)
+    if current_user is not None:
+        return current_user
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -70,13 +239,21 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
         token_data = TokenData(username=username)
     except JWTError:
         raise credentials_exception
-    user = get_user(db, token_data.username)
+    user = await get_user(db, token_data.username)
     if user is None:
         raise credentials_exception
-    return user
+    current_user = CurrentUser.from_orm(user)
+    token_cache.put(token, current_user, payload.get("exp", float("inf")))
+    return current_user
 
 
-async def get_current_active_user(current_user: db_defs.User = Depends(get_current_user)):
+async def get_current_active_user(current_user: CurrentUser = Depends(get_current_user)):
     if current_user.disabled:
         raise HTTPException(status_code=400, detail="Inactive user")
     return current_user
+
+
+async def get_current_admin_user(current_user: CurrentUser = Depends(get_current_active_user)):
+    if current_user.username not in ADMIN_USERS:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not an admin")
+    return current_user
@@ -0,0 +1,135 @@
+import codecs
+import json
+import re
+from os import environ
+from typing import AsyncIterator
+
+from starlette.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+# Rows per INSERT statement and transaction
+BULK_CHUNK_SIZE = int(environ.get("BULK_CHUNK_SIZE", 500))
+# Longest single item in an upload in characters, the most that is ever buffered of the request body
+BULK_MAX_ITEM_SIZE = int(environ.get("BULK_MAX_ITEM_SIZE", 64 * 1024))
+
+
+json_decoder = json.JSONDecoder()
+JSON_LITERALS = ("true", "false", "null", "NaN", "Infinity", "-Infinity")
+# The start of a number, or what can follow the digits the decoder took as a whole number
+NUMBER_TAIL = re.compile(r"-?\d*(\.\d*)?([eE][-+]?\d*)?")
+
+
+class BulkItemError(ValueError):
+    pass
+
+
+class BulkUploadError(ValueError):
+    # The rest of the upload can't be parsed
+    pass
+
+
+async def iter_bulk_items(chunks: AsyncIterator[bytes], ndjson: bool, max_item_size: int = BULK_MAX_ITEM_SIZE):
+    # Yields the decoded items of a JSON array or of newline delimited JSON as the body arrives, an item that isn't
+    # valid JSON is yielded as a BulkItemError where the format allows skipping it
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    expect = "["
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        if ndjson:
+            *lines, buffer = buffer.split("\n")
+            for line in lines:
+                if line.strip():
+                    yield parse_line(line)
+        else:
+            buffer, expect, items = parse_array(buffer, expect)
+            for item in items:
+                if isinstance(item, BulkUploadError):
+                    raise item
+                yield item
+        if len(buffer) > max_item_size:
+            raise BulkUploadError(f"Item longer than {max_item_size} characters")
+    buffer += decoder.decode(b"", final=True)
+    if ndjson:
+        if buffer.strip():
+            yield parse_line(buffer)
+    elif expect != "end":
+        raise BulkUploadError("Unterminated JSON array")
+
+
+def parse_line(line: str):
+    try:
+        return json.loads(line)
+    except ValueError as e:
+        return BulkItemError(f"Invalid JSON: {e}")
+
+
+def parse_array(buffer: str, expect: str):
+    # Consumes every complete item of a JSON array from the front of the buffer. `expect` is what has to come next,
+    # one of "[", "item or ]", "item", ", or ]" and "end", returned with the rest of the buffer. Where the array is
+    # broken, the items before it are returned with the BulkUploadError as the last one.
+    items = []
+    try:
+        return parse_items(buffer, expect, items)
+    except BulkUploadError as e:
+        return "", expect, items + [e]
+
+
+def parse_items(buffer: str, expect: str, items: list):
+    position = 0
+    while True:
+        while position < len(buffer) and buffer[position] in " \t\r\n":
+            position += 1
+        if position == len(buffer):
+            return "", expect, items
+        char = buffer[position]
+        if expect == "[":
+            # A "]" before any "[" too, it closes nothing
+            if char != "[":
+                raise BulkUploadError("Expected a JSON array")
+            expect = "item or ]"
+        elif expect == ", or ]":
+            if char not in ",]":
+                raise BulkUploadError("Expected ',' or ']' after an item")
+            expect = "item" if char == "," else "end"
+        elif expect == "end":
+            raise BulkUploadError("Unexpected data after the JSON array")
+        elif char == "]":
+            if expect == "item":
+                raise BulkUploadError("Expected an item after ','")
+            expect = "end"
+        else:
+            start = position
+            try:
+                item, position = json_decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError as e:
+                if cut_off(e):
+                    # Wait for more of the body
+                    return buffer[start:], expect, items
+                raise BulkUploadError(f"Invalid JSON: {e.msg}")
+            if not isinstance(item, (dict, list, str)) and NUMBER_TAIL.fullmatch(buffer, position):
+                # A number or literal at the end of the buffer might continue in the next chunk
+                return buffer[start:], expect, items
+            items.append(item)
+            expect = ", or ]"
+            continue
+        position += 1
+
+
+def cut_off(error: json.JSONDecodeError):
+    # Whether the item may just be incomplete: the decoder stopped at the end of the buffer, or in a string, literal,
+    # number or escape that runs up to it. Anything else can't be made valid by more of the body.
+    rest = error.doc[error.pos:]
+    return (not rest.strip() or error.msg.startswith("Unterminated string")
+            or any(literal.startswith(rest) for literal in JSON_LITERALS) or NUMBER_TAIL.fullmatch(rest) is not None
+            or (error.msg.startswith("Invalid \\uXXXX escape") and len(rest) < 6))
+
+
+class UploadStreamingResponse(StreamingResponse):
+    # Streams a body that is produced while the request body is still being read. StreamingResponse would race the
+    # body iterator for receive() to watch for disconnects and swallow parts of the upload.
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
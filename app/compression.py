@@ -0,0 +1,145 @@
+import asyncio
+import sqlite3
+import sys
+import time
+import zlib
+from os import environ
+
+from sqlalchemy import String, event
+from sqlalchemy.pool import Pool
+from sqlalchemy.types import TypeDecorator
+
+# Message contents of MESSAGE_COMPRESSION_THRESHOLD bytes or more are stored compressed in SQLite, as a blob whose first
+# byte names the codec. Shorter ones, and those that don't get smaller, stay text. Reading handles every stored form
+# whatever the settings are now.
+MESSAGE_COMPRESSION = environ.get("MESSAGE_COMPRESSION", "zlib")  # zlib, zstd (needs zstandard) or none
+MESSAGE_COMPRESSION_THRESHOLD = int(environ.get("MESSAGE_COMPRESSION_THRESHOLD", 1024))  # bytes
+MESSAGE_COMPRESSION_LEVEL = int(environ.get("MESSAGE_COMPRESSION_LEVEL", 3 if MESSAGE_COMPRESSION == "zstd" else 6))
+# Rows rewritten per transaction by `python compression.py compress`, and the pause between two transactions
+COMPRESS_BATCH_SIZE = int(environ.get("COMPRESS_BATCH_SIZE", 500))
+COMPRESS_BATCH_PAUSE = float(environ.get("COMPRESS_BATCH_PAUSE", 0.01))
+
+ZLIB = 1
+ZSTD = 2
+
+if MESSAGE_COMPRESSION == "zstd":
+    import zstandard
+elif MESSAGE_COMPRESSION not in ("zlib", "none"):
+    raise ValueError(f"Unknown MESSAGE_COMPRESSION {MESSAGE_COMPRESSION!r}")
+
+
+def compress(text):
+    # The stored form of a message content
+    if text is None or MESSAGE_COMPRESSION == "none":
+        return text
+    raw = text.encode()
+    if len(raw) < MESSAGE_COMPRESSION_THRESHOLD:
+        return text
+    if MESSAGE_COMPRESSION == "zstd":
+        packed = bytes((ZSTD,)) + zstandard.compress(raw, MESSAGE_COMPRESSION_LEVEL)
+    else:
+        packed = bytes((ZLIB,)) + zlib.compress(raw, MESSAGE_COMPRESSION_LEVEL)
+    return packed if len(packed) < len(raw) else text
+
+
+def decompress(value):
+    # The text of a stored message content, text passes through unchanged
+    if not isinstance(value, bytes):
+        return value
+    if value[0] == ZLIB:
+        return zlib.decompress(memoryview(value)[1:]).decode()
+    if value[0] == ZSTD:
+        import zstandard
+        return zstandard.decompress(memoryview(value)[1:]).decode()
+    raise ValueError(f"Unknown compression marker {value[0]}")
+
+
+class CompressedText(TypeDecorator):
+    # Compresses on the way into SQLite. Values are read back as stored, so a message's content is only decompressed
+    # by whatever serializes it, and loading messages that are never shown costs nothing extra.
+    impl = String
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return compress(value) if dialect.name == "sqlite" else value
+
+
+def register_functions(dbapi_connection, connection_record=None):
+    # message_text(content) for the search index triggers and view, every connection that writes messages needs it
+    if hasattr(dbapi_connection, "create_function"):
+        dbapi_connection.create_function("message_text", 1, decompress, deterministic=True)
+
+
+# On every pool, so that no SQLite connection of SQLAlchemy's misses the function, whoever set up its engine
+event.listen(Pool, "connect", register_functions)
+
+
+def connect(path: str, **kwargs):
+    # A plain sqlite3 connection that can write messages. Tools outside of the app, the sqlite3 shell included, can
+    # read, .backup and .dump/restore the database without message_text(), but writes to messages fail without it.
+    connection = sqlite3.connect(path, **kwargs)
+    register_functions(connection)
+    return connection
+
+
+async def compress_stored(db, pause: float = COMPRESS_BATCH_PAUSE, batch_size: int = COMPRESS_BATCH_SIZE):
+    # Rewrites the messages stored as text that are long enough to be compressed, batch by batch. Returns
+    # (rewritten messages, bytes before, bytes after). A message edited in the meantime is left to the edit.
+    import db_defs
+    from sqlalchemy import LargeBinary, bindparam, cast, func, select, update
+    messages = db_defs.Message.__table__
+    rewritten, before, after = 0, 0, 0
+    last_id = 0
+    while True:
+        rows = (await db.execute(
+            select(messages.c.id, messages.c.content)
+            .filter(messages.c.id > last_id, func.typeof(messages.c.content) == "text",
+                    func.length(cast(messages.c.content, LargeBinary)) >= MESSAGE_COMPRESSION_THRESHOLD)
+            .order_by(messages.c.id).limit(batch_size)
+        )).all()
+        if not rows:
+            await db.rollback()
+            return rewritten, before, after
+        last_id = rows[-1].id
+        changes = []
+        for row in rows:
+            stored = compress(row.content)
+            if isinstance(stored, bytes):
+                changes.append({"b_id": row.id, "b_old": row.content, "b_new": stored})
+                before += len(row.content.encode())
+                after += len(stored)
+        if changes:
+            # Core UPDATE with a plain String bind, the rows are compressed already
+            result = await db.execute(
+                update(messages).filter(messages.c.id == bindparam("b_id"),
+                                        messages.c.content == bindparam("b_old", type_=String))
+                .values(content=bindparam("b_new", type_=String)), changes
+            )
+            rewritten += result.rowcount
+        await db.commit()
+        await asyncio.sleep(pause)
+
+
+if __name__ == "__main__":
+    # python compression.py compress: compresses the messages stored before compression was turned on, in every shard
+    from db import create_shards, engine, open_session, shard_indexes
+    import db_defs
+    if sys.argv[1:] != ["compress"]:
+        sys.exit("usage: python compression.py compress")
+    if MESSAGE_COMPRESSION == "none":
+        sys.exit("MESSAGE_COMPRESSION is none")
+    db_defs.Base.metadata.create_all(bind=engine)
+    create_shards()
+
+    async def run_once():
+        for shard in shard_indexes():
+            db = open_session(shard)
+            start = time.perf_counter()
+            try:
+                rewritten, before, after = await compress_stored(db)
+            finally:
+                await db.close()
+            print(f"{'central database' if shard is None else f'shard {shard}'}: {rewritten} messages compressed, "
+                  f"{before} -> {after} bytes in {time.perf_counter() - start:.1f}s")
+
+    asyncio.run(run_once())
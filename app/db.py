@@ -1,23 +1,336 @@
 # import json
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import StaticPool
+from os import environ
+from typing import Dict, List, Optional
 
-engine = create_engine(
-    "sqlite+pysqlite:///test.db",
-    echo=True, future=True,
-    connect_args={"check_same_thread": False},
-    poolclass=StaticPool
-)
-SessionLocal = sessionmaker(autoflush=False, autocommit=False, bind=engine)
+from sqlalchemy import Column, Index, MetaData, Table, create_engine, event, literal, select, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool, StaticPool
+from starlette.requests import HTTPConnection
 
+import db_defs
+from metrics import METRICS_ENABLED, instrument_engine
+from profiling import PROFILING_ENABLED, run_in_threadpool
+from search import create_search_index
 
-def get_db():
-    db = SessionLocal()
+DB_URL = make_url(environ.get("DB_URL", "sqlite:///test.db"))
+# DB_ASYNC=1 serves requests through SQLAlchemy's asyncio extension, otherwise the sync session is used with every
+# round-trip pushed to the threadpool. The async URL defaults to DB_URL with the dialect's asyncio driver.
+DB_ASYNC = environ.get("DB_ASYNC", "").lower() in ("1", "true", "yes")
+DB_ASYNC_URL = make_url(environ.get("DB_ASYNC_URL") or DB_URL.set(
+    drivername={"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg"}.get(DB_URL.get_backend_name(),
+                                                                                      DB_URL.drivername)))
+DB_ECHO = environ.get("DB_ECHO", "").lower() in ("1", "true", "yes")
+# "queue" keeps up to DB_POOL_SIZE + DB_MAX_OVERFLOW connections open, "null" connects per session and "static"
+# shares one connection, which only an in-memory SQLite database needs.
+DB_POOL = environ.get("DB_POOL", "queue")
+DB_POOL_SIZE = int(environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(environ.get("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(environ.get("DB_POOL_TIMEOUT", 30))
+
+SQLITE_JOURNAL_MODE = environ.get("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT = int(environ.get("SQLITE_BUSY_TIMEOUT", 5000))  # ms
+SQLITE_MMAP_SIZE = int(environ.get("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))  # bytes
+SQLITE_CACHE_SIZE = int(environ.get("SQLITE_CACHE_SIZE", -64 * 1024))  # negative values are KiB, positive pages
+# SQLite ignores foreign keys, ON DELETE CASCADE included, unless they are turned on for every connection
+SQLITE_FOREIGN_KEYS = environ.get("SQLITE_FOREIGN_KEYS", "ON")
+
+# DB_SHARDS=N keeps the messages of every chat, with its invites, tombstones, archive, attachments and search index, in
+# one of N SQLite databases picked by hashing the chat id. Users, chats and memberships stay in the DB_URL database,
+# which every shard connection attaches, so queries join across both as if it was one database. The version and the
+# members' read state of a chat are counted in its shard too, so writing messages never takes the central write lock.
+DB_SHARDS = int(environ.get("DB_SHARDS", 0))
+# Shard i is at DB_SHARD_URL.format(i)
+DB_SHARD_URL = environ.get("DB_SHARD_URL", "sqlite:///shard{}.db")
+# Message ids of shard i start above i * SHARD_ID_SPAN, so they stay unique across shards
+SHARD_ID_SPAN = 1 << 40
+SHARD_TABLES = [db_defs.Message.__table__, db_defs.Invite.__table__, db_defs.Tombstone.__table__,
+                db_defs.MessageArchive.__table__, db_defs.ChatVersion.__table__, db_defs.Attachment.__table__,
+                db_defs.ReadState.__table__]
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers run alongside the single writer, and with synchronous=NORMAL a commit no longer waits for an
+    # fsync. Writers queue on the busy timeout instead of failing with "database is locked" right away.
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT}")
+    cursor.execute(f"PRAGMA journal_mode = {SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA cache_size = {SQLITE_CACHE_SIZE}")
+    cursor.execute(f"PRAGMA foreign_keys = {SQLITE_FOREIGN_KEYS}")
+    cursor.close()
+
+
+def shard_for(chat_id: int, count: int):
+    # Jump consistent hash (Lamping and Veach): growing from n to n + 1 shards only moves 1 / (n + 1) of the chats
+    key = chat_id & 0xFFFFFFFFFFFFFFFF
+    bucket, j = -1, 0
+    while j < count:
+        bucket = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+
+def engine_options(url, is_async=False):
+    options = {"echo": DB_ECHO, "future": True}
+    if DB_POOL == "queue":
+        options.update(poolclass=AsyncAdaptedQueuePool if is_async else QueuePool, pool_size=DB_POOL_SIZE,
+                       max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT, pool_pre_ping=True)
+    else:
+        options["poolclass"] = {"null": NullPool, "static": StaticPool}[DB_POOL]
+    if url.get_backend_name() == "sqlite":
+        options["connect_args"] = {"check_same_thread": False}
+    return options
+
+
+def configure_engine(sync_engine):
+    if sync_engine.dialect.name == "sqlite":
+        event.listen(sync_engine, "connect", set_sqlite_pragmas)
+    if METRICS_ENABLED or PROFILING_ENABLED:
+        instrument_engine(sync_engine)
+    return sync_engine
+
+
+engine = configure_engine(create_engine(DB_URL, **engine_options(DB_URL)))
+SessionLocal = sessionmaker(autoflush=False, autocommit=False, expire_on_commit=False, bind=engine)
+
+if DB_ASYNC:
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    async_engine = create_async_engine(DB_ASYNC_URL, **engine_options(DB_ASYNC_URL, is_async=True))
+    configure_engine(async_engine.sync_engine)
+    AsyncSessionLocal = sessionmaker(autoflush=False, autocommit=False, expire_on_commit=False, bind=async_engine,
+                                     class_=AsyncSession)
+
+
+class ShardSet:
+    def __init__(self, central_url, shard_urls: List[str], is_async: bool = DB_ASYNC):
+        central_path = make_url(central_url).database
+
+        def attach_central(dbapi_connection, connection_record):
+            # Unqualified names resolve in the shard first, so the central copies of the shard tables stay hidden
+            cursor = dbapi_connection.cursor()
+            cursor.execute("ATTACH DATABASE ? AS central", (central_path,))
+            cursor.execute(f"PRAGMA central.journal_mode = {SQLITE_JOURNAL_MODE}")
+            cursor.execute(f"PRAGMA central.synchronous = {SQLITE_SYNCHRONOUS}")
+            cursor.close()
+
+        self.engines = []
+        self.async_engines = []
+        self.sessions = []
+        for url in map(make_url, shard_urls):
+            engine = configure_engine(create_engine(url, **engine_options(url)))
+            event.listen(engine, "connect", attach_central)
+            self.engines.append(engine)
+            if is_async:
+                from sqlalchemy.ext.asyncio import create_async_engine
+                async_url = url.set(drivername="sqlite+aiosqlite")
+                engine = create_async_engine(async_url, **engine_options(async_url, is_async=True))
+                event.listen(configure_engine(engine.sync_engine), "connect", attach_central)
+                self.async_engines.append(engine)
+                self.sessions.append(sessionmaker(autoflush=False, autocommit=False, expire_on_commit=False,
+                                                  bind=engine, class_=AsyncSession))
+            else:
+                self.sessions.append(sessionmaker(autoflush=False, autocommit=False, expire_on_commit=False,
+                                                  bind=engine))
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def shard_for(self, chat_id: int):
+        return shard_for(chat_id, len(self))
+
+    def create_all(self):
+        for shard, engine in enumerate(self.engines):
+            create_shard_tables(engine.url, shard)
+
+    def session(self, shard: int):
+        if self.async_engines:
+            return self.sessions[shard]()
+        return ThreadedSession(self.sessions[shard]())
+
+    async def find_invite(self, invite: str):
+        # Invite links carry no chat id, so every shard is asked
+        for shard in range(len(self)):
+            db = self.session(shard)
+            try:
+                if await db.scalar(select(db_defs.Invite.chat_id).filter_by(id=invite)) is not None:
+                    return shard
+            finally:
+                await db.close()
+        return None
+
+    async def dispose(self):
+        for engine in self.async_engines:
+            await engine.dispose()
+        for engine in self.engines:
+            engine.dispose()
+
+
+def add_missing_columns(connection, tables):
+    # create_all only creates missing tables. Columns and indexes added to a table since the database was created are
+    # added here, NOT NULL columns with their default, which existing rows take on. Changed constraints aren't
+    # migrated, SQLite can't alter them in place.
+    for table in tables:
+        columns = {row[1] for row in connection.execute(text(f"PRAGMA table_info({table.name})"))}
+        if not columns:
+            continue
+        for column in table.columns:
+            if column.name in columns:
+                continue
+            definition = f"{column.name} {column.type.compile(dialect=connection.dialect)}"
+            if not column.nullable:
+                default = column.default.arg if column.default is not None and column.default.is_scalar else None
+                if default is None:
+                    raise RuntimeError(f"Can't add {table.name}.{column.name}, a NOT NULL column without a default")
+                definition += " NOT NULL DEFAULT " + str(literal(default, column.type).compile(
+                    dialect=connection.dialect, compile_kwargs={"literal_binds": True}))
+            connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {definition}"))
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
+def create_shard_tables(url, shard: int):
+    # Through a connection of its own, with the central database attached the shard tables would be found there. The
+    # foreign keys are left out, SQLite can't check them against the central database.
+    metadata = MetaData()
+    for table in SHARD_TABLES:
+        Table(table.name, metadata,
+              *(Column(column.name, column.type, primary_key=column.primary_key, nullable=column.nullable,
+                       autoincrement=column.autoincrement) for column in table.columns),
+              *(Index(index.name, *(column.name for column in index.columns)) for index in table.indexes),
+              **table.kwargs)
+    engine = create_engine(url, future=True)
+    try:
+        with engine.begin() as connection:
+            metadata.create_all(bind=connection)
+            add_missing_columns(connection, SHARD_TABLES)
+            create_search_index(connection)
+            for table in ("messages", "tombstones", "message_archive", "attachments"):
+                connection.execute(text("INSERT INTO sqlite_sequence (name, seq) SELECT :name, :seq WHERE NOT EXISTS "
+                                        "(SELECT 1 FROM sqlite_sequence WHERE name = :name)"),
+                                   {"name": table, "seq": shard * SHARD_ID_SPAN})
+    finally:
+        engine.dispose()
+
+
+shards: Optional[ShardSet] = ShardSet(DB_URL, [DB_SHARD_URL.format(i) for i in range(DB_SHARDS)]) \
+    if DB_SHARDS else None
+
+
+class ThreadedSession:
+    # The subset of AsyncSession the endpoints use, backed by a sync Session whose calls run in the threadpool
+
+    def __init__(self, session: Session):
+        self.sync_session = session
+
+    def add(self, instance):
+        self.sync_session.add(instance)
+
+    def get_bind(self):
+        return self.sync_session.get_bind()
+
+    async def execute(self, statement, params=None):
+        return await run_in_threadpool(self.sync_session.execute, statement, params)
+
+    async def scalar(self, statement, params=None):
+        return await run_in_threadpool(self.sync_session.scalar, statement, params)
+
+    async def scalars(self, statement, params=None):
+        return await run_in_threadpool(self.sync_session.scalars, statement, params)
+
+    async def get(self, entity, ident):
+        return await run_in_threadpool(self.sync_session.get, entity, ident)
+
+    async def delete(self, instance):
+        await run_in_threadpool(self.sync_session.delete, instance)
+
+    async def refresh(self, instance, attribute_names=None):
+        await run_in_threadpool(self.sync_session.refresh, instance, attribute_names)
+
+    async def flush(self):
+        await run_in_threadpool(self.sync_session.flush)
+
+    async def commit(self):
+        await run_in_threadpool(self.sync_session.commit)
+
+    async def rollback(self):
+        await run_in_threadpool(self.sync_session.rollback)
+
+    async def close(self):
+        await run_in_threadpool(self.sync_session.close)
+
+    async def run_sync(self, fn, *args, **kwargs):
+        return await run_in_threadpool(fn, self.sync_session, *args, **kwargs)
+
+
+async def dispose_engines():
+    # Pooled aiosqlite connections each own a non-daemon thread, the process can't exit until they are closed
+    if DB_ASYNC:
+        await async_engine.dispose()
+    engine.dispose()
+    if shards is not None:
+        await shards.dispose()
+
+
+def open_session(shard: Optional[int] = None):
+    # A session on the given shard, or on the central database
+    if shard is not None:
+        return shards.session(shard)
+    if DB_ASYNC:
+        return AsyncSessionLocal()
+    return ThreadedSession(SessionLocal())
+
+
+def sharded():
+    return shards is not None
+
+
+def shard_of(chat_id: int):
+    # The shard a chat is stored in, None without sharding
+    return None if shards is None else shards.shard_for(chat_id)
+
+
+def shard_groups(chat_ids) -> Dict[Optional[int], list]:
+    groups = {}
+    for chat_id in chat_ids:
+        groups.setdefault(shard_of(chat_id), []).append(chat_id)
+    return groups
+
+
+def shard_indexes():
+    return [None] if shards is None else list(range(len(shards)))
+
+
+def create_shards():
+    if shards is not None:
+        shards.create_all()
+
+
+async def route(connection: HTTPConnection):
+    # The shard a request works on, found from its path. Requests about no chat in particular use the central
+    # database and go to the shards themselves where they need messages.
+    path_params = connection.path_params
+    if "chat_id" in path_params:
+        try:
+            return shards.shard_for(int(path_params["chat_id"]))
+        except ValueError:
+            return None
+    if "invite" in path_params:
+        return await shards.find_invite(path_params["invite"])
+    return None
+
+
+async def get_db(connection: HTTPConnection = None):
+    db = open_session(await route(connection) if shards is not None and connection is not None else None)
     try:
         yield db
     finally:
-        db.close()
+        await db.close()
 
 # DB_PATH = "db.json"
 
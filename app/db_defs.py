@@ -1,14 +1,21 @@
 import sqlalchemy
-from sqlalchemy import Integer, Column, String, Boolean, ForeignKey, Table
+from sqlalchemy import Integer, Column, String, Boolean, ForeignKey, Table, Index, LargeBinary
 from sqlalchemy.orm import relationship, declarative_base
 
+from compression import CompressedText
+
 Base = declarative_base()
 
 chat_association_table = Table(
     'chat_association',
     Base.metadata,
-    Column('user_id', ForeignKey('users.username')),
-    Column('chat_id', ForeignKey('chats.id'))
+    Column('user_id', ForeignKey('users.username'), primary_key=True),
+    Column('chat_id', ForeignKey('chats.id', ondelete="CASCADE"), primary_key=True),
+    Column('last_read_message_id', Integer),
+    # Messages of others after last_read_message_id, kept up to date by every write so that listing chats never
+    # counts messages
+    Column('unread_count', Integer, nullable=False, default=0),
+    Index("ix_chat_association_chat_id", "chat_id")
 )
 
 
@@ -34,10 +41,21 @@ class User(Base):
 
 class Chat(Base):
     __tablename__ = "chats"
+    # Ids must never be reused, clients keep them around as sync state
+    __table_args__ = {"sqlite_autoincrement": True}
 
     id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
-    messages = relationship("Message", back_populates="chat", cascade="all, delete-orphan")
-    invites = relationship("Invite", back_populates="chat", cascade="all, delete-orphan")
+    version = Column(Integer, nullable=False, default=0)
+    # Retention policy, messages older than max_age seconds or beyond the newest max_count are archived
+    retention_max_age = Column(Integer)
+    retention_max_count = Column(Integer)
+    # Every message with an id up to this one lives in message_archive
+    archived_upto = Column(Integer, nullable=False, default=0)
+    # Set on deleted chats whose messages are still being purged, the row goes once they are gone
+    deleted_at = Column(sqlalchemy.BigInteger)
+    # The database deletes the children with the chat, the ORM must not load them to do it row by row
+    messages = relationship("Message", back_populates="chat", cascade="all, delete-orphan", passive_deletes=True)
+    invites = relationship("Invite", back_populates="chat", cascade="all, delete-orphan", passive_deletes=True)
     members = relationship(
         "User",
         secondary=chat_association_table,
@@ -50,15 +68,24 @@ class Chat(Base):
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        Index("ix_messages_chat_id_id", "chat_id", "id"),
+        Index("ix_messages_chat_id_version", "chat_id", "version"),
+        {"sqlite_autoincrement": True},
+    )
 
     id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
-    content = Column(String, nullable=False)
+    # Long contents are stored compressed, read them through compression.decompress
+    content = Column(CompressedText, nullable=False)
     timestamp = Column(sqlalchemy.BigInteger, nullable=False)
     edited = Column(Boolean, nullable=False, default=False)
+    version = Column(Integer, nullable=False, default=0)
     author_id = Column(Integer, ForeignKey('users.username'))
     author = relationship("User", back_populates="messages")
-    chat_id = Column(Integer, ForeignKey("chats.id"), nullable=False)
+    chat_id = Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"), nullable=False)
     chat = relationship("Chat", back_populates="messages")
+    # What the message shows of its attachments, copied from their rows, which never change. NULL without any.
+    attachments = Column(sqlalchemy.JSON(none_as_null=True))
 
     def __repr__(self):
         return f"Message(id={self.id!r}, content={self.content!r}, author={self.author!r}, " \
@@ -70,8 +97,97 @@ class Invite(Base):
 
     id = Column(String, primary_key=True, nullable=False)
 
-    chat_id = Column(Integer, ForeignKey("chats.id"), nullable=False)
+    chat_id = Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"), nullable=False)
     chat = relationship("Chat", back_populates="invites")
 
     def __repr__(self):
         return f"Invite(id={self.id!r}, chat_id={self.chat_id!r})"
+
+
+class Attachment(Base):
+    __tablename__ = "attachments"
+    __table_args__ = (
+        Index("ix_attachments_chat_id", "chat_id"),
+        Index("ix_attachments_digest", "digest"),
+        {"sqlite_autoincrement": True},
+    )
+
+    # One upload into a chat. Its file is stored once per content under the digest, however often it is uploaded.
+    id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
+    chat_id = Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"), nullable=False)
+    uploader_id = Column(String, ForeignKey("users.username"), nullable=False)
+    digest = Column(String(64), nullable=False)  # sha256, hex
+    size = Column(sqlalchemy.BigInteger, nullable=False)
+    filename = Column(String, nullable=False)
+    content_type = Column(String, nullable=False)
+    created_at = Column(sqlalchemy.BigInteger, nullable=False)
+
+    def __repr__(self):
+        return f"Attachment(id={self.id!r}, chat_id={self.chat_id!r}, digest={self.digest!r}, size={self.size!r}, " \
+               f"filename={self.filename!r})"
+
+
+class ChatVersion(Base):
+    __tablename__ = "chat_versions"
+
+    # With sharded storage the version of a chat is counted in its shard, so that writing a message doesn't take the
+    # central database's write lock. No foreign key, the chat lives in the central database. Until the first bump
+    # after sharding, a chat without a row here is still at chats.version.
+    chat_id = Column(Integer, primary_key=True, nullable=False, autoincrement=False)
+    version = Column(Integer, nullable=False)
+
+    def __repr__(self):
+        return f"ChatVersion(chat_id={self.chat_id!r}, version={self.version!r})"
+
+
+class ReadState(Base):
+    __tablename__ = "read_states"
+
+    # With sharded storage the read state of a chat's members is kept in its shard too, for the same reason as its
+    # version. A member without a row here is still at the read state of their chat_association row.
+    chat_id = Column(Integer, primary_key=True, nullable=False, autoincrement=False)
+    user_id = Column(String(30), primary_key=True, nullable=False)
+    last_read_message_id = Column(Integer)
+    unread_count = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"ReadState(chat_id={self.chat_id!r}, user_id={self.user_id!r}, " \
+               f"last_read_message_id={self.last_read_message_id!r}, unread_count={self.unread_count!r})"
+
+
+class Tombstone(Base):
+    __tablename__ = "tombstones"
+    __table_args__ = (
+        Index("ix_tombstones_chat_id_version", "chat_id", "version"),
+    )
+
+    id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
+    # No foreign key, tombstones have to outlive the chat. A missing message_id marks the whole chat as deleted.
+    chat_id = Column(Integer, nullable=False)
+    message_id = Column(Integer)
+    version = Column(Integer, nullable=False)
+    # Usernames of the members of a deleted chat, only they are told that it was deleted
+    members = Column(sqlalchemy.JSON(none_as_null=True))
+
+    def __repr__(self):
+        return f"Tombstone(chat_id={self.chat_id!r}, message_id={self.message_id!r}, version={self.version!r})"
+
+
+class MessageArchive(Base):
+    __tablename__ = "message_archive"
+    __table_args__ = (
+        Index("ix_message_archive_chat_id_last_id", "chat_id", "last_id"),
+    )
+
+    # One block of consecutive messages of a chat, compressed together
+    id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
+    chat_id = Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"), nullable=False)
+    first_id = Column(Integer, nullable=False)
+    last_id = Column(Integer, nullable=False)
+    count = Column(Integer, nullable=False)
+    max_version = Column(Integer, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+
+    def __repr__(self):
+        return f"MessageArchive(chat_id={self.chat_id!r}, first_id={self.first_id!r}, last_id={self.last_id!r}, " \
+               f"count={self.count!r})"
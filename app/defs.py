@@ -21,6 +21,10 @@ class PublicUser(BaseModel):
     username: str
 
 
+class CurrentUser(PublicUser):
+    disabled: Optional[bool] = None
+
+
 class User(PublicUser):
     email: Optional[str] = None
     full_name: Optional[str] = None
@@ -31,12 +35,55 @@ class UserInDB(User):
     hashed_password: str
 
 
+class AttachmentInfo(BaseModel):
+    id: int
+    filename: str
+    content_type: str
+    size: int
+
+
 class Message(BaseModel):
     id: int
     content: str
     timestamp: str
     edited: bool = False
     author: PublicUser
+    attachments: List[AttachmentInfo] = []
+
+
+class BulkMessage(BaseModel):
+    content: str
+    # Nanoseconds like the server's own timestamps, defaults to the time of the upload
+    timestamp: Optional[int] = None
+
+
+class BulkResult(BaseModel):
+    index: int
+    id: Optional[int] = None
+    error: Optional[str] = None
+
+
+class MessagePage(BaseModel):
+    messages: List[Message]
+    next_cursor: Optional[int] = None
+
+
+class SearchResult(BaseModel):
+    chat_id: int
+    message: Message
+    # The HTML escaped content with every match wrapped in <mark></mark>
+    highlight: str
+
+
+class SearchPage(BaseModel):
+    results: List[SearchResult]
+    next_cursor: Optional[str] = None
+
+
+class ChatChanges(BaseModel):
+    version: int
+    messages: List[Message]
+    deleted: List[int]
 
 
 class Chat(BaseModel):
@@ -45,6 +92,39 @@ class Chat(BaseModel):
     members: List[PublicUser]
 
 
+class RetentionPolicy(BaseModel):
+    # Messages older than max_age seconds or beyond the newest max_count move to the archive, without either the
+    # server's default applies
+    max_age: Optional[pydantic.conint(ge=1)] = None
+    max_count: Optional[pydantic.conint(ge=1)] = None
+
+
+class PurgeStatus(BaseModel):
+    chat_id: int
+    # Nanoseconds
+    deleted_at: int
+    remaining_messages: int
+    # By the process that answered, purges of other processes show up in remaining_messages only
+    purged_messages: int
+
+
+class ChatSummary(BaseModel):
+    id: int
+    member_count: int
+    last_message: Optional[Message] = None
+    unread_count: int
+
+
+class ReadState(BaseModel):
+    last_read_message_id: Optional[int] = None
+    unread_count: int
+
+
+class ChatSummaryPage(BaseModel):
+    chats: List[ChatSummary]
+    next_cursor: Optional[int] = None
+
+
 class Invite(BaseModel):
     invite: str
 
@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from os import environ
+from typing import Dict, Optional, Set
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+EVENT_QUEUE_SIZE = int(environ.get("EVENT_QUEUE_SIZE", 100))
+# How events reach the subscribers: "memory" only within this process, "sqlite" through a change log in
+# EVENT_LOG_PATH that every process tails, e.g. the workers of `uvicorn --workers` or containers sharing a volume
+EVENT_BACKEND = environ.get("EVENT_BACKEND", "memory")
+EVENT_LOG_PATH = environ.get("EVENT_LOG_PATH", "events.db")
+# Seconds between two reads of the log while nothing is published, the delivery latency of other processes' events
+EVENT_POLL_INTERVAL = float(environ.get("EVENT_POLL_INTERVAL", 0.02))
+# Seconds events are kept in the log, a process that falls further behind misses the older ones
+EVENT_LOG_RETENTION = float(environ.get("EVENT_LOG_RETENTION", 60))
+EVENT_LOG_BUSY_TIMEOUT = float(environ.get("EVENT_LOG_BUSY_TIMEOUT", 5))
+
+
+class Subscriber:
+    def __init__(self, chat_id: int, username: str, queue_size: int):
+        self.chat_id = chat_id
+        self.username = username
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(queue_size)
+        self.overflowed = False
+
+    def deliver(self, event: dict):
+        # Runs on the subscriber's loop. A client that can't keep up is cut off instead of buffering without bound,
+        # the None sentinel tells its connection to close so it can resync.
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflow()
+
+    def overflow(self):
+        # Runs on the subscriber's loop, also when events were lost before reaching it
+        if self.overflowed:
+            return
+        self.overflowed = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+
+class ChatEventBroker:
+    def __init__(self, queue_size: int = EVENT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.subscribers: Dict[int, Set[Subscriber]] = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, chat_id: int, username: str):
+        subscriber = Subscriber(chat_id, username, self.queue_size)
+        with self.lock:
+            self.subscribers.setdefault(chat_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        with self.lock:
+            subscribers = self.subscribers.get(subscriber.chat_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.subscribers[subscriber.chat_id]
+
+    def publish(self, chat_id: int, event: dict):
+        # Safe to call from the threadpool that runs sync endpoints
+        self.deliver(chat_id, event)
+
+    def deliver(self, chat_id: int, event: dict):
+        with self.lock:
+            subscribers = list(self.subscribers.get(chat_id, ()))
+        for subscriber in subscribers:
+            subscriber.loop.call_soon_threadsafe(subscriber.deliver, event)
+
+    def overflow_all(self):
+        # Every subscriber may have missed events and has to resync
+        with self.lock:
+            subscribers = [subscriber for chat in self.subscribers.values() for subscriber in chat]
+        for subscriber in subscribers:
+            subscriber.loop.call_soon_threadsafe(subscriber.overflow)
+
+    def close(self):
+        pass
+
+
+class SQLiteEventBroker(ChatEventBroker):
+    # Every process appends its events to one log table and delivers what it reads back from it, its own events
+    # included. Row ids are handed out under SQLite's write lock and committed in that order, so every process reads
+    # the same events in the same order, and each row exactly once since only ids past the last one read are asked for.
+    def __init__(self, path: str = EVENT_LOG_PATH, queue_size: int = EVENT_QUEUE_SIZE,
+                 poll_interval: float = EVENT_POLL_INTERVAL, retention: float = EVENT_LOG_RETENTION):
+        super().__init__(queue_size)
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.pending: Optional[queue.Queue] = None
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        # Started lazily by the first subscriber or event. Where the log ends is read right away, whatever is
+        # published from then on gets delivered.
+        with self.lock:
+            if self.thread is not None:
+                return self.pending
+            connection = sqlite3.connect(self.path, timeout=EVENT_LOG_BUSY_TIMEOUT, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            # AUTOINCREMENT, so that ids aren't reused once the newest events are pruned
+            connection.execute("CREATE TABLE IF NOT EXISTS chat_events (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                               "chat_id INTEGER NOT NULL, payload BLOB NOT NULL, created_at REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS chat_events_created_at ON chat_events (created_at)")
+            connection.commit()
+            # The last id handed out, the newest events may have been pruned already
+            last_id = connection.execute(
+                "SELECT coalesce((SELECT seq FROM sqlite_sequence WHERE name = 'chat_events'), 0)"
+            ).fetchone()[0]
+            self.pending = queue.Queue()
+            self.thread = threading.Thread(target=self.run, args=(connection, self.pending, last_id),
+                                           name="chat-event-log", daemon=True)
+            self.thread.start()
+            return self.pending
+
+    def subscribe(self, chat_id: int, username: str):
+        self.start()
+        return super().subscribe(chat_id, username)
+
+    def publish(self, chat_id: int, event: dict):
+        self.start().put((chat_id, orjson.dumps(event)))
+
+    def run(self, connection: sqlite3.Connection, pending: queue.Queue, last_id: int):
+        unwritten = []
+        next_prune = time.monotonic()
+        try:
+            while True:
+                try:
+                    unwritten.append(pending.get(timeout=self.poll_interval))
+                    while True:
+                        unwritten.append(pending.get_nowait())
+                except queue.Empty:
+                    pass
+                stopping = None in unwritten
+                if stopping:
+                    unwritten.remove(None)
+                try:
+                    if unwritten:
+                        now = time.time()
+                        with connection:
+                            connection.executemany(
+                                "INSERT INTO chat_events (chat_id, payload, created_at) VALUES (?, ?, ?)",
+                                [(chat_id, payload, now) for chat_id, payload in unwritten]
+                            )
+                        unwritten = []
+                    for event_id, chat_id, payload in connection.execute(
+                        "SELECT id, chat_id, payload FROM chat_events WHERE id > ? ORDER BY id", (last_id,)
+                    ):
+                        if event_id > last_id + 1:
+                            # Ids are handed out without gaps, the events in between were pruned before they were
+                            # read here
+                            logger.warning("Chat events %d to %d were pruned before they were read", last_id + 1,
+                                           event_id - 1)
+                            self.overflow_all()
+                        last_id = event_id
+                        # Events of chats nobody here listens to aren't even parsed
+                        if chat_id in self.subscribers:
+                            self.deliver(chat_id, orjson.loads(payload))
+                    if time.monotonic() >= next_prune:
+                        with connection:
+                            connection.execute("DELETE FROM chat_events WHERE created_at < ?",
+                                               (time.time() - self.retention,))
+                        next_prune = time.monotonic() + self.retention / 2
+                except Exception:
+                    # Unwritten events are retried with the next round. Whatever went wrong, the thread keeps tailing
+                    # the log, the process would get no events anymore without it.
+                    logger.exception("Chat event log at %s failed", self.path)
+                if stopping:
+                    return
+        finally:
+            connection.close()
+
+    def close(self):
+        # Writes the events published so far, then stops tailing the log
+        with self.lock:
+            thread, pending = self.thread, self.pending
+            self.thread = self.pending = None
+        if thread is not None:
+            pending.put(None)
+            thread.join()
+
+
+EVENT_BACKENDS = {"memory": ChatEventBroker, "sqlite": SQLiteEventBroker}
+event_broker = EVENT_BACKENDS[EVENT_BACKEND]()
@@ -1,24 +1,80 @@
+import asyncio
 import random
 import re
 import string
 import time
+from hmac import compare_digest
+from collections import Counter
+from contextlib import asynccontextmanager
 from datetime import timedelta
+from typing import Optional, Union, List, Tuple
 
-from fastapi import Depends, FastAPI, HTTPException, status
+import orjson
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, Response, WebSocket, status
+from fastapi.responses import ORJSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from pydantic import ValidationError
+from sqlalchemy import select, exists, insert, delete, update, func, and_, bindparam
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi.middleware.cors import CORSMiddleware
 
 import db_defs
+from attachments import ATTACHMENT_MAX_SIZE, AttachmentResponse, AttachmentTooLarge, blob_path, store_upload
 from auth import get_password_hash, get_current_active_user, authenticate_user, ACCESS_TOKEN_EXPIRE_MINUTES, \
-    create_access_token
-from db import get_db, engine
-from defs import Token, PublicUser, Invite, StrList, MessageList, UserList, User, ChatList
+    create_access_token, get_current_user, hash_password, token_username, get_current_admin_user
+from db import add_missing_columns, get_db, engine, dispose_engines, create_shards, open_session, shard_groups, \
+    shard_indexes, shard_of, sharded
+from bulk import BULK_CHUNK_SIZE, BulkItemError, BulkUploadError, UploadStreamingResponse, iter_bulk_items
+from compression import decompress
+from events import event_broker, Subscriber
+from metrics import METRICS_ENABLED, METRICS_TOKEN, MetricsMiddleware, registry
+from profiling import PROFILING_ENABLED, ProfilingMiddleware
+from purge import PURGE_INTERVAL, delete_chat_rows, is_large_chat, mark_chat_deleted, purge_deleted_chats, \
+    purge_progress, purged_messages
+from retention import RETENTION_ENABLED, RETENTION_INTERVAL, archive_expired, find_archived, read_archive, \
+    read_archive_changes
+from tasks import PeriodicTask
+from search import (create_search_index, fts_match, highlight, highlight_html, match_query, messages_fts,
+                    search_available)
+from writer import BatchWriter, WRITE_BEHIND
+from defs import Token, PublicUser, Invite, StrList, UserList, User, ChatList, Message, MessagePage, ChatChanges, \
+    CurrentUser, ChatSummary, ChatSummaryPage, MessageList, BulkMessage, BulkResult, SearchPage, SearchResult, \
+    RetentionPolicy, PurgeStatus, ReadState, AttachmentInfo
+
+MESSAGE_PAGE_SIZE = 50
+MAX_MESSAGE_PAGE_SIZE = 200
+CHAT_PAGE_SIZE = 50
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+# Search pages through the best matches only, deeper pages would sort ever more rows in every shard
+MAX_SEARCH_RESULTS = 10 * MAX_SEARCH_PAGE_SIZE
+# Messages read and encoded at a time by the history export
+EXPORT_PAGE_SIZE = 1000
+# Everything needed to serialize a message, the author is represented by its username so users are never loaded
+MESSAGE_COLUMNS = (db_defs.Message.id, db_defs.Message.content, db_defs.Message.timestamp, db_defs.Message.edited,
+                   db_defs.Message.author_id, db_defs.Message.attachments)
+# A chat's version is counted in chat_versions once it is sharded, see db_defs.ChatVersion
+versioned_chats = db_defs.Chat.__table__.outerjoin(db_defs.ChatVersion.__table__,
+                                                   db_defs.ChatVersion.chat_id == db_defs.Chat.id)
+chat_version = func.coalesce(db_defs.ChatVersion.version, db_defs.Chat.version)
+MAX_CHAT_PAGE_SIZE = 200
 
 db_defs.Base.metadata.create_all(bind=engine)
+with engine.begin() as connection:
+    add_missing_columns(connection, db_defs.Base.metadata.sorted_tables)
+    create_search_index(connection)
+create_shards()
 
 app = FastAPI()
 
+if PROFILING_ENABLED:
+    # Inside the metrics middleware, so profiled requests report the statements it counts
+    app.add_middleware(ProfilingMiddleware, router=app.router, authorize=token_username)
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware, router=app.router)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:8080"],
@@ -32,34 +88,477 @@ def check_email(email):
     return re.match(r"[^@]+@[^@]+\.[^@]+", email)
 
 
-def get_chat(db: Session, chat_id: int):
-    return db.query(db_defs.Chat).filter_by(id=chat_id).scalar()
+async def get_chat(db: AsyncSession, chat_id: int):
+    return await db.get(db_defs.Chat, chat_id)
+
+
+async def user_exists(db: AsyncSession, username: str):
+    return await db.scalar(select(db_defs.User.username).filter_by(username=username)) is not None
+
+
+async def user_in_chat(db: AsyncSession, chat_id: int, username: str):
+    members = db_defs.chat_association_table.c
+    return bool(await db.scalar(select(exists().where(members.chat_id == chat_id, members.user_id == username))))
+
+
+def chat_member(detail: str):
+    # Dependency for endpoints under /chats/{chat_id} that only members may use
+    async def check_membership(chat_id: int, current_user: CurrentUser = Depends(get_current_active_user),
+                               db: AsyncSession = Depends(get_db)):
+        if not await user_in_chat(db, chat_id, current_user.username):
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=detail)
+        return current_user
+
+    return check_membership
+
+
+class NotModified(Exception):
+    def __init__(self, etag: str):
+        self.etag = etag
+
+
+def chat_etag(detail: str):
+    # Like chat_member, but answers with 304 when the client's copy of the chat is current. The chat's version covers
+    # messages, members and invites, so this costs one extra query and nothing else is loaded on a match.
+    async def check_etag(chat_id: int, request: Request, response: Response,
+                         current_user: CurrentUser = Depends(chat_member(detail)),
+                         db: AsyncSession = Depends(get_db)):
+        etag = f'"{chat_id}.{await db.scalar(get_chat_version(chat_id))}"'
+        if_none_match = {tag.strip() for tag in request.headers.get("if-none-match", "").split(",")}
+        if etag in if_none_match or f"W/{etag}" in if_none_match or "*" in if_none_match:
+            raise NotModified(etag)
+        response.headers["ETag"] = etag
+        return current_user
+
+    return check_etag
+
+
+@app.exception_handler(NotModified)
+async def not_modified(request: Request, exc: NotModified):
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": exc.etag})
+
+
+async def get_message(db: AsyncSession, chat_id: int, message_id: int):
+    return await db.scalar(
+        select(db_defs.Message).filter_by(chat_id=chat_id, id=message_id)
+    )
+
+
+async def get_message_page(db: AsyncSession, chat_id: int, before: Optional[int], after: Optional[int], limit: int):
+    # Walks forward from `after`, otherwise back from `before` (or the newest message). The returned cursor is the
+    # value to pass as the same parameter to get the next page. Pages reaching past the oldest stored message continue
+    # in the archive.
+    bounds = [db_defs.Message.chat_id == db_defs.Chat.id]
+    if before is not None:
+        bounds.append(db_defs.Message.id < before)
+    if after is not None:
+        bounds.append(db_defs.Message.id > after)
+    # The chat is joined to learn where its archive ends without another round-trip
+    order = db_defs.Message.id if after is not None else db_defs.Message.id.desc()
+    query = select(db_defs.Chat.archived_upto, *MESSAGE_COLUMNS).select_from(db_defs.Chat) \
+        .outerjoin(db_defs.Message, and_(*bounds)).filter(db_defs.Chat.id == chat_id).order_by(order).limit(limit + 1)
+    rows = (await db.execute(query)).all()
+    archived_upto = rows[0].archived_upto if rows else 0
+    messages = [row for row in rows if row.id is not None]
+    if after is not None:
+        if after < archived_upto:
+            # Archived ids are all lower than the stored ones
+            messages = await read_archive(db, chat_id, None, after, limit + 1) + messages
+        next_cursor = messages[limit - 1].id if len(messages) > limit else None
+        return messages[:limit], next_cursor
+    if archived_upto and len(messages) <= limit:
+        messages += await read_archive(db, chat_id, before, None, limit + 1 - len(messages))
+    next_cursor = messages[limit - 1].id if len(messages) > limit else None
+    return messages[:limit][::-1], next_cursor
+
+
+def get_chat_version(chat_id: int):
+    return select(chat_version).select_from(versioned_chats).filter(db_defs.Chat.id == chat_id)
+
+
+async def bump_chat_version(db: AsyncSession, chat_id: int, count: int = 1):
+    if sharded():
+        # In the chat's shard, so writing a message doesn't take the central write lock
+        await db.execute(
+            sqlite_insert(db_defs.ChatVersion)
+            .from_select(["chat_id", "version"],
+                         select(db_defs.Chat.id, db_defs.Chat.version + count).filter(db_defs.Chat.id == chat_id))
+            .on_conflict_do_update(index_elements=[db_defs.ChatVersion.chat_id],
+                                   set_={"version": db_defs.ChatVersion.version + count})
+        )
+    else:
+        await db.execute(
+            update(db_defs.Chat).filter_by(id=chat_id).values(version=db_defs.Chat.version + count)
+            .execution_options(synchronize_session=False)
+        )
+    return await db.scalar(get_chat_version(chat_id))
+
+
+async def read_state_table(db: AsyncSession, chat_ids):
+    # Where the read state of the chats' members is kept: chat_association, or with sharding read_states in the chats'
+    # shard. Members without a row there yet get theirs copied from chat_association first.
+    if not sharded():
+        return db_defs.chat_association_table
+    members = db_defs.chat_association_table.c
+    await db.execute(
+        sqlite_insert(db_defs.ReadState)
+        .from_select(["chat_id", "user_id", "last_read_message_id", "unread_count"],
+                     select(members.chat_id, members.user_id, members.last_read_message_id, members.unread_count)
+                     .filter(members.chat_id.in_(chat_ids)))
+        .on_conflict_do_nothing()
+    )
+    return db_defs.ReadState.__table__
+
+
+async def store_messages(db: AsyncSession, new_messages: List[Tuple[int, str, str, int, Optional[list]]]):
+    # Stores (chat_id, author_id, content, timestamp, attachments) tuples with one version bump per chat, the caller
+    # commits. Returns the stored message for every tuple, or a 404 for those of chats that are gone.
+    versions = {}
+    for chat_id, count in Counter(chat_id for chat_id, *_ in new_messages).items():
+        version = await bump_chat_version(db, chat_id, count)
+        if version is not None:
+            versions[chat_id] = version - count
+    results = []
+    for chat_id, author_id, content, timestamp, attachments in new_messages:
+        if chat_id not in versions:
+            results.append(HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat not found"))
+            continue
+        versions[chat_id] += 1
+        results.append(db_defs.Message(chat_id=chat_id, author_id=author_id, content=content, timestamp=timestamp,
+                                       attachments=attachments, version=versions[chat_id]))
+        db.add(results[-1])
+    messages = [message for message in results if isinstance(message, db_defs.Message)]
+    if not messages:
+        return results
+    await db.flush()
+    read_states = await read_state_table(db, list(versions))
+    members = read_states.c
+    await db.execute(
+        update(read_states).filter(members.chat_id == bindparam("b_chat_id"))
+        .values(unread_count=members.unread_count + bindparam("b_count")),
+        [{"b_chat_id": chat_id, "b_count": count}
+         for chat_id, count in Counter(message.chat_id for message in messages).items()]
+    )
+    # Everything up to your own message counts as read, which leaves an author the messages of others after it
+    last_read = {(message.chat_id, message.author_id): message.id for message in messages}
+    await db.execute(
+        update(read_states)
+        .filter(members.chat_id == bindparam("b_chat_id"), members.user_id == bindparam("b_user_id"))
+        .values(last_read_message_id=bindparam("b_message_id"), unread_count=bindparam("b_unread")),
+        [{"b_chat_id": chat_id, "b_user_id": user_id, "b_message_id": message_id,
+          "b_unread": sum(message.chat_id == chat_id and message.id > message_id and message.author_id != user_id
+                          for message in messages)}
+         for (chat_id, user_id), message_id in last_read.items()]
+    )
+    return results
+
+
+async def insert_message_rows(db: AsyncSession, chat_id: int, author_id: str, rows: List[BulkMessage]):
+    # One multi-row INSERT for the whole chunk, returns the new ids in order
+    version = await bump_chat_version(db, chat_id, len(rows)) - len(rows)
+    now = time.time_ns()
+    statement = insert(db_defs.Message).values([
+        {"chat_id": chat_id, "author_id": author_id, "content": row.content,
+         "timestamp": now if row.timestamp is None else row.timestamp, "version": version + i}
+        for i, row in enumerate(rows, 1)
+    ])
+    if db.get_bind().dialect.name == "sqlite":
+        # No RETURNING here, but the rows of a single statement get consecutive ids under the write lock
+        last_id = (await db.execute(statement)).lastrowid
+        ids = list(range(last_id - len(rows) + 1, last_id + 1))
+    else:
+        ids = (await db.scalars(statement.returning(db_defs.Message.id))).all()
+    read_states = await read_state_table(db, [chat_id])
+    members = read_states.c
+    await db.execute(update(read_states)
+                     .filter(members.chat_id == chat_id, members.user_id != author_id)
+                     .values(unread_count=members.unread_count + len(rows)))
+    await db.execute(update(read_states)
+                     .filter(members.chat_id == chat_id, members.user_id == author_id)
+                     .values(last_read_message_id=ids[-1], unread_count=0))
+    await db.commit()
+    for i, (message_id, row) in enumerate(zip(ids, rows), 1):
+        event_broker.publish(chat_id, {"type": "message_created", "version": version + i, "message": Message(
+            id=message_id, content=row.content, timestamp=now if row.timestamp is None else row.timestamp,
+            author=PublicUser(username=author_id)).dict()})
+    return ids
+
+
+async def import_messages(db: AsyncSession, chat_id: int, author_id: str, items):
+    # Yields one NDJSON result line per uploaded item, in upload order and at most BULK_CHUNK_SIZE items behind
+    pending: List[Tuple[int, Union[BulkMessage, str]]] = []
+    index = 0
+
+    async def flush():
+        rows = [item for _, item in pending if isinstance(item, BulkMessage)]
+        ids = iter(await insert_message_rows(db, chat_id, author_id, rows) if rows else ())
+        lines = "".join(
+            (BulkResult(index=i, id=next(ids)) if isinstance(item, BulkMessage) else BulkResult(index=i, error=item))
+            .json(exclude_none=True) + "\n"
+            for i, item in pending
+        )
+        pending.clear()
+        return lines
+
+    try:
+        async for item in items:
+            if isinstance(item, BulkItemError):
+                pending.append((index, str(item)))
+            else:
+                try:
+                    pending.append((index, BulkMessage.parse_obj(item)))
+                except ValidationError as e:
+                    pending.append((index, "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}"
+                                                     for error in e.errors())))
+            index += 1
+            if len(pending) >= BULK_CHUNK_SIZE:
+                yield await flush()
+    except BulkUploadError as e:
+        pending.append((index, str(e)))
+    yield await flush()
+
+
+@asynccontextmanager
+async def shard_session(db: AsyncSession, shard: Optional[int]):
+    # `db` itself without sharding, otherwise a session of its own on the shard
+    if shard is None:
+        yield db
+        return
+    shard_db = open_session(shard)
+    try:
+        yield shard_db
+    finally:
+        await shard_db.close()
+
+
+@asynccontextmanager
+async def background_session(shard: Optional[int] = None):
+    # For work outside of any request, on the central database or the given shard
+    db = open_session(shard)
+    try:
+        yield db
+    finally:
+        await db.close()
+
+
+def in_shard(shard: Optional[int]):
+    # Filters the chats down to those stored in `shard`, without sharding there is nothing to filter
+    return None if shard is None else lambda chat_id: shard_of(chat_id) == shard
+
+
+async def sender_errors(db: AsyncSession, new_messages):
+    # The messages were queued after their author's membership was checked, since then the chat may have been deleted
+    # or the author removed from it. Returns the error for each (chat_id, author_id) that can't send anymore.
+    chat_ids = {chat_id for chat_id, *_ in new_messages}
+    live_chats = set(await db.scalars(select(db_defs.Chat.id).filter(db_defs.Chat.id.in_(chat_ids),
+                                                                      db_defs.Chat.deleted_at.is_(None))))
+    members = db_defs.chat_association_table.c
+    memberships = set(await db.execute(select(members.chat_id, members.user_id).filter(
+        members.chat_id.in_(chat_ids), members.user_id.in_({author_id for _, author_id, *_ in new_messages})
+    )))
+    errors = {}
+    for chat_id, author_id, *_ in new_messages:
+        if chat_id not in live_chats:
+            errors[chat_id, author_id] = status.HTTP_404_NOT_FOUND, "Chat not found"
+        elif (chat_id, author_id) not in memberships:
+            errors[chat_id, author_id] = status.HTTP_403_FORBIDDEN, "Not allowed to send in chat"
+    return errors
+
+
+async def write_message_batch(new_messages):
+    # One transaction per shard. Yields (index, message) for the messages of each shard once it committed, and
+    # (index, error) for those that can't be sent anymore or whose shard failed to commit.
+    batches = {}
+    for i, (chat_id, *_) in enumerate(new_messages):
+        batches.setdefault(shard_of(chat_id), []).append(i)
+    for shard, indexes in batches.items():
+        results = {}
+        try:
+            async with background_session(shard) as db:
+                errors = await sender_errors(db, [new_messages[i] for i in indexes])
+                for i in indexes:
+                    if new_messages[i][:2] in errors:
+                        results[i] = HTTPException(*errors[new_messages[i][:2]])
+                writable = [i for i in indexes if i not in results]
+                if writable:
+                    results.update(zip(writable, await store_messages(db, [new_messages[i] for i in writable])))
+                    await db.commit()
+        except Exception as e:
+            results = dict.fromkeys(indexes, e)
+        for i in indexes:
+            yield i, results[i]
+
+
+message_writer = BatchWriter(write_message_batch)
+
+
+@registry.collector
+def collect_writer_metrics():
+    queue = message_writer.queue
+    return [("chatapp_write_queue_size", "Messages waiting for the writer", "gauge", queue.qsize() if queue else 0)]
+
+
+async def archive_chats():
+    archived = 0
+    for shard in shard_indexes():
+        async with background_session(shard) as db:
+            archived += await archive_expired(db, chat_filter=in_shard(shard))
+    return archived
+
+
+async def purge_chats():
+    purged = 0
+    for shard in shard_indexes():
+        async with background_session(shard) as db:
+            purged += await purge_deleted_chats(db, chat_filter=in_shard(shard))
+    return purged
+
 
+archiver = PeriodicTask(archive_chats, RETENTION_INTERVAL, "Retention pass")
+purger = PeriodicTask(purge_chats, PURGE_INTERVAL, "Purging deleted chats")
 
-def user_exists(db: Session, username: str):
-    return db.query(db_defs.User.username).filter_by(username=username).scalar() is not None
+if RETENTION_ENABLED:
+    app.add_event_handler("startup", archiver.start)
+app.add_event_handler("startup", purger.start)
+# Queued messages are written before the pools they need are closed
+app.add_event_handler("shutdown", archiver.close)
+app.add_event_handler("shutdown", purger.close)
+app.add_event_handler("shutdown", message_writer.close)
+app.add_event_handler("shutdown", event_broker.close)
+app.add_event_handler("shutdown", dispose_engines)
 
 
-def user_in_chat(chat: db_defs.Chat, username: str):
-    return chat is not None and len([user for user in chat.members if user.username == username])
+async def get_chat_summaries(db: AsyncSession, username: str, after: Optional[int], limit: int):
+    # A fixed number of aggregate queries per page, however many chats, members or messages there are
+    members = db_defs.chat_association_table.c
+    memberships = select(members.chat_id, members.unread_count).filter(members.user_id == username)
+    if after is not None:
+        memberships = memberships.filter(members.chat_id > after)
+    memberships = (await db.execute(memberships.order_by(members.chat_id).limit(limit + 1))).all()
+    next_cursor = memberships[limit - 1].chat_id if len(memberships) > limit else None
+    chat_ids = [membership.chat_id for membership in memberships[:limit]]
+    unread_counts = {membership.chat_id: membership.unread_count for membership in memberships[:limit]}
+    if not chat_ids:
+        return [], next_cursor
 
+    member_counts = dict((await db.execute(
+        select(members.chat_id, func.count()).filter(members.chat_id.in_(chat_ids)).group_by(members.chat_id)
+    )).all())
+    last_messages = {}
+    for shard, shard_chat_ids in shard_groups(chat_ids).items():
+        async with shard_session(db, shard) as shard_db:
+            last_messages.update((message.chat_id, message) for message in await shard_db.execute(
+                select(db_defs.Message.chat_id, *MESSAGE_COLUMNS).filter(db_defs.Message.id.in_(
+                    select(func.max(db_defs.Message.id)).filter(db_defs.Message.chat_id.in_(shard_chat_ids))
+                    .group_by(db_defs.Message.chat_id)
+                ))
+            ))
+            if shard is not None:
+                unread_counts.update((state.chat_id, state.unread_count) for state in await shard_db.execute(
+                    select(db_defs.ReadState.chat_id, db_defs.ReadState.unread_count)
+                    .filter(db_defs.ReadState.user_id == username, db_defs.ReadState.chat_id.in_(shard_chat_ids))
+                ))
+    return [ChatSummary(
+        id=chat_id,
+        member_count=member_counts.get(chat_id, 0),
+        last_message=message_from_row(last_messages[chat_id]) if chat_id in last_messages else None,
+        unread_count=unread_counts.get(chat_id, 0)
+    ) for chat_id in chat_ids], next_cursor
 
-def get_message(chat: db_defs.Chat, message_id: int):
-    return None if chat is None else [message for message in chat.messages if message.id == message_id][0]
+
+async def search_messages(db: AsyncSession, q: str, scope, cursor: Optional[str], limit: int,
+                          shards: List[Optional[int]] = (None,)):
+    # Best matches first by FTS5's bm25 rank, the cursor is the number of results on the previous pages. Ranks depend on
+    # the whole index (new messages change them all) so they can't be used as a cursor, an offset only repeats or skips
+    # results when matches are added or deleted between pages. Every shard in `shards` is searched and their best
+    # matches merged.
+    if not search_available(db.get_bind()):
+        raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED, detail="Search needs SQLite FTS5")
+    try:
+        offset = int(cursor) if cursor is not None else 0
+    except ValueError:
+        offset = -1
+    if not 0 <= offset < MAX_SEARCH_RESULTS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+    query = match_query(q)
+    if not query:
+        return SearchPage(results=[])
+    limit = min(limit, MAX_SEARCH_RESULTS - offset)
+    statement = (
+        select(messages_fts.c.rank, highlight(), db_defs.Message.chat_id, *MESSAGE_COLUMNS)
+        .select_from(messages_fts)
+        .join(db_defs.Message, db_defs.Message.id == messages_fts.c.rowid)
+        .filter(fts_match(query), scope)
+        .order_by(messages_fts.c.rank, db_defs.Message.id)
+        .limit(offset + limit + 1)
+    )
+    rows = []
+    for shard in shards:
+        async with shard_session(db, shard) as shard_db:
+            rows.extend((await shard_db.execute(statement)).all())
+    if len(shards) > 1:
+        rows = sorted(rows, key=lambda row: (row.rank, row.id))
+    rows = rows[offset:offset + limit + 1]
+    next_cursor = str(offset + limit) if len(rows) > limit and offset + limit < MAX_SEARCH_RESULTS else None
+    results = []
+    for row in rows[:limit]:
+        message = message_from_row(row)
+        results.append(SearchResult(chat_id=row.chat_id, message=message,
+                                    highlight=highlight_html(row.highlight, message.content)))
+    return SearchPage(results=results, next_cursor=next_cursor)
+
+
+def message_from_row(message):
+    # Serializes a message entity or a MESSAGE_COLUMNS row without loading its author
+    return Message(id=message.id, content=decompress(message.content), timestamp=message.timestamp,
+                   edited=message.edited, author=PublicUser(username=message.author_id),
+                   attachments=message.attachments or [])
+
+
+def message_dict(message):
+    # The Message schema as plain data, for rows straight from the database that need no validation
+    return {"id": message.id, "content": decompress(message.content), "timestamp": str(message.timestamp),
+            "edited": message.edited, "author": {"username": message.author_id},
+            "attachments": message.attachments or []}
+
+
+def fast_json(content, response: Response):
+    # Encodes trusted plain data with orjson, skipping the response model's validation and jsonable_encoder. FastAPI
+    # only copies headers that dependencies set on `response` to responses it builds itself, so carry them over here.
+    return ORJSONResponse(content, headers={k: v for k, v in response.headers.items() if k != "content-length"})
+
+
+async def export_messages(db: AsyncSession, chat_id: int, ndjson: bool):
+    # Walks the whole history in pages so that at most one page is held and encoded at a time
+    separator = b"\n" if ndjson else b","
+    after, first = 0, True
+    if not ndjson:
+        yield b"["
+    while after is not None:
+        messages, after = await get_message_page(db, chat_id, None, after, EXPORT_PAGE_SIZE)
+        if messages:
+            chunk = separator.join(orjson.dumps(message_dict(message)) for message in messages)
+            yield chunk + b"\n" if ndjson else chunk if first else b"," + chunk
+            first = False
+    if not ndjson:
+        yield b"]"
 
 
 def is_owner(message: db_defs.Message, username: str):
-    return False if message is None else message.author.username == username
+    return False if message is None else message.author_id == username
 
 
-def only_allow_message_owner_edits(chat: db_defs.Chat, message_id: int, username: string):
-    if chat is None or not user_in_chat(chat, username):
+async def only_allow_message_owner_edits(db: AsyncSession, chat_id: int, message_id: int, username: string):
+    if not await user_in_chat(db, chat_id, username):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not allowed to edit chat")
-    message = get_message(chat, message_id)
-    if message is None:
+    message = await get_message(db, chat_id, message_id)
+    archived = None if message is not None else await find_archived(db, chat_id, message_id)
+    if message is None and archived is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Message doesn't exist")
-    if not is_owner(message, username):
+    if not is_owner(message or archived, username):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only the sender is able to edit")
+    if archived is not None:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Archived messages can't be changed")
     return message
 
 
@@ -68,19 +567,47 @@ def generate_random_invite(length: int):
     return ''.join(random.SystemRandom().choice(charset) for _ in range(length))
 
 
-def add_user(db, username, password, full_name, email, disabled=False):
+async def forward_events(websocket: WebSocket, subscriber: Subscriber):
+    while True:
+        event = await subscriber.queue.get()
+        if event is None:
+            await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+            return
+        await websocket.send_json(event)
+        if event["type"] == "member_kicked" and event["username"] == subscriber.username:
+            await websocket.close()
+            return
+
+
+async def wait_for_disconnect(websocket: WebSocket):
+    while (await websocket.receive())["type"] != "websocket.disconnect":
+        pass
+
+
+def add_user(db, username, password, full_name, email, disabled=False, hashed_password=None):
     db.add(db_defs.User(
         username=username,
         full_name=full_name,
         email=email,
-        hashed_password=get_password_hash(password),
+        hashed_password=hashed_password or get_password_hash(password),
         disabled=disabled
     ))
 
 
+if METRICS_ENABLED:
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics(authorization: str = Header("")):
+        # Prometheus text exposition format
+        if not METRICS_TOKEN or not compare_digest(authorization.encode(), f"Bearer {METRICS_TOKEN}".encode()):
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid metrics token",
+                                headers={"WWW-Authenticate": "Bearer"})
+        return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.post("/token", response_model=Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = authenticate_user(db, form_data.username, form_data.password)
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(),
+                                 db: AsyncSession = Depends(get_db)):
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -95,159 +622,443 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
 
 
 @app.post("/users/register")
-async def register(username: str, password: str, full_name: str, email: str, db: Session = Depends(get_db)):
+async def register(username: str, password: str, full_name: str, email: str, db: AsyncSession = Depends(get_db)):
     if not check_email(email):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="email is invalid")
 
-    if user_exists(db, username):
+    if await user_exists(db, username):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="username already registered")
-    add_user(db, username, password, full_name, email)
-    db.commit()
+    add_user(db, username, password, full_name, email, hashed_password=await hash_password(password))
+    await db.commit()
 
 
 @app.get("/users/me/", response_model=User)
-async def read_users_me(current_user: db_defs.User = Depends(get_current_active_user)):
-    return User.from_orm(current_user)
+async def read_users_me(current_user: CurrentUser = Depends(get_current_active_user),
+                        db: AsyncSession = Depends(get_db)):
+    user = await db.get(db_defs.User, current_user.username)
+    if user is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="user not found")
+    return User.from_orm(user)
 
 
 @app.get("/users/{username}", response_model=User)
-async def get_user(username, current_user: db_defs.User = Depends(get_current_active_user),
-                   db: Session = Depends(get_db)):
-    user = db.query(db_defs.User).filter_by(username=username).scalar()
+async def get_user(username, current_user: CurrentUser = Depends(get_current_active_user),
+                   db: AsyncSession = Depends(get_db)):
+    user = await db.scalar(select(db_defs.User).filter_by(username=username))
     if user is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="user not found")
     return User.from_orm(user) if username == current_user.username else PublicUser.from_orm(user)
 
 
-@app.get("/invite/{invite}")
-def use_invite(invite, current_user: db_defs.User = Depends(get_current_active_user), db: Session = Depends(get_db)):
-    invite = db.query(db_defs.Invite).filter_by(id=invite).scalar()
-    if invite is None:
+async def get_invite_chat_id(db: AsyncSession, invite: str):
+    chat_id = await db.scalar(select(db_defs.Invite.chat_id).filter_by(id=invite))
+    if chat_id is None:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid invite")
-    if user_in_chat(invite.chat, current_user.username):
+    return chat_id
+
+
+@app.get("/invite/{invite}")
+async def use_invite(invite, current_user: CurrentUser = Depends(get_current_active_user),
+                     db: AsyncSession = Depends(get_db)):
+    chat_id = await get_invite_chat_id(db, invite)
+    try:
+        # Nothing read yet but the archive, which counts as read (see mark_read), every other message is unread
+        await db.execute(insert(db_defs.chat_association_table).values(
+            user_id=current_user.username, chat_id=chat_id,
+            last_read_message_id=select(func.nullif(db_defs.Chat.archived_upto, 0))
+            .filter(db_defs.Chat.id == chat_id).scalar_subquery(),
+            unread_count=select(func.count()).filter(db_defs.Message.chat_id == chat_id).scalar_subquery()
+        ))
+        if sharded():
+            await db.execute(delete(db_defs.ReadState).filter_by(chat_id=chat_id, user_id=current_user.username))
+        await bump_chat_version(db, chat_id)
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Joined already")
-    invite.chat.members.append(current_user)
-    db.commit()
 
 
 @app.delete("/invite/{invite}")
-def delete_invite(invite, current_user: db_defs.User = Depends(get_current_active_user), db: Session = Depends(get_db)):
-    invite = db.query(db_defs.Invite).filter_by(id=invite).scalar()
-    if invite is None:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid invite")
-    if not user_in_chat(invite.chat, current_user.username):
+async def delete_invite(invite, current_user: CurrentUser = Depends(get_current_active_user),
+                        db: AsyncSession = Depends(get_db)):
+    chat_id = await get_invite_chat_id(db, invite)
+    if not await user_in_chat(db, chat_id, current_user.username):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Non-member user can't delete invite")
-    db.delete(invite)
-    db.commit()
+    await db.execute(delete(db_defs.Invite).filter_by(id=invite))
+    await bump_chat_version(db, chat_id)
+    await db.commit()
 
 
 @app.post("/chats/{chat_id}/invite", response_model=Invite)
-def generate_invite(chat_id: int, current_user: db_defs.User = Depends(get_current_active_user),
-                    db: Session = Depends(get_db)):
-    chat = get_chat(db, chat_id)
-    if chat is None or not user_in_chat(chat, current_user.username):
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Non-member user can't create invites")
+async def generate_invite(chat_id: int,
+                          current_user: CurrentUser = Depends(chat_member("Non-member user can't create invites")),
+                          db: AsyncSession = Depends(get_db)):
     invite = generate_random_invite(10)
-    invites = db.query(db_defs.Invite)
-    while invites.filter_by(id=invite).scalar() is not None:
+    while await db.scalar(select(db_defs.Invite.id).filter_by(id=invite)) is not None:
         invite = generate_random_invite(10)
-    db.add(db_defs.Invite(id=invite, chat=chat))
-    db.commit()
+    db.add(db_defs.Invite(id=invite, chat_id=chat_id))
+    await bump_chat_version(db, chat_id)
+    await db.commit()
     return {
         "invite": invite
     }
 
 
 @app.get("/chats/{chat_id}/invites", response_model=StrList)
-def get_invites(chat_id: int, current_user: db_defs.User = Depends(get_current_active_user),
-                db: Session = Depends(get_db)):
-    chat = get_chat(db, chat_id)
-    if chat is None or not user_in_chat(chat, current_user.username):
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not allowed to view chat invites")
-    return StrList.from_orm([invite.id for invite in chat.invites])
-
-
-@app.get("/chats/{chat_id}/messages", response_model=MessageList)
-def get_messages(chat_id: int, current_user: db_defs.User = Depends(get_current_active_user),
-                 db: Session = Depends(get_db)):
-    chat = get_chat(db, chat_id)
-    if chat is None or not user_in_chat(chat, current_user.username):
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not allowed to view chat")
-    return MessageList.from_orm(chat.messages)
+async def get_invites(chat_id: int, response: Response,
+                      current_user: CurrentUser = Depends(chat_etag("Not allowed to view chat invites")),
+                      db: AsyncSession = Depends(get_db)):
+    return fast_json((await db.scalars(select(db_defs.Invite.id).filter_by(chat_id=chat_id))).all(), response)
+
+
+@app.get("/chats/{chat_id}/messages", response_model=MessagePage)
+async def get_messages(chat_id: int, response: Response, before: Optional[int] = None, after: Optional[int] = None,
+                       limit: int = Query(MESSAGE_PAGE_SIZE, ge=1, le=MAX_MESSAGE_PAGE_SIZE),
+                       current_user: CurrentUser = Depends(chat_etag("Not allowed to view chat")),
+                       db: AsyncSession = Depends(get_db)):
+    messages, next_cursor = await get_message_page(db, chat_id, before, after, limit)
+    return fast_json({"messages": [message_dict(message) for message in messages], "next_cursor": next_cursor},
+                     response)
+
+
+@app.get("/chats/{chat_id}/messages/export", response_model=MessageList)
+async def export_chat_messages(chat_id: int, export_format: str = Query("ndjson", alias="format", regex="^(nd)?json$"),
+                               current_user: CurrentUser = Depends(chat_member("Not allowed to view chat")),
+                               db: AsyncSession = Depends(get_db)):
+    # The full history, oldest first, streamed as a JSON array or one message per line
+    ndjson = export_format == "ndjson"
+    return StreamingResponse(export_messages(db, chat_id, ndjson),
+                             media_type="application/x-ndjson" if ndjson else "application/json")
 
 
 @app.post("/chats/{chat_id}/messages")
-def send_message(chat_id: int, msg: str, current_user: db_defs.User = Depends(get_current_active_user),
-                 db: Session = Depends(get_db)):
-    chat = get_chat(db, chat_id)
-    if chat is None or not user_in_chat(chat, current_user.username):
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not allowed to send in chat")
-    db.add(db_defs.Message(chat=chat, content=msg, author=current_user, timestamp=time.time_ns()))
-    db.commit()
+async def send_message(chat_id: int, msg: str, attachment: List[int] = Query([]),
+                       current_user: CurrentUser = Depends(chat_member("Not allowed to send in chat")),
+                       db: AsyncSession = Depends(get_db)):
+    attachments = await own_attachments(db, chat_id, current_user.username, attachment) if attachment else None
+    new_message = (chat_id, current_user.username, msg, time.time_ns(), attachments)
+    if WRITE_BEHIND:
+        # Hand the connection back first, the writer needs one from the same pool while requests wait on it
+        await db.close()
+        message = await message_writer.submit(new_message)
+    else:
+        (message,) = await store_messages(db, [new_message])
+        if isinstance(message, HTTPException):
+            raise message
+        await db.commit()
+    event_broker.publish(chat_id, {"type": "message_created", "version": message.version,
+                                   "message": message_dict(message)})
+
+
+async def own_attachments(db: AsyncSession, chat_id: int, username: str, attachment_ids: List[int]):
+    # The info a message keeps of the given attachments, in the given order. Only what the sender uploaded into this
+    # chat can be attached.
+    rows = {row.id: row for row in await db.execute(
+        select(db_defs.Attachment.id, db_defs.Attachment.filename, db_defs.Attachment.content_type,
+               db_defs.Attachment.size)
+        .filter(db_defs.Attachment.id.in_(attachment_ids), db_defs.Attachment.chat_id == chat_id,
+                db_defs.Attachment.uploader_id == username)
+    )}
+    missing = [attachment_id for attachment_id in attachment_ids if attachment_id not in rows]
+    if missing:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown attachment {missing[0]}")
+    return [AttachmentInfo.from_orm(rows[attachment_id]).dict() for attachment_id in attachment_ids]
+
+
+@app.post("/chats/{chat_id}/attachments", response_model=AttachmentInfo)
+async def upload_attachment(chat_id: int, request: Request, filename: str = Query(..., min_length=1, max_length=255),
+                            current_user: CurrentUser = Depends(chat_member("Not allowed to send in chat")),
+                            db: AsyncSession = Depends(get_db)):
+    # The raw request body is the file. It is streamed to disk, the id it gets can then be sent along with a message.
+    # Hand the connection back while the body arrives, uploads can take long
+    await db.close()
+    try:
+        digest, size = await store_upload(request.stream(), max_size=ATTACHMENT_MAX_SIZE)
+    except AttachmentTooLarge as e:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+    content_type = request.headers.get("content-type") or "application/octet-stream"
+    attachment = db_defs.Attachment(chat_id=chat_id, uploader_id=current_user.username, digest=digest, size=size,
+                                    filename=filename, content_type=content_type, created_at=time.time_ns())
+    db.add(attachment)
+    await db.commit()
+    return attachment
+
+
+@app.api_route("/chats/{chat_id}/attachments/{attachment_id}", methods=["GET", "HEAD"])
+async def download_attachment(chat_id: int, attachment_id: int, request: Request,
+                              current_user: CurrentUser = Depends(chat_member("Not allowed to read chat")),
+                              db: AsyncSession = Depends(get_db)):
+    # Supports single byte ranges, If-Range and If-None-Match, the ETag is the file's digest
+    attachment = (await db.execute(
+        select(db_defs.Attachment.digest, db_defs.Attachment.size, db_defs.Attachment.filename,
+               db_defs.Attachment.content_type)
+        .filter(db_defs.Attachment.id == attachment_id, db_defs.Attachment.chat_id == chat_id)
+    )).one_or_none()
+    if attachment is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Attachment not found")
+    return AttachmentResponse(blob_path(attachment.digest), attachment.size, attachment.digest,
+                              attachment.content_type, attachment.filename, request.headers, request.method)
+
+
+@app.post("/chats/{chat_id}/messages/bulk")
+async def send_messages_bulk(chat_id: int, request: Request,
+                             current_user: CurrentUser = Depends(chat_member("Not allowed to send in chat")),
+                             db: AsyncSession = Depends(get_db)):
+    # Takes a JSON array or, with an NDJSON content type, one message per line and streams back a result per item
+    ndjson = request.headers.get("content-type", "").split(";")[0].strip() in ("application/x-ndjson",
+                                                                              "application/jsonl")
+    return UploadStreamingResponse(
+        import_messages(db, chat_id, current_user.username, iter_bulk_items(request.stream(), ndjson)),
+        media_type="application/x-ndjson"
+    )
 
 
 @app.delete("/chats/{chat_id}/messages/{message_id}")
-def delete_message(chat_id: int, message_id: int, current_user: db_defs.User = Depends(get_current_active_user),
-                   db: Session = Depends(get_db)):
-    chat = get_chat(db, chat_id)
-    message = only_allow_message_owner_edits(chat, message_id, current_user.username)
-    db.delete(message)
-    db.commit()
+async def delete_message(chat_id: int, message_id: int,
+                         current_user: CurrentUser = Depends(get_current_active_user),
+                         db: AsyncSession = Depends(get_db)):
+    message = await only_allow_message_owner_edits(db, chat_id, message_id, current_user.username)
+    version = await bump_chat_version(db, chat_id)
+    await db.delete(message)
+    db.add(db_defs.Tombstone(chat_id=chat_id, message_id=message_id, version=version))
+    # Members who hadn't read the message yet counted it
+    read_states = await read_state_table(db, [chat_id])
+    members = read_states.c
+    await db.execute(update(read_states).filter(
+        members.chat_id == chat_id, members.user_id != message.author_id, members.unread_count > 0,
+        func.coalesce(members.last_read_message_id, 0) < message_id
+    ).values(unread_count=members.unread_count - 1))
+    await db.commit()
+    event_broker.publish(chat_id, {"type": "message_deleted", "version": version, "id": message_id})
 
 
 @app.post("/chats/{chat_id}/messages/{message_id}")
-def edit_message(chat_id: int, message_id: int, message: str,
-                 current_user: db_defs.User = Depends(get_current_active_user), db: Session = Depends(get_db)):
-    chat = get_chat(db, chat_id)
-    msg = only_allow_message_owner_edits(chat, message_id, current_user.username)
+async def edit_message(chat_id: int, message_id: int, message: str,
+                       current_user: CurrentUser = Depends(get_current_active_user),
+                       db: AsyncSession = Depends(get_db)):
+    msg = await only_allow_message_owner_edits(db, chat_id, message_id, current_user.username)
     msg.content = message
     msg.edited = True
-    db.commit()
+    msg.version = await bump_chat_version(db, chat_id)
+    await db.commit()
+    event_broker.publish(chat_id, {"type": "message_edited", "version": msg.version,
+                                   "message": message_dict(msg)})
+
+
+@app.post("/chats/{chat_id}/read", response_model=ReadState)
+async def mark_read(chat_id: int, message_id: Optional[int] = None,
+                    current_user: CurrentUser = Depends(chat_member("Not allowed to read chat")),
+                    db: AsyncSession = Depends(get_db)):
+    # Moves the read marker up to message_id, by default to the newest message. It never moves back, so a client that
+    # is behind can't mark messages unread again. Archived messages count as read, the archive only knows how many
+    # messages a block holds and not by whom, so the marker never stays behind archived_upto. Until a member marks
+    # the chat read again their count still includes what was archived since.
+    newest, archived_upto = (await db.execute(select(func.coalesce(
+        select(func.max(db_defs.Message.id)).filter(db_defs.Message.chat_id == chat_id).scalar_subquery(),
+        db_defs.Chat.archived_upto
+    ), db_defs.Chat.archived_upto).filter(db_defs.Chat.id == chat_id))).one()
+    message_id = newest if message_id is None else max(min(message_id, newest), archived_upto)
+    read_states = await read_state_table(db, [chat_id])
+    members = read_states.c
+    membership = and_(members.chat_id == chat_id, members.user_id == current_user.username)
+    await db.execute(update(read_states).filter(
+        membership, func.coalesce(members.last_read_message_id, 0) < message_id
+    ).values(last_read_message_id=message_id, unread_count=select(func.count()).filter(
+        db_defs.Message.chat_id == chat_id, db_defs.Message.id > message_id,
+        db_defs.Message.author_id != current_user.username
+    ).scalar_subquery()))
+    await db.commit()
+    state = (await db.execute(select(members.last_read_message_id, members.unread_count).filter(membership))).one()
+    return ReadState(last_read_message_id=state.last_read_message_id, unread_count=state.unread_count)
+
+
+@app.get("/chats/{chat_id}/search", response_model=SearchPage)
+async def search_chat(chat_id: int, q: str = Query(..., min_length=1), cursor: Optional[str] = None,
+                      limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=MAX_SEARCH_PAGE_SIZE),
+                      current_user: CurrentUser = Depends(chat_member("Not allowed to view chat")),
+                      db: AsyncSession = Depends(get_db)):
+    return await search_messages(db, q, db_defs.Message.chat_id == chat_id, cursor, limit)
+
+
+@app.get("/search", response_model=SearchPage)
+async def search(q: str = Query(..., min_length=1), cursor: Optional[str] = None,
+                 limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=MAX_SEARCH_PAGE_SIZE),
+                 current_user: CurrentUser = Depends(get_current_active_user), db: AsyncSession = Depends(get_db)):
+    members = db_defs.chat_association_table.c
+    scope = db_defs.Message.chat_id.in_(select(members.chat_id).filter(members.user_id == current_user.username))
+    return await search_messages(db, q, scope, cursor, limit, shard_indexes())
+
+
+@app.get("/chats/{chat_id}/changes", response_model=ChatChanges)
+async def get_changes(chat_id: int, response: Response, since: Optional[int] = Query(None, ge=0),
+                      current_user: CurrentUser = Depends(get_current_active_user),
+                      db: AsyncSession = Depends(get_db)):
+    version, archived_upto, deleted_at = (await db.execute(
+        select(chat_version, db_defs.Chat.archived_upto, db_defs.Chat.deleted_at).select_from(versioned_chats)
+        .filter(db_defs.Chat.id == chat_id)
+    )).first() or (None, 0, None)
+    if version is None or deleted_at is not None:
+        # Everybody else gets the same answer as for a chat that never existed
+        former_members = await db.scalar(
+            select(db_defs.Tombstone.members).filter_by(chat_id=chat_id, message_id=None)
+        )
+        if current_user.username in (former_members or ()):
+            raise HTTPException(status_code=status.HTTP_410_GONE, detail="Chat was deleted")
+    if version is None or deleted_at is not None or not await user_in_chat(db, chat_id, current_user.username):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not allowed to view chat")
+    # Without `since` the client has nothing yet, so it gets every message and no deletions
+    messages = select(*MESSAGE_COLUMNS).filter(db_defs.Message.chat_id == chat_id).order_by(db_defs.Message.id)
+    deleted = []
+    if since is not None:
+        messages = messages.filter(db_defs.Message.version > since)
+        deleted = await db.scalars(
+            select(db_defs.Tombstone.message_id)
+            .filter(db_defs.Tombstone.chat_id == chat_id, db_defs.Tombstone.version > since)
+            .order_by(db_defs.Tombstone.version)
+        )
+    messages = (await db.execute(messages)).all()
+    if archived_upto:
+        messages = await read_archive_changes(db, chat_id, since) + messages
+    return fast_json({"version": version, "messages": [message_dict(message) for message in messages],
+                      "deleted": list(deleted)}, response)
+
+
+@app.websocket("/chats/{chat_id}/ws")
+async def chat_events(websocket: WebSocket, chat_id: int, token: Optional[str] = None,
+                      db: AsyncSession = Depends(get_db)):
+    # Browsers can't set headers on websocket requests, so the token may also be passed as a query parameter
+    authorization = websocket.headers.get("Authorization", "")
+    if token is None and authorization.lower().startswith("bearer "):
+        token = authorization[len("bearer "):]
+    try:
+        current_user = await get_current_active_user(await get_current_user(token or "", db))
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    if not await user_in_chat(db, chat_id, current_user.username):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await db.close()
+
+    subscriber = event_broker.subscribe(chat_id, current_user.username)
+    await websocket.accept()
+    tasks = {asyncio.create_task(forward_events(websocket, subscriber)),
+             asyncio.create_task(wait_for_disconnect(websocket))}
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        event_broker.unsubscribe(subscriber)
 
 
 @app.get("/chats/{chat_id}/members", response_model=UserList)
-def get_members(chat_id: int, current_user: db_defs.User = Depends(get_current_active_user),
-                db: Session = Depends(get_db)):
-    chat = get_chat(db, chat_id)
-    if chat is None or not user_in_chat(chat, current_user.username):
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not a member")
-    return UserList.from_orm(chat.members)
+async def get_members(chat_id: int, response: Response,
+                      current_user: CurrentUser = Depends(chat_etag("Not a member")),
+                      db: AsyncSession = Depends(get_db)):
+    members = db_defs.chat_association_table.c
+    return fast_json([{"username": username} for username in await db.scalars(
+        select(members.user_id).filter(members.chat_id == chat_id)
+    )], response)
+
+
+@app.get("/chats/{chat_id}/retention", response_model=RetentionPolicy)
+async def get_retention(chat_id: int, current_user: CurrentUser = Depends(chat_member("Not a member")),
+                        db: AsyncSession = Depends(get_db)):
+    policy = (await db.execute(
+        select(db_defs.Chat.retention_max_age, db_defs.Chat.retention_max_count).filter_by(id=chat_id)
+    )).one()
+    return RetentionPolicy(max_age=policy.retention_max_age, max_count=policy.retention_max_count)
+
+
+@app.put("/chats/{chat_id}/retention", response_model=RetentionPolicy)
+async def set_retention(chat_id: int, policy: RetentionPolicy,
+                        current_user: CurrentUser = Depends(chat_member("Not allowed to edit chat")),
+                        db: AsyncSession = Depends(get_db)):
+    await db.execute(update(db_defs.Chat).filter_by(id=chat_id)
+                     .values(retention_max_age=policy.max_age, retention_max_count=policy.max_count)
+                     .execution_options(synchronize_session=False))
+    await db.commit()
+    return policy
 
 
 @app.delete("/chats/{chat_id}/members/{member_name}")
-def kick_member(chat_id: int, member_name: str, current_user: db_defs.User = Depends(get_current_active_user),
-                db: Session = Depends(get_db)):
-    chat = get_chat(db, chat_id)
-    if chat is None or not user_in_chat(chat, current_user.username):
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not allowed to edit chat")
-    if not user_in_chat(chat, member_name):
+async def kick_member(chat_id: int, member_name: str,
+                      current_user: CurrentUser = Depends(chat_member("Not allowed to edit chat")),
+                      db: AsyncSession = Depends(get_db)):
+    members = db_defs.chat_association_table.c
+    result = await db.execute(delete(db_defs.chat_association_table).filter(
+        members.chat_id == chat_id, members.user_id == member_name
+    ))
+    if result.rowcount == 0:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Member not found")
-    chat.members.pop(chat.members.index(db.query(db_defs.User).filter_by(username=member_name).scalar()))
-    db.commit()
+    if sharded():
+        await db.execute(delete(db_defs.ReadState).filter_by(chat_id=chat_id, user_id=member_name))
+    await bump_chat_version(db, chat_id)
+    await db.commit()
+    event_broker.publish(chat_id, {"type": "member_kicked", "username": member_name})
 
 
 @app.post("/chats/")
-def create_chat(current_user: db_defs.User = Depends(get_current_active_user),
-                db: Session = Depends(get_db)):
+async def create_chat(current_user: CurrentUser = Depends(get_current_active_user),
+                      db: AsyncSession = Depends(get_db)):
     chat = db_defs.Chat()
-    chat.members.append(current_user)
     db.add(chat)
-    db.commit()
+    await db.flush()
+    await db.execute(insert(db_defs.chat_association_table).values(user_id=current_user.username, chat_id=chat.id))
+    await db.commit()
     return {
         "id": chat.id
     }
 
 
-@app.get("/chats/", response_model=ChatList)
-def get_chats(current_user: db_defs.User = Depends(get_current_active_user)):
-    return current_user.chats
+@app.get("/chats/", response_model=Union[ChatSummaryPage, ChatList])
+async def get_chats(response: Response, full: bool = False, after: Optional[int] = None,
+                    limit: int = Query(CHAT_PAGE_SIZE, ge=1, le=MAX_CHAT_PAGE_SIZE),
+                    current_user: CurrentUser = Depends(get_current_active_user),
+                    db: AsyncSession = Depends(get_db)):
+    if not full:
+        chats, next_cursor = await get_chat_summaries(db, current_user.username, after, limit)
+        return ChatSummaryPage(chats=chats, next_cursor=next_cursor)
+    members = db_defs.chat_association_table.c
+    chats = {chat_id: {"id": chat_id, "messages": [], "members": []} for chat_id in await db.scalars(
+        select(members.chat_id).filter(members.user_id == current_user.username).order_by(members.chat_id)
+    )}
+    for shard, chat_ids in shard_groups(chats).items():
+        async with shard_session(db, shard) as shard_db:
+            for message in await shard_db.execute(select(db_defs.Message.chat_id, *MESSAGE_COLUMNS)
+                                                  .filter(db_defs.Message.chat_id.in_(chat_ids))
+                                                  .order_by(db_defs.Message.id)):
+                chats[message.chat_id]["messages"].append(message_dict(message))
+    for member in await db.execute(select(members.chat_id, members.user_id).filter(members.chat_id.in_(chats))):
+        chats[member.chat_id]["members"].append({"username": member.user_id})
+    return fast_json(list(chats.values()), response)
 
 
 @app.delete("/chats/{chat_id}")
-def delete_chat(chat_id: int, current_user: db_defs.User = Depends(get_current_active_user),
-                db: Session = Depends(get_db)):
-    chat = get_chat(db, chat_id)
-    if chat is None or not user_in_chat(chat, current_user.username):
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not allowed to edit chat")
-    db.delete(chat)
-    db.commit()
+async def delete_chat(chat_id: int, current_user: CurrentUser = Depends(chat_member("Not allowed to edit chat")),
+                      db: AsyncSession = Depends(get_db)):
+    version = await db.scalar(get_chat_version(chat_id))
+    members = db_defs.chat_association_table.c
+    db.add(db_defs.Tombstone(chat_id=chat_id, version=version + 1, members=list(
+        await db.scalars(select(members.user_id).filter(members.chat_id == chat_id).order_by(members.user_id))
+    )))
+    if await is_large_chat(db, chat_id):
+        # Deleting every message at once would hold the write lock for as long as it takes
+        await mark_chat_deleted(db, chat_id)
+        await db.commit()
+        purger.wake()
+    else:
+        await delete_chat_rows(db, chat_id)
+        await db.commit()
+
+
+@app.get("/admin/purges", response_model=List[PurgeStatus])
+async def get_purges(current_user: CurrentUser = Depends(get_current_admin_user), db: AsyncSession = Depends(get_db)):
+    progress = []
+    for shard in shard_indexes():
+        async with shard_session(db, shard) as shard_db:
+            progress.extend(await purge_progress(shard_db, chat_filter=in_shard(shard)))
+    return [PurgeStatus(chat_id=chat_id, deleted_at=deleted_at, remaining_messages=remaining,
+                        purged_messages=purged_messages.get(chat_id, 0))
+            for chat_id, deleted_at, remaining in sorted(progress, key=lambda row: row.deleted_at)]
@@ -0,0 +1,217 @@
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from os import environ
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+from starlette.routing import Match
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+METRICS_ENABLED = environ.get("METRICS_ENABLED", "").lower() in ("1", "true", "yes")
+# /metrics shows every route's traffic and error rates, only scrapers sending "Authorization: Bearer <METRICS_TOKEN>"
+# may read it. Without a token nobody can.
+METRICS_TOKEN = environ.get("METRICS_TOKEN", "")
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50, 100)
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class RequestStats:
+    # Filled in by whatever runs on behalf of one request, the threadpool and aiosqlite's greenlets included, since
+    # they all see the request's context
+    __slots__ = ("statements", "db_seconds", "bcrypt_seconds")
+
+    def __init__(self):
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.bcrypt_seconds = 0.0
+
+
+request_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+
+class Counter:
+    def __init__(self, name: str, description: str, kind: str = "counter"):
+        self.name = name
+        self.description = description
+        self.kind = kind
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, labels: Labels = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, labels, value
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.kind = "histogram"
+        self.buckets = buckets
+        # Per label set: a count for every bucket (the last one is +Inf), the sum and the total count
+        self.values: Dict[Labels, list] = {}
+
+    def observe(self, value: float, labels: Labels = ()):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def samples(self):
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                yield self.name + "_bucket", labels + (("le", str(bound)),), cumulative
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, count
+
+
+class Registry:
+    # Request metrics are only updated from the event loop, so they need no locking. Gauges that read state owned by
+    # other modules are collected when /metrics is scraped.
+    def __init__(self):
+        self.metrics: List = []
+        # Each returns (name, description, type, value) tuples
+        self.collectors: List[Callable[[], List[Tuple[str, str, str, float]]]] = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, fn):
+        self.collectors.append(fn)
+        return fn
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name}{format_labels(labels)} {value}" for name, labels, value in metric.samples())
+        for collect in self.collectors:
+            for name, description, kind, value in collect():
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels: Labels):
+    if not labels:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+registry = Registry()
+requests_total = registry.add(Counter("chatapp_http_requests_total", "Finished HTTP requests"))
+request_duration = registry.add(Histogram("chatapp_http_request_duration_seconds", "HTTP request latency"))
+requests_in_flight = registry.add(Counter("chatapp_http_requests_in_flight", "HTTP requests being served", "gauge"))
+request_statements = registry.add(Histogram("chatapp_db_statements_per_request", "SQL statements per HTTP request",
+                                            STATEMENT_BUCKETS))
+db_statements = registry.add(Counter("chatapp_db_statements_total", "SQL statements executed"))
+db_seconds = registry.add(Counter("chatapp_db_seconds_total", "Time spent executing SQL statements"))
+bcrypt_duration = registry.add(Histogram("chatapp_bcrypt_seconds", "Time spent hashing or verifying one password"))
+bcrypt_seconds = registry.add(Counter("chatapp_bcrypt_seconds_total", "Time spent in bcrypt"))
+
+# Statements of the message writer, startup and other work outside of a request
+background_stats = RequestStats()
+background_lock = threading.Lock()
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    stats = request_stats.get()
+    if stats is None:
+        with background_lock:
+            background_stats.statements += 1
+            background_stats.db_seconds += elapsed
+        return
+    stats.statements += 1
+    stats.db_seconds += elapsed
+
+
+def instrument_engine(sync_engine):
+    event.listen(sync_engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", after_cursor_execute)
+
+
+def observe_bcrypt(elapsed: float):
+    bcrypt_duration.observe(elapsed)
+    stats = request_stats.get()
+    if stats is not None:
+        stats.bcrypt_seconds += elapsed
+
+
+def route_template(router, scope: Scope):
+    # The path with placeholders, so that /chats/1/messages and /chats/2/messages share their metrics
+    partial = None
+    for route in router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and partial is None:
+            partial = route.path
+    return partial or "<unmatched>"
+
+
+class MetricsMiddleware:
+    def __init__(self, app: ASGIApp, router):
+        self.app = app
+        self.router = router
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        route = route_template(self.router, scope)
+        labels = (("method", scope["method"]), ("route", route))
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        requests_in_flight.inc(labels)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            request_stats.reset(token)
+            requests_in_flight.inc(labels, -1)
+            requests_total.inc(labels + (("status", str(status_code)),))
+            request_duration.observe(elapsed, labels)
+            request_statements.observe(stats.statements, labels)
+            route_labels = (("route", route),)
+            db_statements.inc(route_labels, stats.statements)
+            db_seconds.inc(route_labels, stats.db_seconds)
+            bcrypt_seconds.inc(route_labels, stats.bcrypt_seconds)
+
+
+@registry.collector
+def collect_background():
+    with background_lock:
+        return [
+            ("chatapp_db_background_statements_total", "SQL statements executed outside of requests", "counter",
+             background_stats.statements),
+            ("chatapp_db_background_seconds_total", "Time spent in SQL statements outside of requests", "counter",
+             background_stats.db_seconds),
+        ]
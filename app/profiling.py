@@ -0,0 +1,207 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import re
+import threading
+import time
+from contextvars import ContextVar
+from os import environ
+from typing import Callable, Optional
+
+from starlette.concurrency import run_in_threadpool as starlette_run_in_threadpool
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from metrics import RequestStats, request_stats, route_template
+
+# PROFILING_ENABLED=1 installs the middleware, a request is only profiled when it carries the PROFILE_HEADER and a
+# token of one of the PROFILE_USERS. "X-Profile: inline" answers with the report instead of the response, any other
+# value stores the profile in PROFILE_DIR.
+PROFILING_ENABLED = environ.get("PROFILING_ENABLED", "").lower() in ("1", "true", "yes")
+PROFILE_USERS = {username for username in environ.get("PROFILE_USERS", "").split(",") if username}
+PROFILE_DIR = environ.get("PROFILE_DIR", "profiles")
+PROFILE_HEADER = environ.get("PROFILE_HEADER", "X-Profile").lower().encode()
+# Functions listed in inline reports and the order they are listed in
+PROFILE_TOP = int(environ.get("PROFILE_TOP", 40))
+PROFILE_SORT = environ.get("PROFILE_SORT", "cumulative")
+
+
+class RequestProfile:
+    # cProfile only sees the thread it was enabled on, so every threadpool call of the request gets a profile of its
+    # own and they are merged in the end
+    def __init__(self):
+        self.profiles = [cProfile.Profile()]
+        self.lock = threading.Lock()
+
+    def run_in_thread(self, fn, *args, **kwargs):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ profiles all threads from the one that enabled it and refuses a second profiler
+            return fn(*args, **kwargs)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profile.disable()
+            with self.lock:
+                self.profiles.append(profile)
+
+    def stats(self, stream=None):
+        stats = pstats.Stats(self.profiles[0], stream=stream)
+        for profile in self.profiles[1:]:
+            stats.add(profile)
+        return stats
+
+
+class ProfiledSteps:
+    # Awaits the coroutine with the profile enabled only while one of its steps runs. In between the event loop runs
+    # other requests, which a profile left enabled would count as this one's. Tasks the coroutine starts aren't
+    # profiled.
+    def __init__(self, coroutine, profile: cProfile.Profile):
+        self.coroutine = coroutine
+        self.profile = profile
+
+    def step(self, fn, value):
+        try:
+            self.profile.enable()
+        except ValueError:
+            # Python 3.12+ while a threadpool call of the request is being profiled
+            return fn(value)
+        try:
+            return fn(value)
+        finally:
+            self.profile.disable()
+
+    def __await__(self):
+        fn, value = self.coroutine.send, None
+        while True:
+            try:
+                yielded = self.step(fn, value)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                fn, value = self.coroutine.send, (yield yielded)
+            except GeneratorExit:
+                self.coroutine.close()
+                raise
+            except BaseException as e:
+                fn, value = self.coroutine.throw, e
+
+
+active_profile: ContextVar[Optional[RequestProfile]] = ContextVar("active_profile", default=None)
+# The profiler hooks the whole interpreter thread, two profiled requests at once would unhook each other
+profiling_lock = threading.Lock()
+
+
+async def run_in_threadpool(fn, *args, **kwargs):
+    # starlette's run_in_threadpool, the call is profiled when it runs on behalf of a profiled request
+    profile = active_profile.get()
+    if profile is not None:
+        return await starlette_run_in_threadpool(profile.run_in_thread, fn, *args, **kwargs)
+    return await starlette_run_in_threadpool(fn, *args, **kwargs)
+
+
+def profile_name(info: dict):
+    route = re.sub(r"[^A-Za-z0-9]+", "_", info["route"]).strip("_") or "root"
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{info['user']}-{info['method']}-{route}-{time.time_ns() % 10 ** 9}"
+
+
+def write_profile(directory: str, name: str, profile: RequestProfile, info: dict):
+    # <name>.prof loads into pstats, snakeviz and friends, <name>.json holds what the profile was taken of
+    os.makedirs(directory, exist_ok=True)
+    profile.stats().dump_stats(os.path.join(directory, name + ".prof"))
+    with open(os.path.join(directory, name + ".json"), "w") as f:
+        json.dump(info, f, indent=2)
+
+
+def render_profile(profile: RequestProfile, info: dict):
+    stream = io.StringIO()
+    for key, value in info.items():
+        stream.write(f"{key}: {value}\n")
+    stream.write("\n")
+    profile.stats(stream).sort_stats(PROFILE_SORT).print_stats(PROFILE_TOP)
+    return stream.getvalue().encode()
+
+
+class ProfilingMiddleware:
+    def __init__(self, app: ASGIApp, router, authorize: Callable[[str], Optional[str]], users=None,
+                 directory: str = PROFILE_DIR):
+        self.app = app
+        self.router = router
+        # Maps a bearer token to its username, or None if the token isn't valid
+        self.authorize = authorize
+        self.users = PROFILE_USERS if users is None else users
+        self.directory = directory
+
+    def requested_mode(self, scope: Scope):
+        # (mode, username) if the request asks to be profiled and may be, otherwise None
+        mode = authorization = None
+        for key, value in scope["headers"]:
+            if key == PROFILE_HEADER:
+                mode = value.decode("latin-1").strip().lower()
+            elif key == b"authorization":
+                authorization = value.decode("latin-1")
+        if not mode or not authorization or not authorization.lower().startswith("bearer "):
+            return None
+        username = self.authorize(authorization[len("bearer "):].strip())
+        if username is None or username not in self.users:
+            return None
+        return mode, username
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        requested = self.requested_mode(scope) if scope["type"] == "http" else None
+        if requested is None or not profiling_lock.acquire(blocking=False):
+            await self.app(scope, receive, send)
+            return
+        mode, username = requested
+        inline = mode == "inline"
+        info = {"method": scope["method"], "path": scope["path"], "route": route_template(self.router, scope),
+                "user": username}
+        status_code = 500
+        name = None
+
+        async def send_profiled(message):
+            nonlocal status_code, name
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if inline:
+                    return
+                # The profile is written once the response is complete, its name is sent ahead
+                name = profile_name(info)
+                message = {**message, "headers": list(message.get("headers", [])) + [
+                    (b"x-profile-name", name.encode())
+                ]}
+            elif inline:
+                return
+            await send(message)
+
+        profile = RequestProfile()
+        stats = request_stats.get()
+        stats_token = None
+        if stats is None:
+            # The metrics middleware isn't counting for this request, the report needs the statements anyway
+            stats = RequestStats()
+            stats_token = request_stats.set(stats)
+        profile_token = active_profile.set(profile)
+        start = time.perf_counter()
+        try:
+            await ProfiledSteps(self.app(scope, receive, send_profiled), profile.profiles[0])
+        finally:
+            elapsed = time.perf_counter() - start
+            active_profile.reset(profile_token)
+            if stats_token is not None:
+                request_stats.reset(stats_token)
+            profiling_lock.release()
+        info.update(status=status_code, seconds=round(elapsed, 6), statements=stats.statements,
+                    db_seconds=round(stats.db_seconds, 6), bcrypt_seconds=round(stats.bcrypt_seconds, 6),
+                    threadpool_calls=len(profile.profiles) - 1)
+        if inline:
+            body = render_profile(profile, info)
+            await send({"type": "http.response.start", "status": 200, "headers": [
+                (b"content-type", b"text/plain; charset=utf-8"), (b"content-length", str(len(body)).encode()),
+            ]})
+            await send({"type": "http.response.body", "body": body})
+        else:
+            await starlette_run_in_threadpool(write_profile, self.directory, name or profile_name(info), profile, info)
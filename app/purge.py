@@ -0,0 +1,101 @@
+import asyncio
+import time
+from os import environ
+from typing import Callable, Dict, Optional
+
+from sqlalchemy import delete, func, select, update
+
+import db_defs
+from db import sharded
+
+# Chats with more messages than this are deleted in the background, smaller ones within the request
+PURGE_THRESHOLD = int(environ.get("PURGE_THRESHOLD", 5000))
+# Messages deleted per transaction while purging
+PURGE_BATCH_SIZE = int(environ.get("PURGE_BATCH_SIZE", 1000))
+# Pause between two batches, so that requests get the write lock in between
+PURGE_BATCH_PAUSE = float(environ.get("PURGE_BATCH_PAUSE", 0.01))
+# Seconds between looking for purges left unfinished, e.g. by a restart. Deleting a chat starts its purge right away.
+PURGE_INTERVAL = float(environ.get("PURGE_INTERVAL", 300))
+
+# Messages purged by this process per chat, for the admin view
+purged_messages: Dict[int, int] = {}
+
+
+async def is_large_chat(db, chat_id: int):
+    return await db.scalar(select(db_defs.Message.id).filter(db_defs.Message.chat_id == chat_id)
+                           .offset(PURGE_THRESHOLD).limit(1)) is not None
+
+
+async def delete_chat_rows(db, chat_id: int):
+    # Bulk statements instead of the ORM cascade, which loads every message and invite to delete them one by one.
+    # ON DELETE CASCADE removes the same rows, the statements cover SQLite connections without foreign keys turned on.
+    # Returns the number of deleted messages.
+    members = db_defs.chat_association_table.c
+    messages = await db.execute(delete(db_defs.Message).filter(db_defs.Message.chat_id == chat_id)
+                                .execution_options(synchronize_session=False))
+    for statement in (
+        delete(db_defs.MessageArchive).filter(db_defs.MessageArchive.chat_id == chat_id),
+        delete(db_defs.Invite).filter(db_defs.Invite.chat_id == chat_id),
+        delete(db_defs.Attachment).filter(db_defs.Attachment.chat_id == chat_id),
+        delete(db_defs.chat_association_table).where(members.chat_id == chat_id),
+        delete(db_defs.Chat).filter(db_defs.Chat.id == chat_id),
+    ):
+        await db.execute(statement.execution_options(synchronize_session=False))
+    if sharded():
+        for table in (db_defs.ChatVersion, db_defs.ReadState):
+            await db.execute(delete(table).filter(table.chat_id == chat_id).execution_options(synchronize_session=False))
+    return messages.rowcount
+
+
+async def mark_chat_deleted(db, chat_id: int):
+    # Cuts every way into the chat now: without members nobody can read or write it and without invites nobody can
+    # join again. The messages are left to purge_deleted_chats.
+    members = db_defs.chat_association_table.c
+    await db.execute(update(db_defs.Chat).filter_by(id=chat_id).values(deleted_at=time.time_ns())
+                     .execution_options(synchronize_session=False))
+    await db.execute(delete(db_defs.Invite).filter(db_defs.Invite.chat_id == chat_id)
+                     .execution_options(synchronize_session=False))
+    await db.execute(delete(db_defs.chat_association_table).where(members.chat_id == chat_id))
+
+
+async def purge_batch(db, chat_id: int):
+    # Deletes the next PURGE_BATCH_SIZE messages of a deleted chat, the last batch takes the chat with it. Returns
+    # (deleted messages, whether the chat is gone).
+    upto = await db.scalar(select(db_defs.Message.id).filter(db_defs.Message.chat_id == chat_id)
+                           .order_by(db_defs.Message.id).offset(PURGE_BATCH_SIZE - 1).limit(1))
+    if upto is None:
+        count = await delete_chat_rows(db, chat_id)
+        await db.commit()
+        return count, True
+    deleted = await db.execute(delete(db_defs.Message)
+                               .filter(db_defs.Message.chat_id == chat_id, db_defs.Message.id <= upto)
+                               .execution_options(synchronize_session=False))
+    await db.commit()
+    return deleted.rowcount, False
+
+
+async def purge_deleted_chats(db, pause: float = PURGE_BATCH_PAUSE,
+                              chat_filter: Optional[Callable[[int], bool]] = None):
+    # Purges every chat marked deleted (that passes `chat_filter`), returns the number of purged messages
+    purged = 0
+    for chat_id in (await db.scalars(select(db_defs.Chat.id).filter(db_defs.Chat.deleted_at.isnot(None)))).all():
+        if chat_filter is not None and not chat_filter(chat_id):
+            continue
+        done = False
+        while not done:
+            count, done = await purge_batch(db, chat_id)
+            purged += count
+            purged_messages[chat_id] = purged_messages.get(chat_id, 0) + count
+            await asyncio.sleep(pause)
+        purged_messages.pop(chat_id, None)
+    await db.rollback()
+    return purged
+
+
+async def purge_progress(db, chat_filter: Optional[Callable[[int], bool]] = None):
+    # (chat_id, deleted_at, messages left) of every chat still being purged
+    return [row for row in (await db.execute(
+        select(db_defs.Chat.id, db_defs.Chat.deleted_at, func.count(db_defs.Message.id))
+        .outerjoin(db_defs.Message, db_defs.Message.chat_id == db_defs.Chat.id)
+        .filter(db_defs.Chat.deleted_at.isnot(None)).group_by(db_defs.Chat.id).order_by(db_defs.Chat.deleted_at)
+    )).all() if chat_filter is None or chat_filter(row.id)]
@@ -0,0 +1,188 @@
+import asyncio
+import sys
+import time
+import zlib
+from collections import namedtuple
+from os import environ
+from typing import Callable, Optional
+
+import orjson
+from sqlalchemy import delete, func, or_, select, text, update
+
+import db_defs
+from compression import decompress
+
+# Off by default. Archived messages stay in the history, the export and /changes, but they leave the search index
+# and can't be edited or deleted anymore (409 Conflict).
+RETENTION_ENABLED = environ.get("RETENTION_ENABLED", "").lower() in ("1", "true", "yes")
+# Seconds between two retention passes
+RETENTION_INTERVAL = float(environ.get("RETENTION_INTERVAL", 300))
+# Policy of chats that have none of their own, by default everything is kept
+RETENTION_MAX_AGE = int(environ["RETENTION_MAX_AGE"]) if environ.get("RETENTION_MAX_AGE") else None  # seconds
+RETENTION_MAX_COUNT = int(environ["RETENTION_MAX_COUNT"]) if environ.get("RETENTION_MAX_COUNT") else None
+# Messages per archive block. Only full blocks are archived, each in a transaction of its own.
+ARCHIVE_BATCH_SIZE = int(environ.get("ARCHIVE_BATCH_SIZE", 500))
+# Pause between two blocks, so that requests get the write lock in between
+ARCHIVE_BATCH_PAUSE = float(environ.get("ARCHIVE_BATCH_PAUSE", 0.01))
+ARCHIVE_COMPRESSION_LEVEL = int(environ.get("ARCHIVE_COMPRESSION_LEVEL", 6))
+
+ARCHIVE_COLUMNS = (db_defs.Message.id, db_defs.Message.content, db_defs.Message.timestamp, db_defs.Message.edited,
+                   db_defs.Message.author_id, db_defs.Message.version, db_defs.Message.attachments)
+# Has the attributes of a message row, so archived messages serialize like stored ones. Blocks archived before messages
+# had attachments have one value less.
+ArchivedMessage = namedtuple("ArchivedMessage", "id content timestamp edited author_id version attachments",
+                             defaults=(None,))
+
+
+def pack(messages):
+    # The block is compressed as a whole, so the contents go in as text
+    return zlib.compress(orjson.dumps([(message.id, decompress(message.content), *tuple(message)[2:])
+                                       for message in messages]), ARCHIVE_COMPRESSION_LEVEL)
+
+
+def unpack(data: bytes):
+    return [ArchivedMessage(*values) for values in orjson.loads(zlib.decompress(data))]
+
+
+async def read_archive(db, chat_id: int, before: Optional[int], after: Optional[int], limit: int):
+    # Up to `limit` archived messages walking forward from `after` in ascending order, otherwise back from `before`
+    # in descending order
+    messages = []
+    blocks_per_query = limit // ARCHIVE_BATCH_SIZE + 1
+    bound = before if after is None else after
+    while len(messages) < limit:
+        query = select(db_defs.MessageArchive.first_id, db_defs.MessageArchive.last_id, db_defs.MessageArchive.data) \
+            .filter(db_defs.MessageArchive.chat_id == chat_id)
+        if after is not None:
+            query = query.filter(db_defs.MessageArchive.last_id > bound).order_by(db_defs.MessageArchive.last_id)
+        else:
+            if bound is not None:
+                query = query.filter(db_defs.MessageArchive.first_id < bound)
+            query = query.order_by(db_defs.MessageArchive.last_id.desc())
+        blocks = (await db.execute(query.limit(blocks_per_query))).all()
+        for block in blocks:
+            if after is not None:
+                messages.extend(message for message in unpack(block.data) if message.id > after)
+            else:
+                messages.extend(message for message in reversed(unpack(block.data))
+                                if before is None or message.id < before)
+        if len(blocks) < blocks_per_query:
+            break
+        bound = blocks[-1].last_id if after is not None else blocks[-1].first_id
+    return messages[:limit]
+
+
+async def read_archive_changes(db, chat_id: int, since: Optional[int]):
+    # Archived messages changed after version `since` (all of them without it) in ascending order
+    query = select(db_defs.MessageArchive.data).filter(db_defs.MessageArchive.chat_id == chat_id)
+    if since is not None:
+        query = query.filter(db_defs.MessageArchive.max_version > since)
+    messages = []
+    for data in await db.scalars(query.order_by(db_defs.MessageArchive.last_id)):
+        messages.extend(message for message in unpack(data) if since is None or message.version > since)
+    return messages
+
+
+async def find_archived(db, chat_id: int, message_id: int):
+    # The archived message with the id, None if no block holds it
+    data = await db.scalar(select(db_defs.MessageArchive.data).filter(
+        db_defs.MessageArchive.chat_id == chat_id, db_defs.MessageArchive.first_id <= message_id,
+        db_defs.MessageArchive.last_id >= message_id
+    ))
+    if data is None:
+        return None
+    return next((message for message in unpack(data) if message.id == message_id), None)
+
+
+async def archive_cutoff(db, chat_id: int, max_age: Optional[int], max_count: Optional[int]):
+    # The highest message id the policy lets go of, the newest message always stays
+    upto = None
+    if max_count is not None:
+        upto = await db.scalar(select(db_defs.Message.id).filter(db_defs.Message.chat_id == chat_id)
+                               .order_by(db_defs.Message.id.desc()).offset(max_count).limit(1))
+    if max_age is not None:
+        expired = await db.scalar(select(func.max(db_defs.Message.id)).filter(
+            db_defs.Message.chat_id == chat_id, db_defs.Message.timestamp < time.time_ns() - max_age * 10 ** 9
+        ))
+        if expired is not None:
+            newest = await db.scalar(select(func.max(db_defs.Message.id)).filter(db_defs.Message.chat_id == chat_id))
+            upto = max(upto or 0, min(expired, newest - 1)) or None
+    return upto
+
+
+async def archive_batch(db, chat_id: int, upto: int):
+    # Moves the oldest ARCHIVE_BATCH_SIZE messages up to `upto` into one block, returns how many were moved. The write
+    # lock is taken before they are read: no edit or deletion gets in between, and the transaction can't fail on
+    # taking it after another one committed (SQLITE_BUSY_SNAPSHOT, which the busy timeout doesn't wait out).
+    await db.execute(text("BEGIN IMMEDIATE"))
+    messages = (await db.execute(
+        select(*ARCHIVE_COLUMNS).filter(db_defs.Message.chat_id == chat_id, db_defs.Message.id <= upto)
+        .order_by(db_defs.Message.id).limit(ARCHIVE_BATCH_SIZE)
+    )).all()
+    if len(messages) < ARCHIVE_BATCH_SIZE:
+        await db.rollback()
+        return 0
+    first_id, last_id = messages[0].id, messages[-1].id
+    max_version = max(message.version for message in messages)
+    await db.execute(
+        delete(db_defs.Message)
+        .filter(db_defs.Message.chat_id == chat_id, db_defs.Message.id.between(first_id, last_id))
+        .execution_options(synchronize_session=False)
+    )
+    db.add(db_defs.MessageArchive(chat_id=chat_id, first_id=first_id, last_id=last_id, count=len(messages),
+                                  max_version=max_version, data=pack(messages)))
+    await db.execute(update(db_defs.Chat).filter_by(id=chat_id).values(archived_upto=last_id)
+                     .execution_options(synchronize_session=False))
+    await db.commit()
+    return len(messages)
+
+
+async def archive_expired(db, pause: float = ARCHIVE_BATCH_PAUSE,
+                          chat_filter: Optional[Callable[[int], bool]] = None):
+    # One retention pass over every chat with a policy (that passes `chat_filter`), returns the number of archived
+    # messages
+    query = select(db_defs.Chat.id, db_defs.Chat.retention_max_age, db_defs.Chat.retention_max_count) \
+        .filter(db_defs.Chat.deleted_at.is_(None))
+    if RETENTION_MAX_AGE is None and RETENTION_MAX_COUNT is None:
+        query = query.filter(or_(db_defs.Chat.retention_max_age.isnot(None),
+                                 db_defs.Chat.retention_max_count.isnot(None)))
+    archived = 0
+    for chat in (await db.execute(query)).all():
+        if chat_filter is not None and not chat_filter(chat.id):
+            continue
+        if chat.retention_max_age is None and chat.retention_max_count is None:
+            max_age, max_count = RETENTION_MAX_AGE, RETENTION_MAX_COUNT
+        else:
+            max_age, max_count = chat.retention_max_age, chat.retention_max_count
+        upto = await archive_cutoff(db, chat.id, max_age, max_count)
+        while upto is not None:
+            count = await archive_batch(db, chat.id, upto)
+            if not count:
+                break
+            archived += count
+            await asyncio.sleep(pause)
+    await db.rollback()
+    return archived
+
+
+if __name__ == "__main__":
+    # python retention.py run: a single retention pass, e.g. from cron instead of RETENTION_ENABLED on the servers
+    from db import create_shards, engine, open_session, shard_indexes, shard_of
+    if sys.argv[1:] != ["run"]:
+        sys.exit("usage: python retention.py run")
+    db_defs.Base.metadata.create_all(bind=engine)
+    create_shards()
+
+    async def run_once():
+        archived = 0
+        for shard in shard_indexes():
+            db = open_session(shard)
+            try:
+                archived += await archive_expired(
+                    db, chat_filter=None if shard is None else lambda chat_id: shard_of(chat_id) == shard
+                )
+            finally:
+                await db.close()
+        print(f"archived {archived} messages")
+
+    asyncio.run(run_once())
@@ -0,0 +1,114 @@
+import sys
+from html import escape
+
+from sqlalchemy import Column, Integer, MetaData, Table, Text, event, literal_column, text
+
+import db_defs
+
+# External content FTS5 index over the text of messages.content, the triggers keep it in sync with every insert, edit
+# and delete no matter which code path writes the messages. Contents may be stored compressed, so the index reads them
+# through the messages_text view and the triggers through message_text(). Every connection that writes messages needs
+# that function: SQLAlchemy's connections get it when they connect, plain sqlite3 ones come from compression.connect.
+messages_fts = Table(
+    "messages_fts", MetaData(),
+    Column("rowid", Integer, primary_key=True),
+    Column("content", Text),
+    Column("rank"),
+)
+SEARCH_INDEX_DDL = [
+    "CREATE VIEW IF NOT EXISTS messages_text AS SELECT id, message_text(content) AS content FROM messages",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(content, content='messages_text', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN "
+    "INSERT INTO messages_fts (rowid, content) VALUES (new.id, message_text(new.content)); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN "
+    "INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, message_text(old.content)); END",
+    # Compressing a stored message leaves its text, and so the index, as it is
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages "
+    "WHEN message_text(old.content) IS NOT message_text(new.content) BEGIN "
+    "INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, message_text(old.content)); "
+    "INSERT INTO messages_fts (rowid, content) VALUES (new.id, message_text(new.content)); END",
+]
+# Triggers of the index from before compression, which indexed messages.content as stored
+OLD_SEARCH_INDEX = ["messages_fts_insert", "messages_fts_delete", "messages_fts_update"]
+# FTS5 wraps matches in these control characters, which become <mark></mark> once the rest is HTML escaped
+HIGHLIGHT_START = "\x02"
+HIGHLIGHT_END = "\x03"
+
+fts_match = literal_column("messages_fts").op("MATCH")
+
+
+def search_available(connection):
+    return connection.dialect.name == "sqlite"
+
+
+def create_search_index(connection):
+    # Also adds the index to databases created before it existed, filled from the messages already stored, and
+    # rebuilds indexes from before compression
+    if not search_available(connection):
+        return
+    definition = connection.execute(text("SELECT sql FROM sqlite_master WHERE name = 'messages_fts'")).scalar()
+    if definition is not None and "messages_text" not in definition:
+        for trigger in OLD_SEARCH_INDEX:
+            connection.execute(text(f"DROP TRIGGER IF EXISTS {trigger}"))
+        connection.execute(text("DROP TABLE messages_fts"))
+        definition = None
+    for statement in SEARCH_INDEX_DDL:
+        connection.execute(text(statement))
+    if definition is None:
+        rebuild_search_index(connection)
+
+
+def rebuild_search_index(connection):
+    connection.execute(text("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')"))
+
+
+def match_query(q: str):
+    # Every word has to appear, user input is quoted so it can't use (or break on) the FTS5 query syntax
+    return " ".join('"' + word.replace('"', '""') + '"' for word in q.split())
+
+
+def highlight():
+    return literal_column(
+        f"highlight(messages_fts, 0, char({ord(HIGHLIGHT_START)}), char({ord(HIGHLIGHT_END)}))"
+    ).label("highlight")
+
+
+def highlight_html(highlighted: str, content: str):
+    # Message contents are user input, so they are escaped before the matches are marked up. The markers can't be told
+    # apart from the same characters in a content, such a content is returned without marks.
+    if HIGHLIGHT_START in content or HIGHLIGHT_END in content:
+        return escape(content)
+    return escape(highlighted).replace(HIGHLIGHT_START, "<mark>").replace(HIGHLIGHT_END, "</mark>")
+
+
+@event.listens_for(db_defs.Message.__table__, "after_create")
+def create_search_index_with_table(target, connection, **kwargs):
+    create_search_index(connection)
+
+
+if __name__ == "__main__":
+    # python search.py rebuild: reindexes every message in every shard, e.g. after an index was dropped or restored
+    # from a backup
+    import asyncio
+
+    from db import create_shards, engine, open_session, shard_indexes
+    if sys.argv[1:] != ["rebuild"]:
+        sys.exit("usage: python search.py rebuild")
+    db_defs.Base.metadata.create_all(bind=engine)
+    create_shards()
+
+    def rebuild(session):
+        create_search_index(session.connection())
+        rebuild_search_index(session.connection())
+
+    async def run_once():
+        for shard in shard_indexes():
+            db = open_session(shard)
+            try:
+                await db.run_sync(rebuild)
+                await db.commit()
+            finally:
+                await db.close()
+            print(f"{'central database' if shard is None else f'shard {shard}'}: search index rebuilt")
+
+    asyncio.run(run_once())
@@ -0,0 +1,169 @@
+import os
+import sys
+from collections import Counter
+from itertools import count
+from os import environ
+
+from sqlalchemy.engine import make_url
+
+import compression
+from db import DB_SHARD_URL, DB_SHARDS, DB_URL, SHARD_TABLES, create_shard_tables, shard_for
+
+# Messages, tombstones and archive blocks copied per transaction when a chat moves
+MOVE_BATCH_SIZE = int(environ.get("MOVE_BATCH_SIZE", 5000))
+BATCHED_TABLES = ("messages", "tombstones", "message_archive")
+
+
+def shard_path(shard_url: str, shard: int):
+    return os.path.abspath(make_url(shard_url.format(shard)).database)
+
+
+def database_paths(central: str, shard_url: str, shards: int):
+    # The central database first, then every shard file there is, including those beyond `shards` left behind when
+    # the shard count was lowered
+    paths = [central]
+    for i in count():
+        path = shard_path(shard_url, i)
+        if i >= shards and not os.path.exists(path):
+            return paths
+        paths.append(path)
+
+
+def connect(path: str):
+    # With message_text(), the search index triggers fire on the moved messages
+    connection = compression.connect(path, timeout=30, isolation_level=None)
+    connection.execute("PRAGMA journal_mode = WAL")
+    return connection
+
+
+def existing_tables(connection):
+    # Databases from before sharding have no chat_versions table, nor from before read_states
+    return {name for name, in connection.execute("SELECT name FROM main.sqlite_master WHERE type = 'table'")}
+
+
+def stored_chats(connection):
+    # (chat_id, messages) of every chat with rows in the database's shard tables
+    tables = [table.name for table in SHARD_TABLES
+              if table.name != "messages" and table.name in existing_tables(connection)]
+    return connection.execute(
+        "SELECT chat_id, sum(messages) FROM (SELECT chat_id, count(*) AS messages FROM messages GROUP BY chat_id "
+        + "".join(f"UNION ALL SELECT DISTINCT chat_id, 0 FROM {table} " for table in tables)
+        + ") GROUP BY chat_id ORDER BY chat_id"
+    ).fetchall()
+
+
+def copy_rows(connection, table, chat_id: int):
+    # From main into target, in batches of MOVE_BATCH_SIZE rows for the tables that grow with the chat. Rows already
+    # copied by an interrupted run are skipped.
+    columns = ", ".join(column.name for column in table.columns)
+    if table.name not in BATCHED_TABLES:
+        connection.execute("BEGIN IMMEDIATE")
+        connection.execute(f"INSERT OR IGNORE INTO target.{table.name} ({columns}) "
+                           f"SELECT {columns} FROM main.{table.name} WHERE chat_id = ?", (chat_id,))
+        connection.execute(f"DELETE FROM main.{table.name} WHERE chat_id = ?", (chat_id,))
+        connection.execute("COMMIT")
+        return
+    while True:
+        connection.execute("BEGIN IMMEDIATE")
+        upto = connection.execute(f"SELECT max(id) FROM (SELECT id FROM main.{table.name} WHERE chat_id = ? "
+                                  f"ORDER BY id LIMIT ?)", (chat_id, MOVE_BATCH_SIZE)).fetchone()[0]
+        if upto is None:
+            connection.execute("COMMIT")
+            return
+        connection.execute(f"INSERT OR IGNORE INTO target.{table.name} ({columns}) "
+                           f"SELECT {columns} FROM main.{table.name} WHERE chat_id = ? AND id <= ?", (chat_id, upto))
+        connection.execute(f"DELETE FROM main.{table.name} WHERE chat_id = ? AND id <= ?", (chat_id, upto))
+        connection.execute("COMMIT")
+
+
+def fold_chat_version(connection, chat_id: int):
+    # Back in the central database the chat's version is counted in chats.version again
+    connection.execute("BEGIN IMMEDIATE")
+    connection.execute("UPDATE target.chats SET version = (SELECT version FROM main.chat_versions WHERE chat_id = ?) "
+                       "WHERE id = ? AND EXISTS (SELECT 1 FROM main.chat_versions WHERE chat_id = ?)",
+                       (chat_id, chat_id, chat_id))
+    connection.execute("DELETE FROM main.chat_versions WHERE chat_id = ?", (chat_id,))
+    connection.execute("COMMIT")
+
+
+def fold_read_states(connection, chat_id: int):
+    # And the members' read state in chat_association
+    connection.execute("BEGIN IMMEDIATE")
+    connection.execute("UPDATE target.chat_association SET (last_read_message_id, unread_count) = "
+                       "(SELECT last_read_message_id, unread_count FROM main.read_states AS state "
+                       "WHERE state.chat_id = chat_association.chat_id AND state.user_id = chat_association.user_id) "
+                       "WHERE chat_id = ? AND EXISTS (SELECT 1 FROM main.read_states AS state "
+                       "WHERE state.chat_id = chat_association.chat_id AND state.user_id = chat_association.user_id)",
+                       (chat_id,))
+    connection.execute("DELETE FROM main.read_states WHERE chat_id = ?", (chat_id,))
+    connection.execute("COMMIT")
+
+
+def move_chat(source: str, target: str, chat_id: int, central: str):
+    # Message ids move along unchanged, the target's id sequence continues above them. Moving into a lower shard, as
+    # when the shard count is lowered, lets that shard hand out ids from the range of the higher one, so a removed
+    # shard's file must not be brought back.
+    connection = connect(source)
+    try:
+        connection.execute("ATTACH DATABASE ? AS target", (target,))
+        tables = existing_tables(connection)
+        for table in SHARD_TABLES:
+            if table.name not in tables:
+                continue
+            if table.name == "chat_versions" and target == central:
+                fold_chat_version(connection, chat_id)
+            elif table.name == "read_states" and target == central:
+                fold_read_states(connection, chat_id)
+            else:
+                copy_rows(connection, table, chat_id)
+    finally:
+        connection.close()
+
+
+def plan(central: str, shard_url: str, shards: int):
+    # (source, target, chat_id, messages) for every chat stored somewhere else than where `shards` shards put it
+    moves = []
+    for path in database_paths(central, shard_url, shards):
+        if not os.path.exists(path):
+            continue
+        connection = connect(path)
+        try:
+            for chat_id, messages in stored_chats(connection):
+                target = shard_path(shard_url, shard_for(chat_id, shards)) if shards else central
+                if target != path:
+                    moves.append((path, target, chat_id, messages))
+        finally:
+            connection.close()
+    return moves
+
+
+def rebalance(central: str, shard_url: str, shards: int, verbose: bool = False):
+    # Moves every chat to where `shards` shards put it, returns how many chats moved
+    for i in range(shards):
+        create_shard_tables(shard_url.format(i), i)
+    moves = plan(central, shard_url, shards)
+    for source, target, chat_id, messages in moves:
+        move_chat(source, target, chat_id, central)
+        if verbose:
+            print(f"chat {chat_id}: {messages} messages moved from {source} to {target}")
+    return len(moves)
+
+
+if __name__ == "__main__":
+    # Moves every chat to where DB_SHARDS puts it, with the servers stopped:
+    #   DB_SHARDS=4 python shards.py rebalance   moves an unsharded database into 4 shards, or 2 shards into 4
+    #   DB_SHARDS=0 python shards.py rebalance   moves everything back into the DB_URL database
+    #   python shards.py plan                    only lists how many chats and messages would move where
+    if sys.argv[1:] not in (["plan"], ["rebalance"]):
+        sys.exit("usage: python shards.py plan|rebalance")
+    central_path = os.path.abspath(DB_URL.database)
+    if sys.argv[1] == "plan":
+        chats, messages = Counter(), Counter()
+        for source, target, _, moved in plan(central_path, DB_SHARD_URL, DB_SHARDS):
+            chats[source, target] += 1
+            messages[source, target] += moved
+        for source, target in sorted(chats):
+            print(f"{source} -> {target}: {chats[source, target]} chats, {messages[source, target]} messages")
+        print(f"{sum(chats.values())} chats to move")
+    else:
+        print(f"{rebalance(central_path, DB_SHARD_URL, DB_SHARDS, verbose=True)} chats moved")
@@ -0,0 +1,44 @@
+import asyncio
+import logging
+from contextlib import suppress
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicTask:
+    # Runs `fn` every `interval` seconds and right away whenever it is woken up. A failed run is logged and the next
+    # one starts over.
+    def __init__(self, fn: Callable[[], Awaitable], interval: float, name: str):
+        self.fn = fn
+        self.interval = interval
+        self.name = name
+        self.task: Optional[asyncio.Task] = None
+        self.wakeup: Optional[asyncio.Event] = None
+
+    async def start(self):
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def wake(self):
+        # Does nothing before start(), e.g. in tests that run the function themselves
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            try:
+                await self.fn()
+            except Exception:
+                logger.exception("%s failed", self.name)
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+
+    async def close(self):
+        # Cancels a run in progress, the transaction it was in is rolled back
+        if self.task is not None:
+            self.task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self.task
+        self.task = self.wakeup = None
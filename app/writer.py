@@ -0,0 +1,88 @@
+import asyncio
+import contextvars
+from os import environ
+from typing import AsyncIterator, Callable, List, Optional
+
+from fastapi import HTTPException
+from starlette import status
+
+# WRITE_BEHIND=1 sends messages through a single writer task that commits them in batches
+WRITE_BEHIND = environ.get("WRITE_BEHIND", "").lower() in ("1", "true", "yes")
+WRITE_BATCH_SIZE = int(environ.get("WRITE_BATCH_SIZE", 100))
+# How long the writer waits for more messages after the first one of a batch arrived
+WRITE_BATCH_DELAY = float(environ.get("WRITE_BATCH_DELAY", 0.005))
+WRITE_QUEUE_SIZE = int(environ.get("WRITE_QUEUE_SIZE", 1000))
+
+
+class BatchWriter:
+    # write_batch yields (index, result) for the items of a batch as they are written, where a result can be the
+    # exception to fail that item with
+    def __init__(self, write_batch: Callable[[list], AsyncIterator[tuple]], batch_size: int = WRITE_BATCH_SIZE,
+                 batch_delay: float = WRITE_BATCH_DELAY, queue_size: int = WRITE_QUEUE_SIZE):
+        self.write_batch = write_batch
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.queue_size = queue_size
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def submit(self, item):
+        # Resolves with write_batch's result for the item once it is committed
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            # Started lazily on the serving loop, a new loop (as in tests) gets its own writer
+            self.loop = loop
+            self.queue = asyncio.Queue(self.queue_size)
+            # The writer outlives the request that starts it, so it must not run in (and be accounted to) its context
+            self.task = contextvars.Context().run(loop.create_task, self.run(self.queue))
+        future = loop.create_future()
+        try:
+            self.queue.put_nowait((item, future))
+        except asyncio.QueueFull:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many messages waiting to be written",
+                headers={"Retry-After": "1"},
+            )
+        return await future
+
+    async def run(self, queue: asyncio.Queue):
+        while True:
+            batch = [await queue.get()]
+            if batch[0] is None:
+                return
+            deadline = self.loop.time() + self.batch_delay
+            while len(batch) < self.batch_size:
+                timeout = deadline - self.loop.time()
+                try:
+                    entry = queue.get_nowait() if timeout <= 0 else await asyncio.wait_for(queue.get(), timeout)
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+                if entry is None:
+                    queue.put_nowait(None)
+                    break
+                batch.append(entry)
+            await self.flush(batch)
+
+    async def flush(self, batch: List[tuple]):
+        try:
+            async for i, result in self.write_batch([item for item, _ in batch]):
+                future = batch[i][1]
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    async def close(self):
+        # Writes everything already queued, then stops the writer
+        if self.task is not None and self.loop is asyncio.get_running_loop():
+            await self.queue.put(None)
+            await self.task
+        self.loop = self.queue = self.task = None
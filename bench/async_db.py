@@ -0,0 +1,88 @@
+"""Concurrent-request throughput of the sync and async session modes.
+
+Every mode runs in its own process (the mode is picked when `db` is imported) against a fresh database in a temporary
+directory, and drives the ASGI app in-process with concurrent clients:
+
+    AUTHKEY=secret python bench/async_db.py --requests 2000 --concurrency 50
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "app")
+MODES = {"sync": "0", "async": "1"}
+
+
+def percentile(samples, fraction):
+    return sorted(samples)[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+async def drive(app, requests, concurrency, headers, chat_id):
+    import httpx
+    latencies = []
+    counter = iter(range(requests))
+
+    async def client(http):
+        for i in counter:
+            start = time.perf_counter()
+            if i % 2:
+                response = await http.get("/users/me/", headers=headers)
+            else:
+                response = await http.get(f"/chats/{chat_id}/messages", headers=headers)
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as http:
+        start = time.perf_counter()
+        await asyncio.gather(*(client(http) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    # ASGITransport doesn't run lifespan events, close the pools the shutdown handler would
+    await app.router.shutdown()
+    return elapsed, latencies
+
+
+def run(mode, requests, concurrency, history):
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, APP_DIR)
+    import db
+    import db_defs
+    import main
+
+    with db.SessionLocal() as session:
+        main.add_user(session, "bench", "secret", "Bench User", "bench@bench.bench")
+        session.flush()
+        chat = db_defs.Chat(members=[session.get(db_defs.User, "bench")])
+        chat.messages = [db_defs.Message(content=f"seed {i}", author_id="bench", timestamp=i) for i in range(history)]
+        session.add(chat)
+        session.commit()
+        chat_id = chat.id
+    headers = {"Authorization": f"Bearer {main.create_access_token({'sub': 'bench'})}"}
+
+    elapsed, latencies = asyncio.run(drive(main.app, requests, concurrency, headers, chat_id))
+    print(f"{mode:>5}: {requests / elapsed:8.1f} req/s  p50 {percentile(latencies, .5) * 1000:7.2f} ms  "
+          f"p95 {percentile(latencies, .95) * 1000:7.2f} ms  p99 {percentile(latencies, .99) * 1000:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--history", type=int, default=200, help="messages seeded into the benchmark chat")
+    parser.add_argument("--mode", choices=MODES, help="run a single mode in this process")
+    args = parser.parse_args()
+
+    if args.mode:
+        run(args.mode, args.requests, args.concurrency, args.history)
+        return
+    for mode, flag in MODES.items():
+        subprocess.run([sys.executable, __file__, "--mode", mode, "--requests", str(args.requests),
+                        "--concurrency", str(args.concurrency), "--history", str(args.history)],
+                       env={**os.environ, "DB_ASYNC": flag}, check=True)
+
+
+if __name__ == "__main__":
+    main()
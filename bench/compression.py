@@ -0,0 +1,164 @@
+"""Storage and CPU cost of compressing long message contents, per codec.
+
+For every codec, seeds a fresh database in a temporary directory with --messages messages of a chat-like mix: mostly
+short lines, some pasted logs and code blocks of a few KiB. They are stored as text first, like before compression,
+then `compress_stored` (what `python compression.py compress` runs) rewrites them:
+
+    AUTHKEY=secret python bench/compression.py --codecs zlib zstd --messages 20000
+
+Reports the database file size after VACUUM and the bytes of message contents before and after, how long the
+rewrite took, the compression and decompression time per long message, and how long reading and serializing every
+message takes with text and with compressed contents. zstd needs the zstandard package and is skipped without it.
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "app")
+WORDS = ("the deploy is done can you check it again later tomorrow looks good to me thanks I think we should wait "
+         "for the review before merging this one").split()
+LEVELS = ("INFO", "INFO", "INFO", "DEBUG", "WARNING", "ERROR")
+PATHS = ("/api/chats", "/api/messages", "/api/users/me", "/api/invites", "/healthz")
+
+
+def chat_line(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 30)))
+
+
+def log_paste(rng):
+    lines = []
+    for _ in range(rng.randint(30, 120)):
+        lines.append(f"2024-03-{rng.randint(1, 28):02d}T{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:"
+                     f"{rng.randint(0, 59):02d}.{rng.randint(0, 999999):06d} {rng.choice(LEVELS):7} "
+                     f"worker-{rng.randint(1, 8)} {rng.choice(('GET', 'POST'))} {rng.choice(PATHS)}/"
+                     f"{rng.randint(1, 99999)} {rng.choice((200, 200, 201, 404, 500))} {rng.randint(1, 900)}ms "
+                     f"request_id={rng.getrandbits(64):016x}")
+    return "\n".join(lines)
+
+
+def code_block(rng):
+    functions = []
+    for i in range(rng.randint(5, 20)):
+        name = f"{rng.choice(WORDS)}_{rng.choice(WORDS)}_{i}"
+        functions.append(f"def {name}(session, chat_id: int, limit: int = {rng.randint(10, 500)}):\n"
+                         f"    rows = session.execute(select(Message).filter(Message.chat_id == chat_id)\n"
+                         f"                           .order_by(Message.id.desc()).limit(limit)).scalars().all()\n"
+                         f"    if not rows:\n"
+                         f"        raise HTTPException(status_code={rng.choice((404, 409, 422))})\n"
+                         f"    return [message_dict(row) for row in rows]  # {chat_line(rng)}\n")
+    return "```python\n" + "\n".join(functions) + "```"
+
+
+def corpus(count, seed=0):
+    rng = random.Random(seed)
+    kinds = rng.choices((chat_line, log_paste, code_block), weights=(85, 10, 5), k=count)
+    return [kind(rng) for kind in kinds]
+
+
+def database_size(connection):
+    from sqlalchemy import text
+    connection.execute(text("VACUUM"))
+    return connection.execute(text("SELECT page_count * page_size FROM pragma_page_count(), pragma_page_size()"))\
+        .scalar()
+
+
+def read_all(main, db):
+    from sqlalchemy import select
+    import db_defs
+    start = time.perf_counter()
+    rows = db.execute(select(*main.MESSAGE_COLUMNS).order_by(db_defs.Message.id)).all()
+    body = main.ORJSONResponse({"messages": [main.message_dict(row) for row in rows]}).body
+    return time.perf_counter() - start, len(body)
+
+
+def measure(settings):
+    # Runs in a fresh interpreter per codec, the codec is read from the environment on import
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, APP_DIR)
+    from sqlalchemy import text
+    import compression
+    import db
+    import db_defs
+    import main
+    contents = corpus(settings["messages"])
+    with db.SessionLocal() as session:
+        session.add(db_defs.Chat())
+        session.commit()
+    with db.engine.begin() as connection:
+        # As text, the way messages were stored before compression
+        connection.execute(text("INSERT INTO messages (content, chat_id, timestamp, edited, version) "
+                                "VALUES (:content, 1, 0, 0, 0)"), [{"content": content} for content in contents])
+    with db.engine.connect() as connection:
+        size_before = database_size(connection)
+    with db.SessionLocal() as session:
+        read_before, body_size = read_all(main, session)
+
+    async def rewrite():
+        session = db.ThreadedSession(db.SessionLocal())
+        try:
+            return await compression.compress_stored(session, pause=0)
+        finally:
+            await session.close()
+
+    start = time.perf_counter()
+    rewritten, content_before, content_after = asyncio.run(rewrite())
+    migration = time.perf_counter() - start
+    with db.engine.connect() as connection:
+        size_after = database_size(connection)
+    with db.SessionLocal() as session:
+        read_after, body_size_after = read_all(main, session)
+        assert body_size_after == body_size
+        stored = [content for content, in session.execute(text("SELECT content FROM messages")) if
+                  isinstance(content, bytes)]
+    long = [content for content in contents if len(content.encode()) >= compression.MESSAGE_COMPRESSION_THRESHOLD]
+    start = time.perf_counter()
+    for content in long:
+        compression.compress(content)
+    compress_time = (time.perf_counter() - start) / max(len(long), 1)
+    start = time.perf_counter()
+    for content in stored:
+        compression.decompress(content)
+    decompress_time = (time.perf_counter() - start) / max(len(stored), 1)
+    print(json.dumps({"size_before": size_before, "size_after": size_after, "content_before": content_before,
+                      "content_after": content_after, "rewritten": rewritten, "long": len(long),
+                      "migration": migration, "compress": compress_time, "decompress": decompress_time,
+                      "read_before": read_before, "read_after": read_after}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--codecs", nargs="+", default=["zlib", "zstd"])
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--measure", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure:
+        measure(json.loads(args.measure))
+        return
+
+    for codec in args.codecs:
+        if codec == "zstd" and importlib.util.find_spec("zstandard") is None:
+            print(f"{codec:>5}: skipped, zstandard is not installed")
+            continue
+        environment = {**os.environ, "MESSAGE_COMPRESSION": codec, "DB_SHARDS": "0", "RETENTION_ENABLED": "0",
+                       "METRICS_ENABLED": "0"}
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--measure",
+                                 json.dumps({"messages": args.messages})],
+                                env=environment, check=True, stdout=subprocess.PIPE, text=True).stdout
+        r = json.loads(output.splitlines()[-1])
+        print(f"{codec:>5}: database {r['size_before'] / 2 ** 20:6.1f} -> {r['size_after'] / 2 ** 20:6.1f} MiB, "
+              f"long contents {r['content_before'] / 2 ** 20:6.1f} -> {r['content_after'] / 2 ** 20:6.1f} MiB "
+              f"({r['rewritten']}/{r['long']} messages) rewritten in {r['migration']:5.2f}s")
+        print(f"{'':>5}  per long message: compress {r['compress'] * 1e6:6.1f} us, decompress "
+              f"{r['decompress'] * 1e6:6.1f} us; reading all messages {r['read_before'] * 1000:7.1f} -> "
+              f"{r['read_after'] * 1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Concurrent read/write throughput of database configurations.
+
+"before" recreates the previous hard-coded engine (one StaticPool connection, statement logging, rollback journal with
+synchronous=FULL and default caches), "after" uses the defaults from app/db.py and "write_behind" adds the batching
+message writer on top. Every profile runs in its own process against a fresh database in a temporary directory,
+clients send a mix of message writes and reads:
+
+    AUTHKEY=secret python bench/db_engine.py --requests 2000 --concurrency 20 --writes 0.2
+    AUTHKEY=secret python bench/db_engine.py --writes 1 --profiles after write_behind
+"""
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "app")
+PROFILES = {
+    "before": {"DB_POOL": "static", "DB_ECHO": "1", "SQLITE_JOURNAL_MODE": "DELETE", "SQLITE_SYNCHRONOUS": "FULL",
+               "SQLITE_MMAP_SIZE": "0", "SQLITE_CACHE_SIZE": "-2000"},
+    "after": {},
+    "write_behind": {"WRITE_BEHIND": "1"},
+}
+
+
+def percentile(samples, fraction):
+    return sorted(samples)[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+async def drive(app, requests, concurrency, writes, headers, chat_id):
+    import httpx
+    latencies = {"read": [], "write": []}
+    errors = {"read": 0, "write": 0}
+    counter = iter(range(requests))
+    rng = random.Random(0)
+
+    async def client(http):
+        for i in counter:
+            kind = "write" if rng.random() < writes else "read"
+            start = time.perf_counter()
+            try:
+                if kind == "write":
+                    response = await http.post(f"/chats/{chat_id}/messages", params={"msg": f"bench {i}"},
+                                               headers=headers)
+                else:
+                    response = await http.get(f"/chats/{chat_id}/messages", headers=headers)
+                response.raise_for_status()
+            except Exception:
+                # A shared connection fails statements of interleaved sessions, count them instead of stopping
+                errors[kind] += 1
+                continue
+            latencies[kind].append(time.perf_counter() - start)
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as http:
+        start = time.perf_counter()
+        await asyncio.gather(*(client(http) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    # ASGITransport doesn't run lifespan events, close the pools the shutdown handler would
+    await app.router.shutdown()
+    return elapsed, latencies, errors
+
+
+def run(profile, requests, concurrency, writes, history):
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, APP_DIR)
+    import db
+    import db_defs
+    import main
+
+    with db.SessionLocal() as session:
+        main.add_user(session, "bench", "secret", "Bench User", "bench@bench.bench")
+        session.flush()
+        chat = db_defs.Chat(members=[session.get(db_defs.User, "bench")])
+        chat.messages = [db_defs.Message(content=f"seed {i}", author_id="bench", timestamp=i) for i in range(history)]
+        session.add(chat)
+        session.commit()
+        chat_id = chat.id
+    headers = {"Authorization": f"Bearer {main.create_access_token({'sub': 'bench'})}"}
+
+    elapsed, latencies, errors = asyncio.run(drive(main.app, requests, concurrency, writes, headers, chat_id))
+    line = f"{profile:>12} ({'async' if db.DB_ASYNC else 'sync'}): {requests / elapsed:8.1f} req/s"
+    for kind, samples in latencies.items():
+        if samples:
+            line += f"  {kind} p50 {percentile(samples, .5) * 1000:7.2f} ms p99 {percentile(samples, .99) * 1000:7.2f} ms"
+        line += f" ({errors[kind]} failed)"
+    print(line, file=sys.stderr, flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--writes", type=float, default=0.2, help="fraction of requests that send a message")
+    parser.add_argument("--history", type=int, default=200, help="messages seeded into the benchmark chat")
+    parser.add_argument("--profiles", nargs="+", choices=PROFILES, default=list(PROFILES))
+    parser.add_argument("--profile", choices=PROFILES, help="run a single profile in this process")
+    args = parser.parse_args()
+
+    if args.profile:
+        run(args.profile, args.requests, args.concurrency, args.writes, args.history)
+        return
+    for profile in args.profiles:
+        env = PROFILES[profile]
+        # echo logs every statement to stdout, results are reported on stderr
+        subprocess.run([sys.executable, __file__, "--profile", profile, "--requests", str(args.requests),
+                        "--concurrency", str(args.concurrency), "--writes", str(args.writes),
+                        "--history", str(args.history)],
+                       env={**os.environ, **env}, stdout=subprocess.DEVNULL if env.get("DB_ECHO") else None,
+                       check=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""Mixed-workload load test of the API with a stored baseline to catch regressions.
+
+Seeds synthetic users, chats and messages into a fresh database in a temporary directory through add_user and the ORM,
+then drives the ASGI app in-process with concurrent clients that log in, send messages, fetch history and list their
+chats. Which client does what is drawn from a seeded random generator, so two runs with the same settings send the
+same requests:
+
+    AUTHKEY=secret python bench/loadtest.py --users 200 --chats 50 --messages 500 --requests 5000
+    AUTHKEY=secret python bench/loadtest.py --save-baseline        # record bench/loadtest_baseline.json
+    AUTHKEY=secret python bench/loadtest.py                        # compare against it, exits 1 on a regression
+
+A run regresses when any request fails, when the overall throughput drops or the p95 latency of an operation grows by
+more than --tolerance compared to the baseline. Baselines only hold for the machine and settings they were recorded with,
+the settings (including DB_ASYNC, WRITE_BEHIND and BCRYPT_ROUNDS) are stored alongside and have to match.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "app")
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "loadtest_baseline.json")
+OPERATIONS = ("login", "send", "history", "chats")
+# Environment settings that change what is measured, recorded with every result
+ENVIRONMENT = ("DB_ASYNC", "DB_POOL", "WRITE_BEHIND", "BCRYPT_ROUNDS", "METRICS_ENABLED")
+PASSWORD = "secret"
+SEED_BATCH_SIZE = 5000
+
+
+def percentile(samples, fraction):
+    return sorted(samples)[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def parse_mix(value):
+    # "login=1,send=20,history=50,chats=29" -> fraction of requests per operation
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {name!r}, expected one of {', '.join(OPERATIONS)}")
+        mix[name] = float(weight)
+    total = sum(mix.values())
+    if total <= 0:
+        raise argparse.ArgumentTypeError("the mix needs at least one operation with a positive weight")
+    return {name: weight / total for name, weight in mix.items()}
+
+
+def seed(session, users, chats, members, messages, rng):
+    # Returns (username, chat_id) for every membership. Everyone shares one password hash, hashing it per user would
+    # dominate the setup.
+    from sqlalchemy import insert
+    import db_defs
+    import main
+
+    hashed_password = main.get_password_hash(PASSWORD)
+    usernames = [f"user{i}" for i in range(users)]
+    for username in usernames:
+        main.add_user(session, username, PASSWORD, f"Load Test {username}", f"{username}@bench.bench",
+                      hashed_password=hashed_password)
+    session.flush()
+    seeded_chats = [db_defs.Chat() for _ in range(chats)]
+    session.add_all(seeded_chats)
+    session.flush()
+    memberships = [(usernames[(index * members + k) % users], chat.id)
+                   for index, chat in enumerate(seeded_chats) for k in range(min(members, users))]
+    session.execute(insert(db_defs.chat_association_table),
+                    [{"user_id": username, "chat_id": chat_id} for username, chat_id in memberships])
+    authors = {}
+    for username, chat_id in memberships:
+        authors.setdefault(chat_id, []).append(username)
+    rows = []
+    timestamp = time.time_ns()
+    for chat in seeded_chats:
+        for i in range(messages):
+            rows.append({"chat_id": chat.id, "author_id": rng.choice(authors[chat.id]), "timestamp": timestamp + i,
+                         "content": f"seed message {i} in chat {chat.id}"})
+            if len(rows) == SEED_BATCH_SIZE:
+                session.execute(insert(db_defs.Message), rows)
+                rows = []
+    if rows:
+        session.execute(insert(db_defs.Message), rows)
+    session.commit()
+    return memberships
+
+
+def plan(memberships, mix, requests, rng):
+    # The whole request sequence up front, clients take the next entry whenever they are free
+    operations, weights = zip(*mix.items())
+    return [(operation, *rng.choice(memberships)) for operation in rng.choices(operations, weights, k=requests)]
+
+
+async def drive(app, steps, concurrency, tokens, history_limit):
+    import httpx
+    latencies = {operation: [] for operation in OPERATIONS}
+    errors = {operation: 0 for operation in OPERATIONS}
+    queue = iter(enumerate(steps))
+
+    async def request(http, i, operation, username, chat_id):
+        headers = {"Authorization": f"Bearer {tokens[username]}"}
+        if operation == "login":
+            return await http.post("/token", data={"username": username, "password": PASSWORD})
+        if operation == "send":
+            return await http.post(f"/chats/{chat_id}/messages", params={"msg": f"load test {i}"}, headers=headers)
+        if operation == "history":
+            return await http.get(f"/chats/{chat_id}/messages", params={"limit": history_limit}, headers=headers)
+        return await http.get("/chats/", headers=headers)
+
+    async def client(http):
+        for i, (operation, username, chat_id) in queue:
+            start = time.perf_counter()
+            try:
+                response = await request(http, i, operation, username, chat_id)
+                response.raise_for_status()
+            except Exception as e:
+                errors[operation] += 1
+                if errors[operation] == 1:
+                    print(f"{operation} failed: {e!r}", file=sys.stderr)
+                continue
+            latencies[operation].append(time.perf_counter() - start)
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://loadtest") as http:
+        start = time.perf_counter()
+        await asyncio.gather(*(client(http) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return elapsed, latencies, errors
+
+
+def summarize(elapsed, latencies, errors):
+    results = {}
+    for operation in OPERATIONS:
+        samples = latencies[operation]
+        if not samples and not errors[operation]:
+            continue
+        results[operation] = {"requests": len(samples), "errors": errors[operation],
+                              "throughput": len(samples) / elapsed}
+        if samples:
+            results[operation].update({f"p{p}": percentile(samples, p / 100) * 1000 for p in (50, 95, 99)})
+    everything = [sample for samples in latencies.values() for sample in samples]
+    results["total"] = {"requests": len(everything), "errors": sum(errors.values()),
+                        "throughput": len(everything) / elapsed}
+    if everything:
+        results["total"].update({f"p{p}": percentile(everything, p / 100) * 1000 for p in (50, 95, 99)})
+    return results
+
+
+def report(results, baseline=None):
+    for name, result in results.items():
+        line = f"{name:>8}: {result['requests']:6} ok {result['errors']:4} failed {result['throughput']:8.1f} req/s"
+        if "p50" in result:
+            line += "".join(f"  p{p} {result[f'p{p}']:8.2f} ms" for p in (50, 95, 99))
+        if baseline and name in baseline and "p95" in result and "p95" in baseline[name]:
+            line += f"  (baseline p95 {baseline[name]['p95']:8.2f} ms, {baseline[name]['throughput']:8.1f} req/s)"
+        print(line)
+
+
+def regressions(results, baseline, tolerance):
+    found = [f"{name}: {result['errors']} requests failed" for name, result in results.items()
+             if name != "total" and result["errors"]]
+    if results["total"]["throughput"] < baseline["total"]["throughput"] * (1 - tolerance):
+        found.append(f"throughput fell from {baseline['total']['throughput']:.1f} to "
+                     f"{results['total']['throughput']:.1f} req/s")
+    for name, result in results.items():
+        # The overall p95 jumps between the fast reads and slow logins depending on how many logins queue up
+        if name != "total" and name in baseline and "p95" in result and "p95" in baseline[name]:
+            if result["p95"] > baseline[name]["p95"] * (1 + tolerance):
+                found.append(f"{name}: p95 grew from {baseline[name]['p95']:.2f} to {result['p95']:.2f} ms")
+    return found
+
+
+def run(settings):
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, APP_DIR)
+    import db
+    import main
+
+    rng = random.Random(settings["seed"])
+    with db.SessionLocal() as session:
+        memberships = seed(session, settings["users"], settings["chats"], settings["members"], settings["messages"],
+                           rng)
+    tokens = {username: main.create_access_token({"sub": username}) for username, _ in memberships}
+    steps = plan(memberships, settings["mix"], settings["warmup"] + settings["requests"], rng)
+
+    async def measure():
+        await drive(main.app, steps[:settings["warmup"]], settings["concurrency"], tokens, settings["history_limit"])
+        measured = await drive(main.app, steps[settings["warmup"]:], settings["concurrency"], tokens,
+                               settings["history_limit"])
+        # ASGITransport doesn't run lifespan events, flush the writer and close the pools the shutdown handler would
+        await main.app.router.shutdown()
+        return measured
+
+    return summarize(*asyncio.run(measure()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--chats", type=int, default=25)
+    parser.add_argument("--members", type=int, default=8, help="members per chat")
+    parser.add_argument("--messages", type=int, default=200, help="messages seeded into every chat")
+    parser.add_argument("--requests", type=int, default=3000)
+    parser.add_argument("--warmup", type=int, default=200, help="requests sent before measuring")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--mix", type=parse_mix, default="login=1,send=20,history=50,chats=29",
+                        help="relative weight of every operation")
+    parser.add_argument("--history-limit", type=int, default=50, help="messages per history request")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed relative loss of throughput or growth of p95 latency")
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    args = parser.parse_args()
+    # run() changes into a temporary directory
+    args.baseline = os.path.abspath(args.baseline)
+    args.output = args.output and os.path.abspath(args.output)
+
+    settings = {name: getattr(args, name) for name in ("users", "chats", "members", "messages", "requests", "warmup",
+                                                       "concurrency", "mix", "history_limit", "seed")}
+    settings["environment"] = {name: os.environ.get(name) for name in ENVIRONMENT}
+    baseline = None
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["settings"] != settings:
+            sys.exit(f"{args.baseline} was recorded with different settings, rerun with them or --save-baseline:\n"
+                     f"{json.dumps(baseline['settings'], indent=2)}")
+
+    results = run(settings)
+    report(results, baseline and baseline["results"])
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"settings": settings, "results": results}, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"settings": settings, "results": results}, f, indent=2)
+            f.write("\n")
+        print(f"baseline stored in {args.baseline}")
+    elif baseline is None:
+        print(f"no baseline at {args.baseline}, store one with --save-baseline")
+    else:
+        found = regressions(results, baseline["results"], args.tolerance)
+        if found:
+            sys.exit("REGRESSION against " + args.baseline + ":\n  " + "\n  ".join(found))
+        print(f"no regression against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Encoding cost of message histories on the pydantic path and on the orjson fast path.
+
+Rows are built in memory the way the database hands them to the endpoints, so only serialization is measured:
+
+    AUTHKEY=secret python bench/serialization.py --sizes 10000 100000
+
+"pydantic" is what a response_model endpoint did before: build the models, validate them again against the response
+model, jsonable_encoder and json.dumps. "orjson" builds plain dicts and encodes them at once, "ndjson stream" encodes
+the same rows page by page like the history export. Peak memory is traced separately from the timings.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "app")
+Row = namedtuple("Row", "id content timestamp edited author_id attachments", defaults=(None,))
+
+
+def pydantic_path(main, rows):
+    from fastapi.encoders import jsonable_encoder
+    page = main.MessagePage(messages=[main.message_from_row(row) for row in rows])
+    return json.dumps(jsonable_encoder(main.MessagePage.validate(page))).encode()
+
+
+def orjson_path(main, rows):
+    return main.ORJSONResponse({"messages": [main.message_dict(row) for row in rows]}).body
+
+
+def stream_path(main, rows):
+    async def get_message_page(db, chat_id, before, after, limit):
+        # Serves the export's pages from the in-memory rows, ids start at 1
+        page = rows[after:after + limit]
+        return page, page[-1].id if after + limit < len(rows) else None
+
+    async def consume():
+        size = 0
+        async for chunk in main.export_messages(None, 1, ndjson=True):
+            size += len(chunk)
+        return size
+
+    main.get_message_page = get_message_page
+    return asyncio.run(consume())
+
+
+def measure(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    fn(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    args = parser.parse_args()
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, APP_DIR)
+    import main as app_main
+
+    for size in args.sizes:
+        rows = [Row(i + 1, f"message number {i} with some text in it", 1650000000000000000 + i, i % 7 == 0,
+                    f"user{i % 50}") for i in range(size)]
+        for name, fn in (("pydantic", pydantic_path), ("orjson", orjson_path), ("ndjson stream", stream_path)):
+            elapsed, peak = measure(fn, app_main, rows)
+            print(f"{size:>7} messages  {name:>13}: {elapsed * 1000:8.1f} ms  peak {peak / 2 ** 20:7.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Message write throughput of the API by shard count.
+
+For every shard count, seeds a fresh database in a temporary directory with one user who is a member of --chats
+chats, then starts --workers processes, like the workers of `uvicorn --workers`, that each drive the ASGI app
+in-process with --concurrency clients sending messages to random chats for --seconds:
+
+    AUTHKEY=secret python bench/shard_writes.py --shards 0,1,2,4,8 --workers 4
+
+A shard count of 0 is the unsharded layout with everything in one database file. Every write takes that file's write
+lock, with shards writers of different chats take different locks. Reports the messages written per second and the
+number of failed writes (SQLite gives up with "database is locked" after SQLITE_BUSY_TIMEOUT). Shards only help
+while writers wait on each other's locks: with fewer cores than --workers the CPU is the limit for every layout.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "app")
+USERNAME = "writer"
+
+
+def seed(chats):
+    import db
+    import main
+    with db.SessionLocal() as session:
+        main.add_user(session, USERNAME, "secret", "Writer", "writer@bench.bench")
+        session.commit()
+    import db_defs
+    with db.SessionLocal() as session:
+        user = session.get(db_defs.User, USERNAME)
+        session.add_all(db_defs.Chat(members=[user]) for _ in range(chats))
+        session.commit()
+        return [chat_id for chat_id, in session.query(db_defs.Chat.id)]
+
+
+def write(worker, chat_ids, concurrency, seconds, start, results):
+    import httpx
+    import main
+    rng = random.Random(worker)
+    headers = {"Authorization": f"Bearer {main.create_access_token({'sub': USERNAME})}"}
+    written, failed = 0, 0
+
+    async def client(http, deadline):
+        nonlocal written, failed
+        while time.time() < deadline:
+            response = await http.post(f"/chats/{rng.choice(chat_ids)}/messages", params={"msg": "benchmark"},
+                                       headers=headers)
+            if response.status_code == 200:
+                written += 1
+            else:
+                failed += 1
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app, raise_app_exceptions=False),
+                                     base_url="http://bench") as http:
+            await asyncio.sleep(max(0.0, start - time.time()))
+            await asyncio.gather(*(client(http, start + seconds) for _ in range(concurrency)))
+        await main.app.router.shutdown()
+
+    asyncio.run(run())
+    results.put((written, failed))
+
+
+def measure(settings):
+    # Runs in a fresh interpreter per shard count, the storage layout is read from the environment on import
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, APP_DIR)
+    chat_ids = seed(settings["chats"])
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    # Every worker starts writing at the same moment, after all of them imported the app
+    start = time.time() + 2
+    workers = [context.Process(target=write, args=(i, chat_ids, settings["concurrency"], settings["seconds"], start,
+                                                   results))
+               for i in range(settings["workers"])]
+    for worker in workers:
+        worker.start()
+    counts = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    written = sum(count for count, _ in counts)
+    print(json.dumps({"written": written, "failed": sum(count for _, count in counts),
+                      "throughput": written / settings["seconds"]}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", default="0,1,2,4,8", help="comma separated shard counts to compare")
+    parser.add_argument("--chats", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=4, help="writing processes")
+    parser.add_argument("--concurrency", type=int, default=8, help="clients per process")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--measure", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure:
+        measure(json.loads(args.measure))
+        return
+
+    settings = {name: getattr(args, name) for name in ("chats", "workers", "concurrency", "seconds")}
+    baseline = None
+    for shards in map(int, args.shards.split(",")):
+        environment = {**os.environ, "DB_SHARDS": str(shards), "RETENTION_ENABLED": "0", "METRICS_ENABLED": "0"}
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--measure", json.dumps(settings)],
+                                env=environment, check=True, stdout=subprocess.PIPE, text=True).stdout
+        result = json.loads(output.splitlines()[-1])
+        baseline = baseline or result["throughput"]
+        print(f"{shards:3} shards: {result['throughput']:8.1f} messages/s ({result['throughput'] / baseline:4.2f}x) "
+              f"{result['written']:7} written {result['failed']:5} failed")
+
+
+if __name__ == "__main__":
+    main()
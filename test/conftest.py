@@ -0,0 +1,15 @@
+import os
+import shutil
+import tempfile
+
+# app.main opens the database at DB_URL, ./test.db by default, as soon as it is imported. Conftest modules are imported
+# before the test modules, so point it at a throwaway directory here.
+TEST_DIR = tempfile.mkdtemp(prefix="chatapp-test-")
+os.environ["DB_URL"] = f"sqlite:///{os.path.join(TEST_DIR, 'test.db')}"
+# Off by default, the metrics tests need them
+os.environ["METRICS_ENABLED"] = "1"
+os.environ["METRICS_TOKEN"] = "metrics-test-token"
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(TEST_DIR, ignore_errors=True)
@@ -1,6 +1,7 @@
 import asyncio
 import json
 import time
+from contextlib import contextmanager
 from datetime import timedelta
 
 import pytest
@@ -12,133 +13,163 @@ from app.defs import UserInDB, User
 from app.main import check_email
 
 
-@pytest.fixture
-def open_db():
-    from app import db
-    return db
+def fill_user_with_default_values(i, u):
+    if "username" not in u:
+        u["username"] = "test" + str(i)
+    if "full_name" not in u:
+        u["full_name"] = f"test{str(i)} Test"
+    if "email" not in u:
+        u["email"] = "test@test.test"
+    if "password" not in u:
+        u["password"] = "secret"
+    if "disabled" not in u:
+        u["disabled"] = False
+    return u
 
 
-@pytest.fixture
-def reset_db(open_db):
-    old_users = open_db.db["users"]
-    old_invites = open_db.db["invites"]
-    old_chats = open_db.db["chats"]
-    open_db.db["users"] = {}
-    open_db.db["invites"] = {}
-    open_db.db["chats"] = {}
-    open_db.save()
-    yield open_db
-    open_db.db["users"] = old_users
-    open_db.db["invites"] = old_invites
-    open_db.db["chats"] = old_chats
-    open_db.save()
+@pytest.fixture(params=["sync", "async"])
+def sql_engine(request, tmp_path):
+    # The engine requests are served from, a sync one or an aiosqlite one over the same fresh database file
+    from sqlalchemy import create_engine
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from app.main import db_defs
+    url = f"sqlite:///{tmp_path / 'test.db'}"
+    engine = create_engine(url, future=True, connect_args={"check_same_thread": False})
+    db_defs.Base.metadata.create_all(bind=engine)
+    if request.param == "async":
+        return create_async_engine(url.replace("sqlite", "sqlite+aiosqlite"))
+    return engine
 
 
 @pytest.fixture
-def auth(reset_db):
-    from app import auth
-    return auth
+def sql_db(sql_engine, monkeypatch):
+    # Runs the app against a fresh database in both session modes, the yielded session is a sync one for test setup
+    from sqlalchemy import create_engine
+    from sqlalchemy.ext.asyncio import AsyncSession, AsyncEngine
+    from sqlalchemy.orm import sessionmaker
+    import db
+    from auth import token_cache
+    sync_engine = sql_engine
+    if isinstance(sql_engine, AsyncEngine):
+        sync_engine = create_engine(sql_engine.url.set(drivername="sqlite"), future=True)
+    session_local = sessionmaker(autoflush=False, autocommit=False, expire_on_commit=False, bind=sync_engine)
+    # Requests and background work both open their sessions through db.open_session
+    monkeypatch.setattr(db, "DB_ASYNC", isinstance(sql_engine, AsyncEngine))
+    monkeypatch.setattr(db, "SessionLocal", session_local)
+    monkeypatch.setattr(db, "AsyncSessionLocal", sessionmaker(
+        autoflush=False, autocommit=False, expire_on_commit=False, bind=sql_engine, class_=AsyncSession
+    ) if isinstance(sql_engine, AsyncEngine) else None, raising=False)
+    # Tokens minted in the same second for the same username are identical across tests
+    token_cache.clear()
+    db = session_local()
+    yield db
+    db.close()
+
+
+@contextmanager
+def assert_query_budget(engine, budget):
+    # Fails when more than `budget` statements reach the database inside the block, catches reintroduced N+1 loads
+    from sqlalchemy import event
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = getattr(engine, "sync_engine", engine)
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+    assert len(statements) <= budget, "\n".join(statements)
 
 
 @pytest.fixture
-def add_test_users(reset_db, auth, request):
+def sql_users(sql_db, request):
     # Example data:
     # [{"username":"test1","full_name": "full_name","email": "a@a.a","password":"secret","disabled":False}]
     # Minimum data: []
     # Minimum user data: {}
     # default user data:
     # {"username":"test{INDEX}","full_name": "test{INDEX} Test","email": "test@test.test","password":"secret","disabled":False}
+    from app.main import add_user
     marker = request.node.get_closest_marker("test_users")
-    users = marker.args[0] if marker else [{}]
-
-    def fill_user_with_default_values(i, u):
-        if "username" not in u:
-            u["username"] = "test" + str(i)
-        if "full_name" not in u:
-            u["full_name"] = f"test{str(i)} Test"
-        if "email" not in u:
-            u["email"] = "test@test.test"
-        if "password" not in u:
-            u["password"] = "secret"
-        if "disabled" not in u:
-            u["disabled"] = False
-        return u
-
-    generated_users = []
-    for index, user in enumerate(users):
-        user = fill_user_with_default_values(index, user)
-        if user["username"] in reset_db.db["users"]:
-            raise Exception("shouldnt be in state")
-        reset_db.db["users"][user["username"]] = {
-            "username": user["username"],
-            "full_name": user["full_name"],
-            "email": user["email"],
-            "hashed_password": auth.get_password_hash(user["password"]),
-            "disabled": user["disabled"]
-        }
-        generated_users.append(reset_db.db["users"][user["username"]])
-        generated_users[len(generated_users) - 1]["password"] = user["password"]
-        reset_db.save()
-    yield generated_users.copy()
-    for user in generated_users:
-        try:
-            reset_db.db["users"].pop(user["username"])
-        except KeyError:
-            pass
+    users = [fill_user_with_default_values(i, u) for i, u in enumerate(marker.args[0] if marker else [{}])]
+    for user in users:
+        add_user(sql_db, user["username"], user["password"], user["full_name"], user["email"], user["disabled"])
+    sql_db.commit()
+    return users
 
 
 @pytest.fixture
-def token(add_test_users, auth, request):
+def sql_token(sql_users, request):
+    from app.main import create_access_token
     marker = request.node.get_closest_marker("token_test_user_index")
-    index = int(marker.args[0] if marker else 0)
-    if len(add_test_users) <= index:
-        raise KeyError("Index invalid")
-    return auth.create_access_token({"sub": add_test_users[index]["username"]})
+    return create_access_token({"sub": sql_users[int(marker.args[0] if marker else 0)]["username"]})
 
 
 @pytest.fixture
-def test_client(reset_db, auth):
+def sql_client(sql_db):
     from app.main import app
     return TestClient(app)
 
 
-def test_register_user(test_client, reset_db, auth):
-    data = test_client.post("/users/register?username=hi&password=secret&full_name=Hello&email=h%40h.h")
+@pytest.fixture
+def sql_chat(sql_db, sql_users):
+    # A chat with all test users as members and ten messages written by the first one
+    from app.main import db_defs
+    chat = db_defs.Chat()
+    chat.members.extend(sql_db.query(db_defs.User).all())
+    author = sql_db.query(db_defs.User).filter_by(username=sql_users[0]["username"]).scalar()
+    for i in range(10):
+        chat.messages.append(db_defs.Message(content=str(i), author=author, timestamp=i))
+    sql_db.add(chat)
+    sql_db.commit()
+    return chat
+
+
+def test_register_user(sql_client, sql_db):
+    from app import auth, db_defs
+    data = sql_client.post("/users/register?username=hi&password=secret&full_name=Hello&email=h%40h.h")
     assert data.status_code == status.HTTP_200_OK
-    assert "hi" in reset_db.db["users"]
-    assert User(**reset_db.db["users"]["hi"]) == User(username="hi", full_name="Hello", email="h@h.h", disabled=False)
-    assert auth.verify_password("secret", reset_db.db["users"]["hi"]["hashed_password"])
+    user = sql_db.get(db_defs.User, "hi")
+    assert user is not None
+    assert User.from_orm(user) == User(username="hi", full_name="Hello", email="h@h.h", disabled=False)
+    assert auth.verify_password("secret", user.hashed_password)
 
 
 @pytest.mark.test_users([{}])
-def test_register_user_double_username(test_client, add_test_users, reset_db):
-    old_reset_db = reset_db.db.copy()
-    data = test_client.post(f"/users/register?username={add_test_users[0]['username']}&password=secret&full_name"
-                            f"=Hello&email=h%40h.h")
+def test_register_user_double_username(sql_client, sql_users, sql_db):
+    from app import db_defs
+    old_users = [repr(user) for user in sql_db.query(db_defs.User).order_by(db_defs.User.username)]
+    data = sql_client.post(f"/users/register?username={sql_users[0]['username']}&password=secret&full_name"
+                           f"=Hello&email=h%40h.h")
     assert data.status_code == status.HTTP_401_UNAUTHORIZED
     assert data.json()["detail"] == "username already registered"
-    assert old_reset_db == reset_db.db
+    sql_db.expire_all()
+    assert old_users == [repr(user) for user in sql_db.query(db_defs.User).order_by(db_defs.User.username)]
 
 
-def test_register_user_invalid_email(test_client):
-    data = test_client.post("/users/register?username=test1&password=secret&full_name=Hello&email=hh.h")
+def test_register_user_invalid_email(sql_client):
+    data = sql_client.post("/users/register?username=test1&password=secret&full_name=Hello&email=hh.h")
     assert data.status_code == status.HTTP_401_UNAUTHORIZED
     assert data.json()["detail"] == "email is invalid"
 
 
 @pytest.mark.test_users([{}])
-def test_register_user_double_username_invalid_email(test_client, add_test_users, reset_db):
-    data = test_client.post(f"/users/register?username={add_test_users[0]['username']}&password=secret&full_name"
-                            f"=Hello&email=h%40hh")
+def test_register_user_double_username_invalid_email(sql_client, sql_users):
+    data = sql_client.post(f"/users/register?username={sql_users[0]['username']}&password=secret&full_name"
+                           f"=Hello&email=h%40hh")
     assert data.status_code == status.HTTP_401_UNAUTHORIZED
     assert data.json()["detail"] == "email is invalid"
 
 
 @pytest.mark.test_users([{}])
-def test_receive_token(test_client, add_test_users, auth):
-    data = test_client.post(f"/token", data={
-        "username": add_test_users[0]["username"],
-        "password": add_test_users[0]["password"]
+def test_receive_token(sql_client, sql_db, sql_users):
+    from app import db_defs
+    data = sql_client.post(f"/token", data={
+        "username": sql_users[0]["username"],
+        "password": sql_users[0]["password"]
     })
 
     assert data.status_code == 200
@@ -151,56 +182,58 @@ def test_receive_token(test_client, add_test_users, auth):
         return base64url_decode(i.encode("utf-8")).decode("utf-8")
 
     assert base64to_string(token_parts[0]) == "{\"alg\":\"HS256\",\"typ\":\"JWT\"}"
-    assert json.loads(base64to_string(token_parts[1]))["sub"] == add_test_users[0]["username"]
-    current_user = asyncio.run(auth.get_current_user(token))
-    assert current_user == UserInDB(**add_test_users[0])
+    assert json.loads(base64to_string(token_parts[1]))["sub"] == sql_users[0]["username"]
+    data = sql_client.get("/users/me/", headers={"Authorization": f"Bearer {token}"})
+    stored_user = UserInDB.from_orm(sql_db.get(db_defs.User, sql_users[0]["username"]))
+    assert User(**data.json()) == User(**stored_user.dict()) == User(**sql_users[0])
 
 
 @pytest.mark.test_users([{}])
-def test_receive_token_wrong_username(test_client, add_test_users, auth):
-    data = test_client.post(f"/token", data={
-        "username": add_test_users[0]["username"] + "ThisIsANonExistingUsername",
-        "password": add_test_users[0]["password"]
+def test_receive_token_wrong_username(sql_client, sql_users):
+    data = sql_client.post(f"/token", data={
+        "username": sql_users[0]["username"] + "ThisIsANonExistingUsername",
+        "password": sql_users[0]["password"]
     })
     assert data.status_code == status.HTTP_401_UNAUTHORIZED
     assert data.json()["detail"] == "Incorrect username or password"
 
 
 @pytest.mark.test_users([{}])
-def test_receive_token_wrong_password(test_client, add_test_users, auth):
-    data = test_client.post(f"/token", data={
-        "username": add_test_users[0]["username"],
-        "password": add_test_users[0]["password"] + "WrongPassword"
+def test_receive_token_wrong_password(sql_client, sql_users):
+    data = sql_client.post(f"/token", data={
+        "username": sql_users[0]["username"],
+        "password": sql_users[0]["password"] + "WrongPassword"
     })
     assert data.status_code == status.HTTP_401_UNAUTHORIZED
     assert data.json()["detail"] == "Incorrect username or password"
 
 
 @pytest.mark.test_users([{}])
-def test_get_user_me(test_client, add_test_users, token):
-    data = test_client.get("/users/me/", headers={
-        "Authorization": f"Bearer {token}"
+def test_get_user_me(sql_client, sql_users, sql_token):
+    data = sql_client.get("/users/me/", headers={
+        "Authorization": f"Bearer {sql_token}"
     })
 
     assert data.status_code == status.HTTP_200_OK
-    assert User(**data.json()) == User(**add_test_users[0])
+    assert User(**data.json()) == User(**sql_users[0])
 
 
 @pytest.mark.test_users([{}, {}])
 @pytest.mark.token_test_user_index(1)
-def test_get_user_me_2(test_client, add_test_users, token):
-    data = test_client.get("/users/me/", headers={
-        "Authorization": f"Bearer {token}"
+def test_get_user_me_2(sql_client, sql_users, sql_token):
+    data = sql_client.get("/users/me/", headers={
+        "Authorization": f"Bearer {sql_token}"
     })
 
     assert data.status_code == status.HTTP_200_OK
-    assert User(**data.json()) == User(**add_test_users[1])
+    assert User(**data.json()) == User(**sql_users[1])
 
 
 @pytest.mark.test_users([{}])
-def test_get_user_me_invalid_username(test_client, add_test_users, auth):
-    token = auth.create_access_token({"sub": add_test_users[0]["username"] + "ThisIsWrongUsername"})
-    data = test_client.get("/users/me/", headers={
+def test_get_user_me_invalid_username(sql_client, sql_users):
+    from app.main import create_access_token
+    token = create_access_token({"sub": sql_users[0]["username"] + "ThisIsWrongUsername"})
+    data = sql_client.get("/users/me/", headers={
         "Authorization": f"Bearer {token}"
     })
 
@@ -210,16 +243,17 @@ def test_get_user_me_invalid_username(test_client, add_test_users, auth):
 
 @pytest.mark.slow
 @pytest.mark.test_users([{}])
-def test_get_user_me_timed_out_token(test_client, add_test_users, auth):
-    token = auth.create_access_token({"sub": add_test_users[0]["username"]}, timedelta(seconds=1))
-    data = test_client.get("/users/me/", headers={
+def test_get_user_me_timed_out_token(sql_client, sql_users):
+    from app.main import create_access_token
+    token = create_access_token({"sub": sql_users[0]["username"]}, timedelta(seconds=1))
+    data = sql_client.get("/users/me/", headers={
         "Authorization": f"Bearer {token}"
     })
     assert data.status_code == status.HTTP_200_OK
-    assert User(**data.json()) == User(**add_test_users[0])
+    assert User(**data.json()) == User(**sql_users[0])
 
     time.sleep(2)
-    data = test_client.get("/users/me/", headers={
+    data = sql_client.get("/users/me/", headers={
         "Authorization": f"Bearer {token}"
     })
 
@@ -228,42 +262,42 @@ def test_get_user_me_timed_out_token(test_client, add_test_users, auth):
 
 
 @pytest.mark.test_users([{}, {}])
-def test_get_other_user(test_client, add_test_users, token):
-    data = test_client.get(f"users/{add_test_users[1]['username']}", headers={
-        "Authorization": f"Bearer {token}"
+def test_get_other_user(sql_client, sql_users, sql_token):
+    data = sql_client.get(f"users/{sql_users[1]['username']}", headers={
+        "Authorization": f"Bearer {sql_token}"
     })
 
     assert data.status_code == status.HTTP_200_OK
     json_data = {k: v for k, v in data.json().items() if v is not None}
     assert len(json_data) == 1
-    assert json_data["username"] == add_test_users[1]["username"]
+    assert json_data["username"] == sql_users[1]["username"]
 
 
 @pytest.mark.test_users([{}])
-def test_get_other_user_self(test_client, add_test_users, token):
-    data = test_client.get(f"users/{add_test_users[0]['username']}", headers={
-        "Authorization": f"Bearer {token}"
+def test_get_other_user_self(sql_client, sql_users, sql_token):
+    data = sql_client.get(f"users/{sql_users[0]['username']}", headers={
+        "Authorization": f"Bearer {sql_token}"
     })
 
     assert data.status_code == status.HTTP_200_OK
 
     json_data = {k: v for k, v in data.json().items() if v is not None}
     assert len(json_data) == 4
-    assert User(**json_data) == User(**add_test_users[0])
+    assert User(**json_data) == User(**sql_users[0])
 
 
 @pytest.mark.test_users([{}])
-def test_create_chat(test_client, reset_db, add_test_users, token):
-    data = test_client.post("/chats/", headers={
-        "Authorization": f"Bearer {token}"
+def test_create_chat(sql_client, sql_db, sql_users, sql_token):
+    from app import db_defs
+    data = sql_client.post("/chats/", headers={
+        "Authorization": f"Bearer {sql_token}"
     })
     assert data.status_code == status.HTTP_200_OK
-    assert len(reset_db.db["chats"]) == 1
-    assert reset_db.db["chats"]["0"]["messages"] is not None
-    assert len(reset_db.db["chats"]["0"]["messages"]) == 0
-    assert reset_db.db["chats"]["0"]["members"] is not None
-    assert len(reset_db.db["chats"]["0"]["members"]) == 1
-    assert reset_db.db["chats"]["0"]["members"][0] == add_test_users[0]["username"]
+    chats = sql_db.query(db_defs.Chat).all()
+    assert len(chats) == 1
+    assert chats[0].id == data.json()["id"]
+    assert len(chats[0].messages) == 0
+    assert [member.username for member in chats[0].members] == [sql_users[0]["username"]]
 
 
 def test_check_email():
@@ -274,3 +308,1423 @@ def test_check_email():
 @pytest.mark.parametrize("test_input", ["hhh", "h@hh", "hh.h", "@h.h", "h@.h", "h@h."])
 def test_check_email_missing_chars(test_input):
     assert not check_email(test_input)
+
+
+@pytest.mark.test_users([{}])
+def test_get_messages_pages_backwards(sql_client, sql_chat, sql_token):
+    headers = {"Authorization": f"Bearer {sql_token}"}
+    data = sql_client.get(f"/chats/{sql_chat.id}/messages?limit=4", headers=headers)
+    assert data.status_code == status.HTTP_200_OK
+    assert [m["content"] for m in data.json()["messages"]] == ["6", "7", "8", "9"]
+    seen = [m["content"] for m in data.json()["messages"]]
+    while data.json()["next_cursor"] is not None:
+        data = sql_client.get(f"/chats/{sql_chat.id}/messages?limit=4&before={data.json()['next_cursor']}",
+                              headers=headers)
+        assert data.status_code == status.HTTP_200_OK
+        seen = [m["content"] for m in data.json()["messages"]] + seen
+    assert seen == [str(i) for i in range(10)]
+
+
+@pytest.mark.test_users([{}])
+def test_get_messages_pages_forwards(sql_client, sql_chat, sql_token):
+    headers = {"Authorization": f"Bearer {sql_token}"}
+    ids = [m.id for m in sql_chat.messages]
+    data = sql_client.get(f"/chats/{sql_chat.id}/messages?limit=5&after={ids[2]}", headers=headers)
+    assert [m["id"] for m in data.json()["messages"]] == ids[3:8]
+    assert data.json()["next_cursor"] == ids[7]
+    data = sql_client.get(f"/chats/{sql_chat.id}/messages?limit=5&after={ids[7]}", headers=headers)
+    assert [m["id"] for m in data.json()["messages"]] == ids[8:]
+    assert data.json()["next_cursor"] is None
+
+
+@pytest.mark.test_users([{}, {}])
+def test_get_messages_non_member(sql_client, sql_db, sql_chat, sql_token):
+    sql_chat.members.pop(0)
+    sql_db.commit()
+    data = sql_client.get(f"/chats/{sql_chat.id}/messages", headers={"Authorization": f"Bearer {sql_token}"})
+    assert data.status_code == status.HTTP_403_FORBIDDEN
+
+
+@pytest.mark.test_users([{}, {}])
+def test_chat_events(sql_client, sql_chat, sql_token):
+    headers = {"Authorization": f"Bearer {sql_token}"}
+    with sql_client.websocket_connect(f"/chats/{sql_chat.id}/ws?token={sql_token}") as websocket:
+        sql_client.post(f"/chats/{sql_chat.id}/messages?msg=hello", headers=headers)
+        event = websocket.receive_json()
+        assert event["type"] == "message_created"
+        assert event["message"]["content"] == "hello"
+        message_id = event["message"]["id"]
+
+        sql_client.post(f"/chats/{sql_chat.id}/messages/{message_id}?message=edited", headers=headers)
+        event = websocket.receive_json()
+        assert event["type"] == "message_edited"
+        assert event["message"] == {**event["message"], "id": message_id, "content": "edited", "edited": True}
+
+        sql_client.delete(f"/chats/{sql_chat.id}/messages/{message_id}", headers=headers)
+        assert websocket.receive_json() == {"type": "message_deleted", "version": 3, "id": message_id}
+
+        sql_client.delete(f"/chats/{sql_chat.id}/members/test1", headers=headers)
+        assert websocket.receive_json() == {"type": "member_kicked", "username": "test1"}
+
+
+@pytest.mark.test_users([{}, {}])
+@pytest.mark.token_test_user_index(1)
+def test_chat_events_closed_for_kicked_member(sql_client, sql_chat, sql_token, sql_users):
+    from app.main import create_access_token
+    owner_headers = {"Authorization": f"Bearer {create_access_token({'sub': sql_users[0]['username']})}"}
+    with sql_client.websocket_connect(f"/chats/{sql_chat.id}/ws",
+                                      headers={"Authorization": f"Bearer {sql_token}"}) as websocket:
+        sql_client.delete(f"/chats/{sql_chat.id}/members/{sql_users[1]['username']}", headers=owner_headers)
+        assert websocket.receive_json() == {"type": "member_kicked", "username": sql_users[1]["username"]}
+        assert websocket.receive()["type"] == "websocket.close"
+
+
+@pytest.mark.test_users([{}, {}])
+def test_chat_events_rejects_non_member(sql_client, sql_db, sql_chat, sql_token):
+    from starlette.websockets import WebSocketDisconnect
+    sql_chat.members.pop(0)
+    sql_db.commit()
+    with pytest.raises(WebSocketDisconnect):
+        with sql_client.websocket_connect(f"/chats/{sql_chat.id}/ws?token={sql_token}") as websocket:
+            websocket.receive_json()
+    with pytest.raises(WebSocketDisconnect):
+        with sql_client.websocket_connect(f"/chats/{sql_chat.id}/ws?token=invalid") as websocket:
+            websocket.receive_json()
+
+
+def test_slow_subscriber_is_cut_off():
+    from app.events import ChatEventBroker
+
+    async def publish_to_slow_subscriber():
+        broker = ChatEventBroker(queue_size=2)
+        slow = broker.subscribe(1, "slow")
+        for i in range(3):
+            broker.publish(1, {"type": "message_deleted", "id": i})
+        await asyncio.sleep(0)
+        return [slow.queue.get_nowait() for _ in range(slow.queue.qsize())]
+
+    assert asyncio.run(publish_to_slow_subscriber()) == [None]
+
+
+def publish_and_receive_events(path, worker, count, total, barrier, results):
+    # One worker process: two subscribers to chat 1, then `count` events published to chat 1 and to chat 2
+    from app.events import SQLiteEventBroker
+
+    async def run():
+        broker = SQLiteEventBroker(path, queue_size=total + 10, poll_interval=0.005)
+        subscribers = [broker.subscribe(1, f"worker{worker}-{i}") for i in range(2)]
+        await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+        for seq in range(count):
+            broker.publish(1, {"worker": worker, "seq": seq})
+            broker.publish(2, {"worker": worker, "seq": seq})
+        received = [[await asyncio.wait_for(subscriber.queue.get(), 30) for _ in range(total)]
+                    for subscriber in subscribers]
+        # Anything beyond that would be delivered twice
+        await asyncio.sleep(0.2)
+        extra = sum(subscriber.queue.qsize() for subscriber in subscribers)
+        broker.close()
+        return received, extra
+
+    results.put((worker, *asyncio.run(run())))
+
+
+def test_sqlite_events_reach_every_process_once_in_order(tmp_path):
+    import multiprocessing
+    context = multiprocessing.get_context("spawn")
+    workers, count = 4, 50
+    total = workers * count
+    barrier = context.Barrier(workers)
+    results = context.Queue()
+    processes = [context.Process(target=publish_and_receive_events,
+                                 args=(str(tmp_path / "events.db"), worker, count, total, barrier, results))
+                 for worker in range(workers)]
+    for process in processes:
+        process.start()
+    received = {}
+    for _ in processes:
+        worker, streams, extra = results.get(timeout=120)
+        assert extra == 0
+        received[worker] = [[(event["worker"], event["seq"]) for event in stream] for stream in streams]
+    for process in processes:
+        process.join(30)
+        assert process.exitcode == 0
+
+    streams = [stream for worker in sorted(received) for stream in received[worker]]
+    assert len(streams) == workers * 2
+    assert sorted(streams[0]) == [(worker, seq) for worker in range(workers) for seq in range(count)]
+    for worker in range(workers):
+        assert [seq for w, seq in streams[0] if w == worker] == list(range(count))
+    # Every subscriber in every process sees the same order
+    assert all(stream == streams[0] for stream in streams)
+
+
+def test_sqlite_events_survive_bad_rows_and_report_pruned_ones(tmp_path):
+    import sqlite3
+    from app.events import SQLiteEventBroker
+    path = str(tmp_path / "events.db")
+
+    def append(*rows, prune_first=False, prune_all=False):
+        # As another process would
+        connection = sqlite3.connect(path)
+        with connection:
+            ids = [connection.execute("INSERT INTO chat_events (chat_id, payload, created_at) VALUES (1, ?, 0)",
+                                      (payload,)).lastrowid for payload in rows]
+            if prune_first:
+                connection.execute("DELETE FROM chat_events WHERE id = ?", (ids[0],))
+            if prune_all:
+                connection.execute("DELETE FROM chat_events")
+        connection.close()
+
+    async def run():
+        broker = SQLiteEventBroker(path, poll_interval=0.005)
+        subscriber = broker.subscribe(1, "a")
+        received = []
+        # A row that doesn't parse doesn't stop the log from being tailed
+        append(b"not json", b'{"n": 1}')
+        received.append(await asyncio.wait_for(subscriber.queue.get(), 10))
+        # Events pruned before they were read cut the subscribers off, so they resync
+        append(b'{"n": 2}', b'{"n": 3}', prune_first=True)
+        received.append(await asyncio.wait_for(subscriber.queue.get(), 10))
+        broker.close()
+        append(prune_all=True)
+        # Starting on a log whose newest events were pruned loses nothing
+        broker = SQLiteEventBroker(path, poll_interval=0.005)
+        subscriber = broker.subscribe(1, "b")
+        broker.publish(1, {"n": 4})
+        received.append(await asyncio.wait_for(subscriber.queue.get(), 10))
+        broker.close()
+        return received
+
+    assert asyncio.run(run()) == [{"n": 1}, None, {"n": 4}]
+
+
+@pytest.mark.test_users([{}])
+def test_get_changes(sql_client, sql_chat, sql_token):
+    headers = {"Authorization": f"Bearer {sql_token}"}
+    data = sql_client.get(f"/chats/{sql_chat.id}/changes", headers=headers)
+    assert data.status_code == status.HTTP_200_OK
+    assert len(data.json()["messages"]) == 10
+    version = data.json()["version"]
+    first, second = data.json()["messages"][:2]
+
+    sql_client.post(f"/chats/{sql_chat.id}/messages?msg=new", headers=headers)
+    sql_client.post(f"/chats/{sql_chat.id}/messages/{first['id']}?message=edited", headers=headers)
+    sql_client.delete(f"/chats/{sql_chat.id}/messages/{second['id']}", headers=headers)
+
+    data = sql_client.get(f"/chats/{sql_chat.id}/changes?since={version}", headers=headers)
+    assert data.json()["version"] == version + 3
+    assert [(m["content"], m["edited"]) for m in data.json()["messages"]] == [("edited", True), ("new", False)]
+    assert data.json()["deleted"] == [second["id"]]
+
+    data = sql_client.get(f"/chats/{sql_chat.id}/changes?since={version + 3}", headers=headers)
+    assert data.json() == {"version": version + 3, "messages": [], "deleted": []}
+
+
+@pytest.mark.test_users([{}, {}, {}])
+def test_get_changes_deleted_chat(sql_client, sql_token, sql_users):
+    from app.main import create_access_token
+    headers = {"Authorization": f"Bearer {sql_token}"}
+    member, stranger = [{"Authorization": f"Bearer {create_access_token({'sub': u['username']})}"}
+                        for u in sql_users[1:]]
+    chat_id = sql_client.post("/chats/", headers=headers).json()["id"]
+    invite = sql_client.post(f"/chats/{chat_id}/invite", headers=headers).json()["invite"]
+    sql_client.get(f"/invite/{invite}", headers=member)
+    assert sql_client.delete(f"/chats/{chat_id}", headers=headers).status_code == status.HTTP_200_OK
+    data = sql_client.get(f"/chats/{chat_id}/changes?since=0", headers=headers)
+    assert data.status_code == status.HTTP_410_GONE
+    assert sql_client.get(f"/chats/{chat_id}/changes", headers=member).status_code == status.HTTP_410_GONE
+    # Others can't tell a deleted chat from one that never existed
+    assert sql_client.get(f"/chats/{chat_id}/changes", headers=stranger).status_code == status.HTTP_403_FORBIDDEN
+    assert sql_client.get(f"/chats/{chat_id + 100}/changes", headers=stranger).status_code == \
+           status.HTTP_403_FORBIDDEN
+    assert sql_client.post("/chats/", headers=headers).json()["id"] != chat_id
+
+
+@pytest.mark.test_users([{}, {}])
+def test_delete_chat_bulk(sql_client, sql_engine, sql_db, sql_chat, sql_token):
+    # Small chats go at once, with a fixed number of statements however many messages they have
+    from app.main import db_defs
+    headers = {"Authorization": f"Bearer {sql_token}"}
+    chat_id = sql_chat.id
+    sql_client.post(f"/chats/{chat_id}/invite", headers=headers)
+    sql_client.get("/users/me/", headers=headers)
+    with assert_query_budget(sql_engine, 11):
+        assert sql_client.delete(f"/chats/{chat_id}", headers=headers).status_code == status.HTTP_200_OK
+    sql_db.expire_all()
+    assert sql_db.get(db_defs.Chat, chat_id) is None
+    assert sql_db.query(db_defs.Message).count() == 0
+    assert sql_db.query(db_defs.Invite).count() == 0
+    assert sql_db.query(db_defs.Attachment).count() == 0
+    assert sql_db.query(db_defs.chat_association_table).count() == 0
+
+
+@pytest.mark.test_users([{}, {}])
+def test_delete_large_chat_in_background(sql_client, sql_db, sql_chat, sql_token, sql_users, monkeypatch):
+    import auth
+    import purge
+    from app.main import db_defs, purge_chats
+    monkeypatch.setattr(purge, "PURGE_THRESHOLD", 5)
+    monkeypatch.setattr(purge, "PURGE_BATCH_SIZE", 3)
+    monkeypatch.setattr(auth, "ADMIN_USERS", {sql_users[1]["username"]})
+    headers = {"Authorization": f"Bearer {sql_token}"}
+    admin = {"Authorization": f"Bearer {auth.create_access_token({'sub': sql_users[1]['username']})}"}
+    chat_id = sql_chat.id
+    invite = sql_client.post(f"/chats/{chat_id}/invite", headers=headers).json()["invite"]
+
+    assert sql_client.delete(f"/chats/{chat_id}", headers=headers).status_code == status.HTTP_200_OK
+    # Gone for every user right away, only the messages are left
+    assert sql_client.get(f"/chats/{chat_id}/messages", headers=headers).status_code == status.HTTP_403_FORBIDDEN
+    assert sql_client.get(f"/chats/{chat_id}/changes?since=0", headers=headers).status_code == status.HTTP_410_GONE
+    assert sql_client.get("/chats/", headers=headers).json()["chats"] == []
+    assert sql_client.get(f"/invite/{invite}", headers=headers).status_code != status.HTTP_200_OK
+    sql_db.expire_all()
+    assert sql_db.query(db_defs.Message).filter_by(chat_id=chat_id).count() == 10
+
+    assert sql_client.get("/admin/purges", headers=headers).status_code == status.HTTP_403_FORBIDDEN
+    progress = sql_client.get("/admin/purges", headers=admin).json()
+    assert [(p["chat_id"], p["remaining_messages"], p["purged_messages"]) for p in progress] == [(chat_id, 10, 0)]
+
+    assert asyncio.run(purge_chats()) == 10
+    sql_db.expire_all()
+    assert sql_db.get(db_defs.Chat, chat_id) is None
+    assert sql_db.query(db_defs.Message).count() == 0
+    assert sql_client.get("/admin/purges", headers=admin).json() == []
+    assert sql_client.get(f"/chats/{chat_id}/changes?since=0", headers=headers).status_code == status.HTTP_410_GONE
+
+
+@pytest.mark.test_users([{}])
+def test_register_and_login_sql(sql_client, sql_users):
+    data = sql_client.post("/users/register?username=hi&password=secret&full_name=Hello&email=h%40h.h")
+    assert data.status_code == status.HTTP_200_OK
+    data = sql_client.post("/token", data={"username": "hi", "password": "secret"})
+    assert data.status_code == status.HTTP_200_OK
+    data = sql_client.get("/users/me/", headers={"Authorization": f"Bearer {data.json()['access_token']}"})
+    assert User(**data.json()) == User(username="hi", full_name="Hello", email="h@h.h", disabled=False)
+
+
+@pytest.mark.test_users([{}, {}])
+def test_invite_flow(sql_client, sql_users):
+    from app.main import create_access_token
+    owner, guest = [{"Authorization": f"Bearer {create_access_token({'sub': u['username']})}"} for u in sql_users]
+    chat_id = sql_client.post("/chats/", headers=owner).json()["id"]
+    invite = sql_client.post(f"/chats/{chat_id}/invite", headers=owner).json()["invite"]
+    assert sql_client.get(f"/chats/{chat_id}/invites", headers=owner).json() == [invite]
+    assert sql_client.get(f"/chats/{chat_id}/members", headers=guest).status_code == status.HTTP_403_FORBIDDEN
+
+    assert sql_client.get(f"/invite/{invite}", headers=guest).status_code == status.HTTP_200_OK
+    assert sql_client.get(f"/invite/{invite}", headers=guest).json()["detail"] == "Joined already"
+    assert [u["username"] for u in sql_client.get(f"/chats/{chat_id}/members", headers=guest).json()] == \
+           [u["username"] for u in sql_users]
+    sql_client.post(f"/chats/{chat_id}/messages?msg=hi", headers=guest)
+    chats = sql_client.get("/chats/?full=true", headers=owner).json()
+    assert [(c["id"], [m["content"] for m in c["messages"]]) for c in chats] == [(chat_id, ["hi"])]
+
+    assert sql_client.delete(f"/invite/{invite}", headers=guest).status_code == status.HTTP_200_OK
+    assert sql_client.get(f"/chats/{chat_id}/invites", headers=owner).json() == []
+    assert sql_client.delete(f"/chats/{chat_id}", headers=owner).status_code == status.HTTP_200_OK
+    assert sql_client.get("/chats/", headers=guest).json() == {"chats": [], "next_cursor": None}
+
+
+@pytest.mark.test_users([{}])
+def test_login_rehashes_outdated_hash(sql_client, sql_db, sql_users):
+    from app.main import db_defs
+    from auth import pwd_context
+    user = sql_db.get(db_defs.User, sql_users[0]["username"])
+    user.hashed_password = pwd_context.hash(sql_users[0]["password"], rounds=4)
+    sql_db.commit()
+    data = sql_client.post("/token", data={"username": user.username, "password": sql_users[0]["password"]})
+    assert data.status_code == status.HTTP_200_OK
+    sql_db.refresh(user)
+    assert not pwd_context.needs_update(user.hashed_password)
+    assert pwd_context.verify(sql_users[0]["password"], user.hashed_password)
+
+
+def test_hash_pool_rejects_when_saturated():
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from fastapi import HTTPException
+    from auth import HashPool
+    pool = HashPool(ThreadPoolExecutor(max_workers=1), workers=1, queue_size=1)
+    release = threading.Event()
+
+    async def saturate():
+        running = [asyncio.ensure_future(pool.run(release.wait)) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as rejected:
+            await pool.run(release.wait)
+        release.set()
+        await asyncio.gather(*running)
+        return rejected.value.status_code, pool.pending
+
+    assert asyncio.run(saturate()) == (status.HTTP_503_SERVICE_UNAVAILABLE, 0)
+
+
+@pytest.mark.test_users([{}])
+def test_token_cache(sql_client, sql_db, sql_users, sql_token):
+    from app.main import db_defs
+    from auth import token_cache
+    headers = {"Authorization": f"Bearer {sql_token}"}
+    stats = token_cache.stats()
+    assert sql_client.get("/users/me/", headers=headers).status_code == status.HTTP_200_OK
+    assert sql_client.get("/users/me/", headers=headers).status_code == status.HTTP_200_OK
+    assert token_cache.stats()["misses"] == stats["misses"] + 1
+    assert token_cache.stats()["hits"] == stats["hits"] + 1
+
+    # Only a committed change drops the user's tokens
+    sql_db.get(db_defs.User, sql_users[0]["username"]).full_name = "Rolled back"
+    sql_db.flush()
+    assert token_cache.get(sql_token) is not None
+    sql_db.rollback()
+    assert token_cache.get(sql_token) is not None
+    sql_db.get(db_defs.User, sql_users[0]["username"]).full_name = "Changed"
+    sql_db.flush()
+    assert token_cache.get(sql_token) is not None
+    sql_db.commit()
+    assert token_cache.get(sql_token) is None
+    assert sql_client.get("/users/me/", headers=headers).json()["full_name"] == "Changed"
+
+    sql_db.get(db_defs.User, sql_users[0]["username"]).disabled = True
+    sql_db.commit()
+    data = sql_client.get("/users/me/", headers=headers)
+    assert data.status_code == status.HTTP_400_BAD_REQUEST
+    assert data.json()["detail"] == "Inactive user"
+
+
+def test_token_cache_respects_expiry_and_size():
+    from auth import TokenCache
+    from defs import CurrentUser
+    cache = TokenCache(max_size=2, ttl=60)
+    cache.put("expired", CurrentUser(username="a"), time.time() - 1)
+    assert cache.get("expired") is None
+    for token in ("t1", "t2", "t3"):
+        cache.put(token, CurrentUser(username=token), time.time() + 60)
+    assert cache.get("t1") is None
+    assert cache.get("t3").username == "t3"
+    cache.invalidate_user("t3")
+    assert cache.get("t3") is None
+    assert cache.stats() == {"hits": 1, "misses": 3, "size": 1}
+
+
+@pytest.mark.test_users([{}, {}])
+def test_kick_member(sql_client, sql_chat, sql_token, sql_users):
+    headers = {"Authorization": f"Bearer {sql_token}"}
+    member = sql_users[1]["username"]
+    assert sql_client.delete(f"/chats/{sql_chat.id}/members/{member}", headers=headers).status_code == \
+           status.HTTP_200_OK
+    data = sql_client.delete(f"/chats/{sql_chat.id}/members/{member}", headers=headers)
+    assert data.status_code == status.HTTP_404_NOT_FOUND
+    assert data.json()["detail"] == "Member not found"
+    assert sql_client.get(f"/chats/{sql_chat.id}/members", headers=headers).json() == \
+           [{"username": sql_users[0]["username"]}]
+
+
+@pytest.mark.test_users([{}, {}])
+def test_get_chat_summaries(sql_client, sql_users):
+    from app.main import create_access_token
+    owner, guest = [{"Authorization": f"Bearer {create_access_token({'sub': u['username']})}"} for u in sql_users]
+    chat_ids = [sql_client.post("/chats/", headers=owner).json()["id"] for _ in range(3)]
+    invite = sql_client.post(f"/chats/{chat_ids[0]}/invite", headers=owner).json()["invite"]
+    sql_client.get(f"/invite/{invite}", headers=guest)
+    for msg in ("one", "two", "three"):
+        sql_client.post(f"/chats/{chat_ids[0]}/messages?msg={msg}", headers=owner)
+    sql_client.post(f"/chats/{chat_ids[0]}/messages?msg=reply", headers=guest)
+    sql_client.post(f"/chats/{chat_ids[0]}/messages?msg=four", headers=owner)
+
+    data = sql_client.get("/chats/?limit=2", headers=owner).json()
+    assert [(c["id"], c["member_count"], c["unread_count"]) for c in data["chats"]] == \
+           [(chat_ids[0], 2, 0), (chat_ids[1], 1, 0)]
+    assert data["chats"][0]["last_message"]["content"] == "four"
+    assert data["chats"][1]["last_message"] is None
+    assert data["next_cursor"] == chat_ids[1]
+    data = sql_client.get(f"/chats/?limit=2&after={data['next_cursor']}", headers=owner).json()
+    assert [c["id"] for c in data["chats"]] == [chat_ids[2]]
+    assert data["next_cursor"] is None
+
+    data = sql_client.get("/chats/", headers=guest).json()
+    assert [(c["id"], c["unread_count"]) for c in data["chats"]] == [(chat_ids[0], 1)]
+
+
+@pytest.mark.test_users([{}, {}, {}])
+def test_read_marker_and_unread_counts(sql_client, sql_users):
+    from app.main import create_access_token
+    owner, guest, stranger = [{"Authorization": f"Bearer {create_access_token({'sub': u['username']})}"}
+                              for u in sql_users]
+    chat_id = sql_client.post("/chats/", headers=owner).json()["id"]
+
+    def send(headers, msg):
+        sql_client.post(f"/chats/{chat_id}/messages?msg={msg}", headers=headers)
+        return sql_client.get(f"/chats/{chat_id}/messages", headers=headers).json()["messages"][-1]["id"]
+
+    def unread(headers):
+        return sql_client.get("/chats/", headers=headers).json()["chats"][0]["unread_count"]
+
+    first = send(owner, "one")
+    send(owner, "two")
+    invite = sql_client.post(f"/chats/{chat_id}/invite", headers=owner).json()["invite"]
+    sql_client.get(f"/invite/{invite}", headers=guest)
+    assert unread(guest) == 2
+    send(owner, "three")
+    assert (unread(owner), unread(guest)) == (0, 3)
+    # Sending marks everything before your own message as read
+    send(guest, "reply")
+    assert (unread(owner), unread(guest)) == (1, 0)
+    sql_client.post(f"/chats/{chat_id}/messages/bulk", data='[{"content": "a"}, {"content": "b"}]', headers=owner)
+    assert (unread(owner), unread(guest)) == (0, 2)
+    # Only those who hadn't read a deleted message lose it from their count
+    removed = send(owner, "oops")
+    assert sql_client.delete(f"/chats/{chat_id}/messages/{removed}", headers=owner).status_code == 200
+    assert (unread(owner), unread(guest)) == (0, 2)
+    fourth = send(owner, "four")
+    newest = send(owner, "five")
+    assert unread(guest) == 4
+
+    response = sql_client.post(f"/chats/{chat_id}/read?message_id={fourth}", headers=guest)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {"last_read_message_id": fourth, "unread_count": 1}
+    assert unread(guest) == 1
+    # The marker never moves back
+    assert sql_client.post(f"/chats/{chat_id}/read?message_id={first}", headers=guest).json() == \
+           {"last_read_message_id": fourth, "unread_count": 1}
+    assert sql_client.post(f"/chats/{chat_id}/read", headers=guest).json() == \
+           {"last_read_message_id": newest, "unread_count": 0}
+    assert unread(guest) == 0
+    assert sql_client.post(f"/chats/{chat_id}/read", headers=stranger).status_code == status.HTTP_403_FORBIDDEN
+
+
+@pytest.mark.test_users([{}, {}])
+@pytest.mark.parametrize("path, budget", [
+    ("/chats/{chat_id}/messages", 3),
+    ("/chats/{chat_id}/changes", 3),
+    ("/chats/{chat_id}/members", 3),
+    ("/chats/", 3),
+    ("/chats/?full=true", 3),
+])
+def test_query_budget(sql_client, sql_engine, sql_db, sql_chat, sql_token, path, budget):
+    # The statement count must not grow with the number of messages, members or chats
+    from app.main import db_defs
+    headers = {"Authorization": f"Bearer {sql_token}"}
+    path = path.format(chat_id=sql_chat.id)
+    sql_client.get("/users/me/", headers=headers)
+    with assert_query_budget(sql_engine, budget):
+        assert sql_client.get(path, headers=headers).status_code == 200
+    author = sql_db.get(db_defs.User, sql_chat.messages[0].author_id)
+    for _ in range(3):
+        chat = db_defs.Chat(members=[author])
+        chat.messages.extend(db_defs.Message(content=str(i), author=author, timestamp=i) for i in range(5))
+        sql_db.add(chat)
+    sql_chat.messages.extend(db_defs.Message(content=str(i), author=author, timestamp=i) for i in range(20))
+    sql_db.commit()
+    # Touching the user's chats invalidated the cached token, load it again outside the measured request
+    sql_client.get("/users/me/", headers=headers)
+    with assert_query_budget(sql_engine, budget):
+        assert sql_client.get(path, headers=headers).status_code == 200
+
+
+def test_sqlite_engine_pragmas(tmp_path):
+    from sqlalchemy import create_engine, text
+    from db import configure_engine, engine_options, DB_URL
+    engine = configure_engine(create_engine(f"sqlite:///{tmp_path / 'test.db'}", **engine_options(DB_URL)))
+    with engine.connect() as connection:
+        assert connection.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert connection.execute(text("PRAGMA synchronous")).scalar() == 1
+        assert connection.execute(text("PRAGMA busy_timeout")).scalar() == 5000
+        assert connection.execute(text("PRAGMA foreign_keys")).scalar() == 1
+    engine.dispose()
+
+
+def test_delete_chat_cascades_in_database(tmp_path):
+    from sqlalchemy import create_engine, delete, func, select
+    from sqlalchemy.orm import Session
+    from app.main import db_defs
+    from db import configure_engine, engine_options, DB_URL
+    engine = configure_engine(create_engine(f"sqlite:///{tmp_path / 'test.db'}", **engine_options(DB_URL)))
+    db_defs.Base.metadata.create_all(bind=engine)
+    with Session(engine) as session:
+        session.add(db_defs.User(username="a", full_name="A", email="a@a.a", hashed_password="", disabled=False))
+        chat = db_defs.Chat(members=[session.get(db_defs.User, "a")], invites=[db_defs.Invite(id="invite")])
+        chat.messages = [db_defs.Message(content=str(i), author_id="a", timestamp=i) for i in range(3)]
+        session.add(chat)
+        session.commit()
+        session.execute(delete(db_defs.Chat))
+        session.commit()
+        for table in (db_defs.Message, db_defs.Invite, db_defs.chat_association_table):
+            assert session.scalar(select(func.count()).select_from(table)) == 0
+    engine.dispose()
+
+
+@pytest.mark.test_users([{}, {}])
+def test_send_message_write_behind(sql_db, sql_chat, sql_token, monkeypatch):
+    import httpx
+    from sqlalchemy import select
+    from app import main
+    from app.main import db_defs
+    batches = []
+
+    async def write_message_batch(new_messages):
+        batches.append(len(new_messages))
+        async for result in main.write_message_batch(new_messages):
+            yield result
+
+    monkeypatch.setattr(main, "WRITE_BEHIND", True)
+    monkeypatch.setattr(main, "message_writer", main.BatchWriter(write_message_batch, batch_size=8))
+    headers = {"Authorization": f"Bearer {sql_token}"}
+
+    async def send_burst():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as http:
+            responses = await asyncio.gather(*(
+                http.post(f"/chats/{sql_chat.id}/messages", params={"msg": f"burst {i}"}, headers=headers)
+                for i in range(20)
+            ))
+            await main.message_writer.close()
+            page = await http.get(f"/chats/{sql_chat.id}/messages?limit=20", headers=headers)
+        return [response.status_code for response in responses], page.json()["messages"]
+
+    codes, messages = asyncio.run(send_burst())
+    assert codes == [status.HTTP_200_OK] * 20
+    assert sorted(m["content"] for m in messages) == sorted(f"burst {i}" for i in range(20))
+    assert sum(batches) == 20 and len(batches) < 20 and max(batches) <= 8
+    versions = sql_db.scalars(select(db_defs.Message.version).filter_by(chat_id=sql_chat.id)).all()
+    assert sorted(versions)[10:] == list(range(1, 21))
+
+
+@pytest.mark.test_users([{}, {}])
+def test_write_message_batch_fails_only_gone_senders(sql_db, sql_chat, sql_users):
+    # Messages queued before their chat was deleted or their author kicked fail on their own, the rest is written
+    from sqlalchemy import delete, select
+    from app import main
+    from app.main import db_defs
+    first, second = (user["username"] for user in sql_users)
+    members = db_defs.chat_association_table.c
+    sql_db.execute(delete(db_defs.chat_association_table).filter(members.chat_id == sql_chat.id,
+                                                                members.user_id == second))
+    sql_db.commit()
+    new_messages = [(sql_chat.id, first, "kept", 1, None), (sql_chat.id, second, "kicked", 2, None),
+                    (sql_chat.id + 1, first, "deleted", 3, None)]
+
+    async def write():
+        return {i: result async for i, result in main.write_message_batch(new_messages)}
+
+    results = asyncio.run(write())
+    assert results[0].content == "kept"
+    assert [(results[i].status_code, results[i].detail) for i in (1, 2)] == \
+        [(status.HTTP_403_FORBIDDEN, "Not allowed to send in chat"), (status.HTTP_404_NOT_FOUND, "Chat not found")]
+    assert sql_db.scalars(select(db_defs.Message.content).filter_by(chat_id=sql_chat.id)
+                          .order_by(db_defs.Message.id.desc())).first() == "kept"
+
+
+def test_batch_writer_rejects_when_full():
+    from fastapi import HTTPException
+    from writer import BatchWriter
+    release = asyncio.Event()
+
+    async def write_batch(items):
+        await release.wait()
+        for i, item in enumerate(items):
+            yield i, item
+
+    async def saturate():
+        writer = BatchWriter(write_batch, batch_size=1, batch_delay=0, queue_size=1)
+        # One item is being written, the next one fills the queue
+        running = []
+        for i in range(2):
+            running.append(asyncio.ensure_future(writer.submit(i)))
+            await asyncio.sleep(0.01)
+        with pytest.raises(HTTPException) as rejected:
+            await writer.submit(2)
+        release.set()
+        results = await asyncio.gather(*running)
+        await writer.close()
+        return rejected.value.status_code, results
+
+    assert asyncio.run(saturate()) == (status.HTTP_503_SERVICE_UNAVAILABLE, [0, 1])
+
+
+@pytest.mark.parametrize("content_type, body", [
+    ("application/json", '[{"content": "a"}, {"content": "b", "timestamp": 5}, {"text": "c"}, 12, {"content": "d"}]'),
+    ("application/x-ndjson", '{"content": "a"}\n{"content": "b", "timestamp": 5}\n{"text": "c"}\n12\n{"content": "d"}'),
+])
+def test_send_messages_bulk(sql_client, sql_chat, sql_token, content_type, body, monkeypatch):
+    from app import main
+    # Every chunk is its own INSERT and commit
+    monkeypatch.setattr(main, "BULK_CHUNK_SIZE", 2)
+    headers = {"Authorization": f"Bearer {sql_token}", "Content-Type": content_type}
+    response = sql_client.post(f"/chats/{sql_chat.id}/messages/bulk", data=body, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    results = [json.loads(line) for line in response.text.splitlines()]
+    assert [r["index"] for r in results] == [0, 1, 2, 3, 4]
+    assert results[2]["error"] == "content: field required" and "error" in results[3]
+    ids = [results[i]["id"] for i in (0, 1, 4)]
+    messages = sql_client.get(f"/chats/{sql_chat.id}/messages?after={ids[0] - 1}", headers=headers).json()["messages"]
+    assert [(m["id"], m["content"]) for m in messages] == list(zip(ids, "abd"))
+    assert messages[1]["timestamp"] == "5"
+
+
+def test_send_messages_bulk_rejects_broken_upload(sql_client, sql_chat, sql_token):
+    headers = {"Authorization": f"Bearer {sql_token}"}
+    response = sql_client.post(f"/chats/{sql_chat.id}/messages/bulk", data='[{"content": "a"}, {"content": ',
+                               headers=headers)
+    assert [json.loads(line) for line in response.text.splitlines()][-1] == \
+           {"index": 1, "error": "Unterminated JSON array"}
+    for body in ("]", " ,]", ',[{"content": "a"}]'):
+        response = sql_client.post(f"/chats/{sql_chat.id}/messages/bulk", data=body, headers=headers)
+        assert [json.loads(line) for line in response.text.splitlines()] == \
+               [{"index": 0, "error": "Expected a JSON array"}]
+    for body, error in (('[{"content": "a"} {"content": "b"}]', "Expected ',' or ']' after an item"),
+                        ('[{"content": "a"}, {"content": tru}, {"content": "c"}]', "Invalid JSON: Expecting value"),
+                        ('[{"content": "a"},, {"content": "c"}]', "Invalid JSON: Expecting value"),
+                        ('[{"content": "a"},]', "Expected an item after ','")):
+        response = sql_client.post(f"/chats/{sql_chat.id}/messages/bulk", data=body, headers=headers)
+        results = [json.loads(line) for line in response.text.splitlines()]
+        assert "id" in results[0] and results[1:] == [{"index": 1, "error": error}]
+    assert sql_client.post(f"/chats/{sql_chat.id}/messages/bulk", data="[]", headers=headers).text == ""
+    response = sql_client.post(f"/chats/{sql_chat.id}/messages/bulk", data="[]", headers={})
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+def test_iter_bulk_items_does_not_depend_on_chunks():
+    from bulk import BulkUploadError, iter_bulk_items
+
+    async def parse(body: bytes, size: int):
+        async def chunks():
+            for i in range(0, len(body), size):
+                yield body[i:i + size]
+
+        items = []
+        try:
+            async for item in iter_bulk_items(chunks(), ndjson=False):
+                items.append(item)
+        except BulkUploadError as e:
+            items.append(str(e))
+        return items
+
+    for body, expected in (
+        ('[{"a": "\\u00e9\\ud83d\\ude00", "b": [true, null, -1.5e+3]}, "s", false, -12.5E-3, 7]',
+         [{"a": "\u00e9\U0001f600", "b": [True, None, -1500.0]}, "s", False, -0.0125, 7]),
+        ("[1 2]", [1, "Expected ',' or ']' after an item"]),
+        ('[{"a": 1 "b": 2}, 3]', ["Invalid JSON: Expecting ',' delimiter"]),
+        ("[1] 2", [1, "Unexpected data after the JSON array"]),
+        ("[1, 2", [1, "Unterminated JSON array"]),
+    ):
+        for size in (1, 2, 3, 5, len(body)):
+            assert asyncio.run(parse(body.encode(), size)) == expected, (body, size)
+
+
+@pytest.mark.test_users([{}, {}])
+def test_search_messages(sql_client, sql_users):
+    from app.main import create_access_token
+    owner, guest = [{"Authorization": f"Bearer {create_access_token({'sub': u['username']})}"} for u in sql_users]
+    shared, private = [sql_client.post("/chats/", headers=owner).json()["id"] for _ in range(2)]
+    invite = sql_client.post(f"/chats/{shared}/invite", headers=owner).json()["invite"]
+    sql_client.get(f"/invite/{invite}", headers=guest)
+    for msg in ("deploy the app", "app app app", "lunch?", "the app is down"):
+        sql_client.post(f"/chats/{shared}/messages?msg={msg}", headers=owner)
+    sql_client.post(f"/chats/{private}/messages?msg=secret app", headers=owner)
+
+    data = sql_client.get(f"/chats/{shared}/search?q=app&limit=2", headers=guest).json()
+    assert [r["message"]["content"] for r in data["results"]][0] == "app app app"
+    assert data["results"][0]["highlight"] == "<mark>app</mark> <mark>app</mark> <mark>app</mark>"
+    rest = sql_client.get(f"/chats/{shared}/search?q=app&limit=2&cursor={data['next_cursor']}", headers=guest).json()
+    assert rest["next_cursor"] is None
+    assert sorted(r["message"]["content"] for r in data["results"] + rest["results"]) == \
+           ["app app app", "deploy the app", "the app is down"]
+
+    assert sql_client.get(f"/chats/{shared}/search?q=app&cursor=-1", headers=guest).status_code == \
+           status.HTTP_400_BAD_REQUEST
+    assert sql_client.get(f"/chats/{private}/search?q=app", headers=guest).status_code == status.HTTP_403_FORBIDDEN
+    assert len(sql_client.get("/search?q=app", headers=guest).json()["results"]) == 3
+    assert len(sql_client.get("/search?q=app", headers=owner).json()["results"]) == 4
+    # Query syntax is taken literally
+    assert len(sql_client.get('/search?q=the "app', headers=owner).json()["results"]) == 2
+    assert sql_client.get('/search?q=app OR NEAR(', headers=owner).json()["results"] == []
+
+    # Messages sent between pages change every rank, pages still neither repeat nor skip results
+    for _ in range(6):
+        sql_client.post(f"/chats/{private}/messages?msg=hello there", headers=owner)
+    found, cursor = [], None
+    while True:
+        page = sql_client.get(f"/chats/{private}/search", params={"q": "hello", "limit": 2, "cursor": cursor},
+                              headers=owner).json()
+        found += [result["message"]["id"] for result in page["results"]]
+        if page["next_cursor"] is None:
+            break
+        cursor = page["next_cursor"]
+        sql_client.post(f"/chats/{private}/messages?msg=something else entirely", headers=owner)
+    assert len(found) == len(set(found)) == 6
+
+    # The index follows edits and deletes
+    lunch = sql_client.get(f"/chats/{shared}/search?q=lunch", headers=owner).json()["results"][0]["message"]["id"]
+    sql_client.post(f"/chats/{shared}/messages/{lunch}?message=dinner", headers=owner)
+    assert sql_client.get(f"/chats/{shared}/search?q=lunch", headers=owner).json()["results"] == []
+    assert len(sql_client.get(f"/chats/{shared}/search?q=dinner", headers=owner).json()["results"]) == 1
+    sql_client.delete(f"/chats/{shared}/messages/{lunch}", headers=owner)
+    assert sql_client.get(f"/chats/{shared}/search?q=dinner", headers=owner).json()["results"] == []
+
+    # Contents are HTML escaped, only the marks are markup
+    sql_client.post(f"/chats/{private}/messages", params={"msg": "<img src=x onerror=alert(1)> & dinner"},
+                    headers=owner)
+    sql_client.post(f"/chats/{private}/messages", params={"msg": "\x02supper\x03 <b>"}, headers=owner)
+    results = sql_client.get(f"/chats/{private}/search?q=dinner", headers=owner).json()["results"]
+    assert [r["highlight"] for r in results] == ["&lt;img src=x onerror=alert(1)&gt; &amp; <mark>dinner</mark>"]
+    results = sql_client.get(f"/chats/{private}/search?q=supper", headers=owner).json()["results"]
+    assert [r["highlight"] for r in results] == ["\x02supper\x03 &lt;b&gt;"]
+
+
+def test_search_index_added_to_existing_database(tmp_path):
+    from sqlalchemy import create_engine, text
+    from app.main import db_defs
+    from search import create_search_index
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}", future=True)
+    with engine.begin() as connection:
+        db_defs.Base.metadata.create_all(bind=connection)
+        connection.execute(text("DROP TABLE messages_fts"))
+        connection.execute(text("DROP TRIGGER messages_fts_insert"))
+        connection.execute(db_defs.Message.__table__.insert(), [{"content": "old news", "chat_id": 1, "timestamp": 0}])
+        create_search_index(connection)
+        matches = connection.execute(text("SELECT rowid FROM messages_fts WHERE messages_fts MATCH 'news'")).all()
+        assert matches == [(1,)]
+
+
+def test_search_index_upgraded_for_compressed_messages(tmp_path):
+    from sqlalchemy import create_engine, text
+    from app.main import db_defs
+    from search import create_search_index
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}", future=True)
+    with engine.begin() as connection:
+        db_defs.Base.metadata.create_all(bind=connection)
+        # The index as it was before contents were compressed
+        for name in ("messages_fts_insert", "messages_fts_delete", "messages_fts_update"):
+            connection.execute(text(f"DROP TRIGGER {name}"))
+        connection.execute(text("DROP TABLE messages_fts"))
+        connection.execute(text("CREATE VIRTUAL TABLE messages_fts USING fts5(content, content='messages', "
+                                "content_rowid='id')"))
+        connection.execute(db_defs.Message.__table__.insert(), [{"content": "old news " * 200, "chat_id": 1,
+                                                                 "timestamp": 0}])
+        create_search_index(connection)
+        assert "messages_text" in connection.execute(text("SELECT sql FROM sqlite_master "
+                                                          "WHERE name = 'messages_fts'")).scalar()
+        matches = connection.execute(text("SELECT rowid FROM messages_fts WHERE messages_fts MATCH 'news'")).all()
+        assert matches == [(1,)]
+
+
+def test_add_missing_columns(tmp_path):
+    # A database from before the columns were added gets them on startup, its rows take on the defaults
+    from sqlalchemy import create_engine, inspect, select, text
+    from sqlalchemy.orm import Session
+    import db
+    from app.main import db_defs
+    from search import create_search_index
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}", future=True)
+    with engine.begin() as connection:
+        for statement in (
+            "CREATE TABLE users (username VARCHAR(30) NOT NULL PRIMARY KEY, full_name VARCHAR NOT NULL, "
+            "email VARCHAR NOT NULL, hashed_password VARCHAR NOT NULL, disabled BOOLEAN NOT NULL)",
+            "CREATE TABLE chats (id INTEGER NOT NULL PRIMARY KEY)",
+            "CREATE TABLE messages (id INTEGER NOT NULL PRIMARY KEY, content VARCHAR NOT NULL, "
+            "timestamp BIGINT NOT NULL, edited BOOLEAN NOT NULL, author_id INTEGER REFERENCES users (username), "
+            "chat_id INTEGER NOT NULL REFERENCES chats (id))",
+            "CREATE TABLE chat_association (user_id VARCHAR(30) REFERENCES users (username), "
+            "chat_id INTEGER REFERENCES chats (id))",
+            "CREATE TABLE tombstones (id INTEGER NOT NULL PRIMARY KEY, chat_id INTEGER NOT NULL, message_id INTEGER, "
+            "version INTEGER NOT NULL)",
+            "INSERT INTO users VALUES ('a', 'A', 'a@a.a', 'x', 0)",
+            "INSERT INTO chats VALUES (1)",
+            "INSERT INTO chat_association VALUES ('a', 1)",
+            "INSERT INTO messages VALUES (1, 'hello', 0, 0, 'a', 1)",
+            "INSERT INTO tombstones VALUES (1, 2, NULL, 1)",
+        ):
+            connection.execute(text(statement))
+    # Startup runs it every time
+    for _ in range(2):
+        db_defs.Base.metadata.create_all(bind=engine)
+        with engine.begin() as connection:
+            db.add_missing_columns(connection, db_defs.Base.metadata.sorted_tables)
+            create_search_index(connection)
+
+    inspector = inspect(engine)
+    for table in db_defs.Base.metadata.sorted_tables:
+        assert {column["name"] for column in inspector.get_columns(table.name)} == set(table.columns.keys())
+        assert {index.name for index in table.indexes} <= {index["name"] for index in inspector.get_indexes(table.name)}
+    members = db_defs.chat_association_table.c
+    with Session(engine) as session:
+        chat = session.get(db_defs.Chat, 1)
+        assert (chat.version, chat.archived_upto, chat.deleted_at, chat.retention_max_count) == (0, 0, None, None)
+        message = session.get(db_defs.Message, 1)
+        assert (message.content, message.version, message.attachments) == ("hello", 0, None)
+        assert session.execute(select(members.last_read_message_id, members.unread_count)).one() == (None, 0)
+        assert session.get(db_defs.Tombstone, 1).members is None
+    engine.dispose()
+
+
+def test_raw_connections_write_compressed_messages(tmp_path):
+    # The search index triggers call message_text(), every plain sqlite3 connection of the app registers it
+    import sqlite3
+    from sqlalchemy import create_engine
+    import compression
+    import shards
+    from app.main import db_defs
+    path = str(tmp_path / "test.db")
+    engine = create_engine(f"sqlite:///{path}", future=True)
+    db_defs.Base.metadata.create_all(bind=engine)
+    engine.dispose()
+    insert = "INSERT INTO messages (content, chat_id, timestamp, edited, version) VALUES (?, 1, 0, 0, 0)"
+
+    def matches(connection, word):
+        return [rowid for rowid, in connection.execute("SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?",
+                                                       (word,))]
+
+    for i, connect in enumerate((shards.connect, compression.connect)):
+        connection = connect(path)
+        with connection:
+            message_id = connection.execute(insert, (compression.compress(f"first{i} " * 500),)).lastrowid
+            assert isinstance(connection.execute("SELECT content FROM messages WHERE id = ?", (message_id,))
+                              .fetchone()[0], bytes)
+            assert matches(connection, f"first{i}") == [message_id]
+            connection.execute("UPDATE messages SET content = ? WHERE id = ?",
+                               (compression.compress(f"second{i} " * 500), message_id))
+            assert (matches(connection, f"first{i}"), matches(connection, f"second{i}")) == ([], [message_id])
+            connection.execute("DELETE FROM messages WHERE id = ?", (message_id,))
+            assert matches(connection, f"second{i}") == []
+        connection.close()
+    # Without the function only writing fails, reading works
+    connection = sqlite3.connect(path)
+    assert connection.execute("SELECT count(*) FROM messages").fetchone() == (0,)
+    with pytest.raises(sqlite3.OperationalError, match="no such function: message_text"):
+        connection.execute(insert, ("text",))
+    connection.close()
+
+
+@pytest.mark.test_users([{}])
+def test_message_compression(sql_client, sql_db, sql_chat, sql_token):
+    from sqlalchemy import select, text
+    from app.main import db_defs
+    from compression import MESSAGE_COMPRESSION_THRESHOLD
+    from retention import ARCHIVE_COLUMNS, pack, unpack
+    headers = {"Authorization": f"Bearer {sql_token}"}
+    log = "".join(f"2024-01-01T00:00:{i % 60:02d} worker-{i % 4} GET /api/items/{i} 200 {i % 97}ms\n"
+                  for i in range(100))
+    assert len(log) > MESSAGE_COMPRESSION_THRESHOLD
+    path = f"/chats/{sql_chat.id}/messages"
+    sql_client.post(path, params={"msg": log + "needle"}, headers=headers)
+    sql_client.post(path, params={"msg": "short"}, headers=headers)
+    long_id, short_id = [message["id"] for message in sql_client.get(path, headers=headers).json()["messages"][-2:]]
+
+    def stored(message_id):
+        return sql_db.execute(text("SELECT typeof(content), length(content), content FROM messages WHERE id = :id"),
+                              {"id": message_id}).one()
+
+    kind, size, content = stored(long_id)
+    assert kind == "blob" and content[0] == 1 and size < len(log) / 4
+    assert stored(short_id)[0] == "text"
+    assert sql_client.get(path, headers=headers).json()["messages"][-2]["content"] == log + "needle"
+    search = f"/chats/{sql_chat.id}/search"
+    results = sql_client.get(search, params={"q": "needle"}, headers=headers).json()["results"]
+    assert [result["message"]["id"] for result in results] == [long_id]
+    assert results[0]["message"]["content"] == log + "needle" and "<mark>needle</mark>" in results[0]["highlight"]
+
+    sql_client.post(f"{path}/{long_id}", params={"message": log + "haystack"}, headers=headers)
+    assert sql_client.get(search, params={"q": "needle"}, headers=headers).json()["results"] == []
+    assert len(sql_client.get(search, params={"q": "haystack"}, headers=headers).json()["results"]) == 1
+    # Archive blocks hold the text
+    row = sql_db.execute(select(*ARCHIVE_COLUMNS).filter(db_defs.Message.id == long_id)).one()
+    assert unpack(pack([row]))[0].content == log + "haystack"
+
+
+def test_compress_stored_messages(tmp_path):
+    from sqlalchemy import create_engine, text
+    from sqlalchemy.orm import Session
+    from app.main import db_defs
+    from compression import compress_stored, decompress
+    from db import ThreadedSession
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}", future=True,
+                           connect_args={"check_same_thread": False})
+    db_defs.Base.metadata.create_all(bind=engine)
+    contents = [f"line {i} of a pasted stack trace\n" * (i * 10) + f"marker{i}" for i in range(12)]
+    with engine.begin() as connection:
+        # Stored before compression was turned on
+        connection.execute(text("INSERT INTO messages (content, chat_id, timestamp, edited, version) "
+                                "VALUES (:content, 1, 0, 0, 0)"), [{"content": content} for content in contents])
+
+    async def compress():
+        db = ThreadedSession(Session(engine))
+        try:
+            return await compress_stored(db, pause=0, batch_size=5)
+        finally:
+            await db.close()
+
+    rewritten, before, after = asyncio.run(compress())
+    with engine.connect() as connection:
+        rows = connection.execute(text("SELECT typeof(content), content FROM messages ORDER BY id")).all()
+        assert [decompress(content) for _, content in rows] == contents
+        assert rewritten == sum(kind == "blob" for kind, _ in rows) > 0 and after < before / 4
+        assert [kind for kind, _ in rows] == ["text" if len(content) < 1024 else "blob" for content in contents]
+        for i in (3, 11):
+            assert connection.execute(text(f"SELECT rowid FROM messages_fts WHERE messages_fts MATCH 'marker{i}'"))\
+                       .all() == [(i + 1,)]
+    assert asyncio.run(compress())[0] == 0
+    engine.dispose()
+
+
+@pytest.mark.test_users([{}, {}])
+@pytest.mark.parametrize("path", ["messages", "members", "invites"])
+def test_conditional_get(sql_client, sql_engine, sql_chat, sql_users, sql_token, path):
+    from app.main import create_access_token
+    headers = {"Authorization": f"Bearer {sql_token}"}
+    url = f"/chats/{sql_chat.id}/{path}"
+    response = sql_client.get(url, headers=headers)
+    etag = response.headers["ETag"]
+    # Only the version is read, membership is still checked before answering
+    with assert_query_budget(sql_engine, 2):
+        response = sql_client.get(url, headers={**headers, "If-None-Match": etag})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED and response.content == b""
+    assert response.headers["ETag"] == etag
+    other = {"Authorization": f"Bearer {create_access_token({'sub': sql_users[1]['username']})}"}
+    assert sql_client.get(url, headers={**other, "If-None-Match": etag}).status_code == status.HTTP_304_NOT_MODIFIED
+
+    for change in (
+        lambda: sql_client.post(f"/chats/{sql_chat.id}/messages?msg=new", headers=headers),
+        lambda: sql_client.post(f"/chats/{sql_chat.id}/messages/1?message=edited", headers=headers),
+        lambda: sql_client.delete(f"/chats/{sql_chat.id}/messages/2", headers=headers),
+        lambda: sql_client.post(f"/chats/{sql_chat.id}/invite", headers=headers),
+        lambda: sql_client.delete(f"/invite/{sql_client.get(f'/chats/{sql_chat.id}/invites', headers=headers).json()[0]}",
+                                  headers=headers),
+        lambda: sql_client.delete(f"/chats/{sql_chat.id}/members/{sql_users[1]['username']}", headers=headers),
+    ):
+        assert change().status_code == status.HTTP_200_OK
+        response = sql_client.get(url, headers={**headers, "If-None-Match": etag})
+        assert response.status_code == status.HTTP_200_OK and response.headers["ETag"] != etag
+        etag = response.headers["ETag"]
+    invite = sql_client.post(f"/chats/{sql_chat.id}/invite", headers=headers).json()["invite"]
+    etag = sql_client.get(url, headers=headers).headers["ETag"]
+    assert sql_client.get(f"/invite/{invite}", headers=other).status_code == status.HTTP_200_OK
+    assert sql_client.get(url, headers={**headers, "If-None-Match": etag}).status_code == status.HTTP_200_OK
+
+
+@pytest.mark.parametrize("export_format", ["json", "ndjson"])
+def test_export_messages(sql_client, sql_chat, sql_token, export_format, monkeypatch):
+    from app import main
+    monkeypatch.setattr(main, "EXPORT_PAGE_SIZE", 3)
+    headers = {"Authorization": f"Bearer {sql_token}"}
+    response = sql_client.get(f"/chats/{sql_chat.id}/messages/export?format={export_format}", headers=headers)
+    if export_format == "json":
+        exported = response.json()
+    else:
+        exported = [json.loads(line) for line in response.text.splitlines()]
+    page = sql_client.get(f"/chats/{sql_chat.id}/messages", headers=headers).json()["messages"]
+    assert exported == page and len(exported) == 10
+    assert page[0] == {"id": page[0]["id"], "content": "0", "timestamp": "0", "edited": False,
+                       "author": {"username": "test0"}, "attachments": []}
+
+
+@pytest.mark.test_users([{}, {}, {}])
+def test_attachments(sql_client, sql_users, tmp_path, monkeypatch):
+    import hashlib
+    import os
+    import random
+    from app import main
+    from app.main import create_access_token
+    monkeypatch.chdir(tmp_path)
+    owner, guest, stranger = [{"Authorization": f"Bearer {create_access_token({'sub': u['username']})}"}
+                              for u in sql_users]
+    chat_id, other_chat_id = [sql_client.post("/chats/", headers=owner).json()["id"] for _ in range(2)]
+    invite = sql_client.post(f"/chats/{chat_id}/invite", headers=owner).json()["invite"]
+    sql_client.get(f"/invite/{invite}", headers=guest)
+    data = random.Random(0).getrandbits(700 * 1024 * 8).to_bytes(700 * 1024, "little")
+    digest = hashlib.sha256(data).hexdigest()
+
+    def upload(headers, body=data, chat=chat_id, filename="report.bin"):
+        return sql_client.post(f"/chats/{chat}/attachments?filename={filename}", data=body,
+                               headers={**headers, "Content-Type": "application/octet-stream"})
+
+    response = upload(owner)
+    assert response.status_code == status.HTTP_200_OK
+    attachment = response.json()
+    assert attachment == {"id": attachment["id"], "filename": "report.bin", "content_type": "application/octet-stream",
+                          "size": len(data)}
+    # The same content is stored once
+    again = upload(owner, filename="copy.bin").json()
+    other = upload(owner, chat=other_chat_id).json()
+    assert len({attachment["id"], again["id"], other["id"]}) == 3
+    stored = [os.path.join(root, name) for root, _, names in os.walk("attachments") for name in names]
+    assert stored == [os.path.join("attachments", digest[:2], digest[2:4], digest)]
+    assert upload(stranger).status_code == status.HTTP_403_FORBIDDEN
+    monkeypatch.setattr(main, "ATTACHMENT_MAX_SIZE", 1000)
+    assert upload(owner).status_code == status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    assert os.listdir(os.path.join("attachments", "tmp")) == []
+
+    response = sql_client.post(f"/chats/{chat_id}/messages", params=[("msg", "see"), ("attachment", again["id"]),
+                                                                     ("attachment", attachment["id"])], headers=owner)
+    assert response.status_code == status.HTTP_200_OK
+    message = sql_client.get(f"/chats/{chat_id}/messages", headers=guest).json()["messages"][-1]
+    assert message["attachments"] == [again, attachment]
+    # Only your own uploads into the same chat can be attached
+    for headers, attachment_id in ((guest, attachment["id"]), (owner, other["id"]), (owner, 10 ** 9)):
+        response = sql_client.post(f"/chats/{chat_id}/messages?msg=x&attachment={attachment_id}", headers=headers)
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    url = f"/chats/{chat_id}/attachments/{attachment['id']}"
+    response = sql_client.get(url, headers=guest)
+    assert response.status_code == status.HTTP_200_OK and response.content == data
+    assert response.headers["etag"] == f'"{digest}"' and response.headers["accept-ranges"] == "bytes"
+    assert response.headers["content-disposition"] == "attachment; filename*=utf-8''report.bin"
+    response = sql_client.get(url, headers={**guest, "Range": "bytes=300000-300009"})
+    assert response.status_code == status.HTTP_206_PARTIAL_CONTENT and response.content == data[300000:300010]
+    assert response.headers["content-range"] == f"bytes 300000-300009/{len(data)}"
+    response = sql_client.get(url, headers={**guest, "Range": "bytes=-5"})
+    assert response.status_code == status.HTTP_206_PARTIAL_CONTENT and response.content == data[-5:]
+    response = sql_client.get(url, headers={**guest, "Range": f"bytes={len(data)}-"})
+    assert response.status_code == status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+    assert response.headers["content-range"] == f"bytes */{len(data)}"
+    response = sql_client.get(url, headers={**guest, "Range": "bytes=0-9", "If-Range": '"outdated"'})
+    assert response.status_code == status.HTTP_200_OK and response.content == data
+    response = sql_client.get(url, headers={**guest, "If-None-Match": f'"{digest}"'})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED and response.content == b""
+
+    assert sql_client.get(url, headers=stranger).status_code == status.HTTP_403_FORBIDDEN
+    response = sql_client.get(f"/chats/{chat_id}/attachments/{other['id']}", headers=owner)
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_attachment_zero_copy_send(tmp_path):
+    from attachments import AttachmentResponse, parse_range, RangeNotSatisfiable
+    path = tmp_path / "blob"
+    path.write_bytes(b"0123456789")
+    assert parse_range("bytes=2-", 10) == (2, 9) and parse_range("bytes=8-20", 10) == (8, 9)
+    assert parse_range("bytes=0-1,4-5", 10) is None and parse_range("items=0-1", 10) is None
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range("bytes=-3", 0)
+
+    async def serve(extensions, method="GET"):
+        messages = []
+
+        async def send(message):
+            if message["type"] == "http.response.zerocopysend":
+                message = {**message, "file": message["file"].read()}
+            messages.append(message)
+
+        response = AttachmentResponse(str(path), 10, "abc", "text/plain", "a.txt", {"range": "bytes=3-5"}, method)
+        await response({"type": "http", "extensions": extensions}, None, send)
+        return messages
+
+    start, body = asyncio.run(serve({"http.response.zerocopysend": {}}))
+    assert start["status"] == 206 and (b"content-range", b"bytes 3-5/10") in start["headers"]
+    # The server seeks to the offset itself
+    assert body == {"type": "http.response.zerocopysend", "file": b"0123456789", "offset": 3, "count": 3}
+    start, body = asyncio.run(serve({}))
+    assert body == {"type": "http.response.body", "body": b"345", "more_body": False}
+    start, body = asyncio.run(serve({}, "HEAD"))
+    assert (b"content-length", b"3") in start["headers"] and body == {"type": "http.response.body", "body": b""}
+
+
+@pytest.mark.test_users([{}])
+def test_metrics(sql_client, sql_engine, sql_chat, sql_token, sql_users):
+    import re
+    from metrics import instrument_engine
+    instrument_engine(getattr(sql_engine, "sync_engine", sql_engine))
+    headers = {"Authorization": f"Bearer {sql_token}"}
+
+    def sample(text, name, **labels):
+        pattern = re.escape(name + "{" + ",".join(f'{k}="{v}"' for k, v in labels.items())) + r"[,}].* (\S+)"
+        values = re.findall("^" + pattern + "$", text, re.MULTILINE)
+        return float(values[0]) if values else 0
+
+    sql_client.get("/users/me/", headers=headers)
+    # Users' tokens don't open it
+    assert sql_client.get("/metrics").status_code == status.HTTP_401_UNAUTHORIZED
+    assert sql_client.get("/metrics", headers=headers).status_code == status.HTTP_401_UNAUTHORIZED
+    scraper = {"Authorization": "Bearer metrics-test-token"}
+    before = sql_client.get("/metrics", headers=scraper).text
+    for _ in range(3):
+        sql_client.get(f"/chats/{sql_chat.id}/messages", headers=headers)
+    sql_client.post("/token", data={"username": sql_users[0]["username"], "password": sql_users[0]["password"]})
+    after = sql_client.get("/metrics", headers=scraper).text
+
+    route = {"method": "GET", "route": "/chats/{chat_id}/messages"}
+    assert sample(after, "chatapp_http_requests_total", **route, status=200) - \
+           sample(before, "chatapp_http_requests_total", **route, status=200) == 3
+    assert sample(after, "chatapp_http_request_duration_seconds_count", **route) - \
+           sample(before, "chatapp_http_request_duration_seconds_count", **route) == 3
+    assert sample(after, "chatapp_http_requests_in_flight", **route) == 0
+    # Membership, version and the page itself, the token comes from the cache
+    statements = sample(after, "chatapp_db_statements_total", route=route["route"]) - \
+        sample(before, "chatapp_db_statements_total", route=route["route"])
+    assert statements == 9
+    assert sample(after, "chatapp_bcrypt_seconds_total", route="/token") > \
+           sample(before, "chatapp_bcrypt_seconds_total", route="/token")
+    assert "# TYPE chatapp_http_request_duration_seconds histogram" in after
+    assert "chatapp_token_cache_hits_total" in after
+
+
+@pytest.mark.test_users([{}, {}])
+def test_profiling(sql_engine, sql_chat, sql_token, sql_users, tmp_path, monkeypatch):
+    import pstats
+    from starlette.middleware import Middleware
+    from app.main import app, create_access_token, token_username
+    from metrics import instrument_engine
+    from profiling import ProfilingMiddleware
+    instrument_engine(getattr(sql_engine, "sync_engine", sql_engine))
+    # Innermost, where main installs it when PROFILING_ENABLED is set
+    monkeypatch.setattr(app, "user_middleware", app.user_middleware + [Middleware(
+        ProfilingMiddleware, router=app.router, authorize=token_username, users={sql_users[0]["username"]},
+        directory=str(tmp_path / "profiles"),
+    )])
+    monkeypatch.setattr(app, "middleware_stack", app.build_middleware_stack())
+    client = TestClient(app)
+    path = f"/chats/{sql_chat.id}/messages"
+    headers = {"Authorization": f"Bearer {sql_token}"}
+
+    assert "x-profile-name" not in client.get(path, headers=headers).headers
+    other_user = {"Authorization": f"Bearer {create_access_token({'sub': sql_users[1]['username']})}"}
+    assert "x-profile-name" not in client.get(path, headers={**other_user, "X-Profile": "1"}).headers
+    assert not (tmp_path / "profiles").exists()
+
+    response = client.get(path, headers={**headers, "X-Profile": "1"})
+    assert response.status_code == status.HTTP_200_OK
+    assert len(response.json()["messages"]) == 10
+    name = response.headers["x-profile-name"]
+    info = json.loads((tmp_path / "profiles" / (name + ".json")).read_text())
+    assert info["route"] == "/chats/{chat_id}/messages"
+    assert info["user"] == sql_users[0]["username"]
+    assert info["status"] == status.HTTP_200_OK
+    assert info["statements"] == 3
+    # The sync session's round-trips ran in the threadpool and were profiled there
+    assert info["threadpool_calls"] > 0 or hasattr(sql_engine, "sync_engine")
+    assert pstats.Stats(str(tmp_path / "profiles" / (name + ".prof"))).total_calls > 0
+
+    response = client.get(path, headers={**headers, "X-Profile": "inline"})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "route: /chats/{chat_id}/messages" in response.text
+    assert "statements: 3" in response.text
+    assert "function calls" in response.text
+
+    # What the event loop runs in between the request's own steps isn't counted as part of it
+    import httpx
+    concurrent_calls = []
+
+    def concurrent_work():
+        concurrent_calls.append(sum(range(100)))
+
+    async def profile_alongside_other_work():
+        done = asyncio.Event()
+
+        async def other_work():
+            while not done.is_set():
+                concurrent_work()
+                await asyncio.sleep(0)
+
+        task = asyncio.ensure_future(other_work())
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as http:
+            await asyncio.sleep(0)
+            profiled = await http.get(path, headers={**headers, "X-Profile": "1"})
+        done.set()
+        await task
+        return profiled
+
+    response = asyncio.run(profile_alongside_other_work())
+    stats = pstats.Stats(str(tmp_path / "profiles" / (response.headers["x-profile-name"] + ".prof")))
+    assert len(concurrent_calls) > 1
+    assert "concurrent_work" not in {function for _, _, function in stats.stats}
+    assert "get_messages" in {function for _, _, function in stats.stats}
+
+
+def test_retention_archives_and_reads_through(sql_client, sql_db, sql_chat, sql_token, monkeypatch):
+    import retention
+    from app import db_defs
+    from app.main import archive_chats
+    monkeypatch.setattr(retention, "ARCHIVE_BATCH_SIZE", 4)
+    headers = {"Authorization": f"Bearer {sql_token}"}
+    ids = [message.id for message in sql_chat.messages]
+    path = f"/chats/{sql_chat.id}"
+
+    assert sql_client.put(f"{path}/retention", json={"max_count": 0}, headers=headers).status_code == \
+           status.HTTP_422_UNPROCESSABLE_ENTITY
+    assert sql_client.put(f"{path}/retention", json={"max_count": 5}, headers=headers).status_code == 200
+    assert sql_client.get(f"{path}/retention", headers=headers).json() == {"max_age": None, "max_count": 5}
+    etag = sql_client.get(f"{path}/messages", headers=headers).headers["ETag"]
+    # Five messages are over the limit, but only full blocks are archived
+    assert asyncio.run(archive_chats()) == 4
+    assert asyncio.run(archive_chats()) == 0
+    sql_db.expire_all()
+    assert [message.id for message in sql_db.query(db_defs.Message).order_by(db_defs.Message.id)] == ids[4:]
+    assert sql_db.query(db_defs.MessageArchive).count() == 1
+
+    def page_through(param, cursor):
+        seen = []
+        while True:
+            data = sql_client.get(f"{path}/messages", params={"limit": 3, param: cursor}, headers=headers).json()
+            seen.append([message["id"] for message in data["messages"]])
+            if data["next_cursor"] is None:
+                return seen
+            cursor = data["next_cursor"]
+
+    assert page_through("after", 0) == [ids[0:3], ids[3:6], ids[6:9], ids[9:]]
+    assert page_through("before", None) == [ids[7:], ids[4:7], ids[1:4], ids[:1]]
+    assert [m["content"] for m in sql_client.get(f"{path}/messages", headers=headers).json()["messages"]] == \
+           [str(i) for i in range(10)]
+    # Archiving changes nothing the client sees
+    assert sql_client.get(f"{path}/messages", headers={**headers, "If-None-Match": etag}).status_code == \
+           status.HTTP_304_NOT_MODIFIED
+    export = sql_client.get(f"{path}/messages/export", headers=headers).text.splitlines()
+    assert [json.loads(line)["id"] for line in export] == ids
+    assert [m["id"] for m in sql_client.get(f"{path}/changes", headers=headers).json()["messages"]] == ids
+    # Archived messages are read only
+    assert sql_client.post(f"{path}/messages/{ids[0]}", params={"message": "x"}, headers=headers).status_code == \
+           status.HTTP_409_CONFLICT
+    assert sql_client.delete(f"{path}/messages/{ids[1]}", headers=headers).status_code == status.HTTP_409_CONFLICT
+    assert sql_client.delete(f"{path}/messages/{ids[-1] + 100}", headers=headers).status_code == \
+           status.HTTP_404_NOT_FOUND
+    assert [m["content"] for m in sql_client.get(f"{path}/messages", headers=headers).json()["messages"]][:2] == \
+           ["0", "1"]
+    # and count as read
+    from app.main import add_user, create_access_token
+    add_user(sql_db, "joiner", "secret", "Joiner", "joiner@test.test")
+    sql_db.commit()
+    joiner = {"Authorization": f"Bearer {create_access_token({'sub': 'joiner'})}"}
+    invite = sql_client.post(f"{path}/invite", headers=headers).json()["invite"]
+    assert sql_client.get(f"/invite/{invite}", headers=joiner).status_code == 200
+    assert sql_client.get("/chats/", headers=joiner).json()["chats"][0]["unread_count"] == 6
+    assert sql_client.post(f"{path}/read", params={"message_id": ids[0]}, headers=joiner).json() == \
+           {"last_read_message_id": ids[3], "unread_count": 6}
+    assert sql_client.post(f"{path}/read", params={"message_id": ids[5]}, headers=joiner).json() == \
+           {"last_read_message_id": ids[5], "unread_count": 4}
+
+    assert sql_client.delete(path, headers=headers).status_code == 200
+    sql_db.expire_all()
+    assert sql_db.query(db_defs.MessageArchive).count() == 0
+
+
+def test_sharded_storage(tmp_path, monkeypatch):
+    # Messages and invites live in the shard of their chat and users, chats and members in the central database. The
+    # endpoints work the same, also after the chats were rebalanced onto more shards and back into one database.
+    import sqlite3
+    from sqlalchemy import create_engine, func, select
+    from sqlalchemy.orm import Session, sessionmaker
+    import db
+    import shards
+    from app.main import add_user, app, create_access_token, db_defs
+    from auth import token_cache
+    central_path = str(tmp_path / "central.db")
+    shard_url = f"sqlite:///{tmp_path}/shard{{}}.db"
+    central = db.configure_engine(create_engine(f"sqlite:///{central_path}", **db.engine_options(db.DB_URL)))
+    db_defs.Base.metadata.create_all(bind=central)
+    monkeypatch.setattr(db, "SessionLocal", sessionmaker(autoflush=False, autocommit=False, expire_on_commit=False,
+                                                         bind=central))
+    shard_sets = []
+
+    def use_shards(count):
+        shard_set = db.ShardSet(f"sqlite:///{central_path}", [shard_url.format(i) for i in range(count)],
+                                is_async=False) if count else None
+        if shard_set is not None:
+            shard_set.create_all()
+            shard_sets.append(shard_set)
+        monkeypatch.setattr(db, "shards", shard_set)
+
+    def stored(path, table=db_defs.Message):
+        engine = create_engine(f"sqlite:///{path}")
+        with engine.connect() as connection:
+            rows = connection.execute(select(table.chat_id, table.id)).all()
+        engine.dispose()
+        return rows
+
+    use_shards(2)
+    token_cache.clear()
+    with Session(central) as session:
+        for username in ("a", "b"):
+            add_user(session, username, "secret", username, f"{username}@test.test")
+        session.commit()
+    a = {"Authorization": f"Bearer {create_access_token({'sub': 'a'})}"}
+    b = {"Authorization": f"Bearer {create_access_token({'sub': 'b'})}"}
+    client = TestClient(app)
+    chat_ids = [client.post("/chats/", headers=a).json()["id"] for _ in range(6)]
+    for chat_id in chat_ids:
+        invite = client.post(f"/chats/{chat_id}/invite", headers=a).json()["invite"]
+        assert client.get(f"/invite/{invite}", headers=b).status_code == 200
+        for i in range(3):
+            assert client.post(f"/chats/{chat_id}/messages", params={"msg": f"hello {chat_id} {i}"},
+                               headers=b if i == 0 else a).status_code == 200
+
+    assert stored(central_path) == [] and stored(central_path, db_defs.Invite) == []
+    for shard in range(2):
+        rows = stored(tmp_path / f"shard{shard}.db")
+        assert {chat_id for chat_id, _ in rows} == {i for i in chat_ids if db.shard_for(i, 2) == shard}
+        assert all(shard * db.SHARD_ID_SPAN < message_id < (shard + 1) * db.SHARD_ID_SPAN for _, message_id in rows)
+
+    summaries = {chat["id"]: chat for chat in client.get("/chats/", headers=b).json()["chats"]}
+    assert all(summaries[chat_id]["unread_count"] == 2 for chat_id in chat_ids)
+    assert all(summaries[chat_id]["last_message"]["content"] == f"hello {chat_id} 2" for chat_id in chat_ids)
+    # The read state of a sharded chat is kept in its shard, messages are written without the central write lock
+    lock = sqlite3.connect(central_path, isolation_level=None)
+    lock.execute("BEGIN IMMEDIATE")
+    try:
+        for content in ("locked", "again"):
+            assert client.post(f"/chats/{chat_ids[0]}/messages", params={"msg": content}, headers=a).status_code == 200
+        *_, locked, again = client.get(f"/chats/{chat_ids[0]}/messages", headers=a).json()["messages"]
+        assert client.delete(f"/chats/{chat_ids[0]}/messages/{locked['id']}", headers=a).status_code == 200
+        read = client.post(f"/chats/{chat_ids[0]}/read", params={"message_id": again["id"] - 1}, headers=b).json()
+        assert read == {"last_read_message_id": again["id"] - 1, "unread_count": 1}
+    finally:
+        lock.rollback()
+        lock.close()
+    with Session(central) as session:
+        # Still at joining the empty chat
+        assert session.scalar(select(db_defs.chat_association_table.c.unread_count).filter_by(
+            chat_id=chat_ids[0], user_id="b")) == 0
+    assert client.get("/chats/", headers=b).json()["chats"][0]["unread_count"] == 1
+    assert client.delete(f"/chats/{chat_ids[0]}/messages/{again['id']}", headers=a).status_code == 200
+    assert client.get("/chats/", headers=b).json()["chats"][0]["unread_count"] == 0
+    full = client.get("/chats/", params={"full": True}, headers=b).json()
+    assert all(len(chat["messages"]) == 3 for chat in full)
+    found, cursor = [], None
+    while True:
+        page = client.get("/search", params={"q": "hello", "limit": 4, "cursor": cursor}, headers=b).json()
+        found += [result["message"]["id"] for result in page["results"]]
+        if page["next_cursor"] is None:
+            break
+        cursor = page["next_cursor"]
+    assert len(found) == len(set(found)) == 18
+
+    chat_id = chat_ids[-1]
+    path = f"/chats/{chat_id}"
+    version = client.get(f"{path}/changes", headers=a).json()["version"]
+    first, second, third = client.get(f"{path}/messages", headers=a).json()["messages"]
+    assert client.post(f"{path}/messages/{second['id']}", params={"message": "edited"}, headers=a).status_code == 200
+    assert client.delete(f"{path}/messages/{third['id']}", headers=a).status_code == 200
+    changes = client.get(f"{path}/changes", params={"since": version}, headers=a).json()
+    assert (changes["version"], changes["deleted"]) == (version + 2, [third["id"]])
+    assert [message["content"] for message in changes["messages"]] == ["edited"]
+    with Session(central) as session:
+        # The chat's version is counted in its shard
+        assert session.get(db_defs.Chat, chat_id).version == 0
+    monkeypatch.chdir(tmp_path)
+    attachment = client.post(f"/chats/{chat_ids[0]}/attachments", params={"filename": "a.txt"}, data=b"shared",
+                             headers=a).json()
+    assert client.post(f"/chats/{chat_ids[0]}/messages", params={"msg": "file", "attachment": attachment["id"]},
+                       headers=a).status_code == 200
+    history = {i: client.get(f"/chats/{i}/messages", headers=a).json()["messages"] for i in chat_ids}
+    unread = [chat["unread_count"] for chat in client.get("/chats/", headers=b).json()["chats"]]
+
+    for count in (3, 0):
+        assert shards.rebalance(central_path, shard_url, count) > 0
+        use_shards(count)
+        assert shards.plan(central_path, shard_url, count) == []
+        for i in chat_ids:
+            assert client.get(f"/chats/{i}/messages", headers=a).json()["messages"] == history[i]
+        assert client.get(f"{path}/changes", headers=a).json()["version"] == version + 2
+        assert [chat["unread_count"] for chat in client.get("/chats/", headers=b).json()["chats"]] == unread
+        assert client.get(f"/chats/{chat_ids[0]}/attachments/{attachment['id']}", headers=b).content == b"shared"
+    assert len(stored(central_path)) == 18
+    assert all(stored(tmp_path / f"shard{shard}.db") == [] for shard in range(3))
+
+    use_shards(3)
+    shards.rebalance(central_path, shard_url, 3)
+    assert client.post(f"{path}/messages", params={"msg": "after"}, headers=a).status_code == 200
+    assert client.get(path + "/messages", headers=a).json()["messages"][-1]["id"] > history[chat_id][-1]["id"]
+    assert client.delete(path, headers=a).status_code == 200
+    assert client.get(f"{path}/changes", headers=a).status_code == status.HTTP_410_GONE
+    assert chat_id not in {stored_chat_id for stored_chat_id, _ in
+                           stored(tmp_path / f"shard{db.shard_for(chat_id, 3)}.db")}
+    with Session(central) as session:
+        assert session.scalar(select(func.count()).select_from(db_defs.Chat)) == 5
+    for shard_set in shard_sets:
+        asyncio.run(shard_set.dispose())
+    central.dispose()